@@ -3,7 +3,9 @@ from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 from django.db import models
-from .models import Rank, TelegramGroup, User, UserInGroup, Message, DailyCheckin, MessageTypePoints
+from .models import Rank, TelegramGroup, User, UserInGroup, Message, DailyCheckin, MessageTypePoints, ChatSummary, SummaryJob, DailySummary, Interaction, ScoreHistogram, RankNotification, PointsLedger, DigestPost, ScheduledTaskRun
+from .ranks import rank_ladder, rerank_after_ladder_change
+from .exports import export_filename, export_response
 
 
 @admin.register(Rank)
@@ -14,12 +16,39 @@ class RankAdmin(admin.ModelAdmin):
     ordering = ['sort_order']
     search_fields = ['name']
 
+    def save_model(self, request, obj, form, change):
+        old_ladder = rank_ladder()
+        super().save_model(request, obj, form, change)
+        self._rerank(request, old_ladder)
+
+    def delete_model(self, request, obj):
+        old_ladder = rank_ladder()
+        super().delete_model(request, obj)
+        self._rerank(request, old_ladder)
+
+    def delete_queryset(self, request, queryset):
+        old_ladder = rank_ladder()
+        super().delete_queryset(request, queryset)
+        self._rerank(request, old_ladder)
+
+    def _rerank(self, request, old_ladder):
+        """Пересчитывает звания только в диапазоне рейтинга, который затронуло изменение"""
+        result = rerank_after_ladder_change(old_ladder)
+        if result:
+            upper = result['upper'] if result['upper'] is not None else '∞'
+            self.message_user(
+                request,
+                f"Звания пересчитаны для рейтинга {result['lower']}–{upper}: изменено {result['changed']}, "
+                f"уведомлений в очереди {result['queued']}"
+            )
+
 
 @admin.register(TelegramGroup)
 class TelegramGroupAdmin(admin.ModelAdmin):
     list_display = ['title', 'telegram_id', 'is_active', 'user_count', 'summary_actions']
     list_filter = ['is_active']
     search_fields = ['title', 'telegram_id']
+    actions = ['export_messages', 'export_memberships', 'export_leaderboard']
     
     def user_count(self, obj):
         return UserInGroup.objects.filter(group=obj, is_active=True).count()
@@ -30,13 +59,34 @@ class TelegramGroupAdmin(admin.ModelAdmin):
         from django.utils.html import format_html
         
         summary_url = f'/group/{obj.id}/summary/'
+        export_url = f'/group/{obj.id}/export/'
         return format_html(
-            '<a class="button" href="{}">📊 Резюмировать активность</a>',
-            summary_url
+            '<a class="button" href="{}">📊 Резюмировать активность</a> <a class="button" href="{}">📥 Выгрузка</a>',
+            summary_url, export_url
         )
     summary_actions.short_description = 'Действия'
     summary_actions.allow_tags = True
 
+    def _export(self, queryset, dataset, output, compress):
+        """Потоковая выгрузка по выбранным группам за все время"""
+        groups = list(queryset)
+        return export_response(
+            dataset, [group.id for group in groups], output=output, compress=compress,
+            filename=export_filename(dataset, groups[0] if len(groups) == 1 else None),
+        )
+
+    @admin.action(description='Выгрузить сообщения (CSV, gzip)')
+    def export_messages(self, request, queryset):
+        return self._export(queryset, 'messages', 'csv', True)
+
+    @admin.action(description='Выгрузить участников (CSV)')
+    def export_memberships(self, request, queryset):
+        return self._export(queryset, 'memberships', 'csv', False)
+
+    @admin.action(description='Выгрузить таблицу лидеров (CSV)')
+    def export_leaderboard(self, request, queryset):
+        return self._export(queryset, 'leaderboard', 'csv', False)
+
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
@@ -105,3 +155,71 @@ class MessageTypePointsAdmin(admin.ModelAdmin):
     list_display = ['message_type', 'points', 'description']
     list_editable = ['points']
     search_fields = ['message_type', 'description']
+
+
+@admin.register(ChatSummary)
+class ChatSummaryAdmin(admin.ModelAdmin):
+    list_display = ['group', 'start_datetime', 'end_datetime', 'model_name', 'message_count', 'input_tokens', 'prompt_tokens', 'created_at']
+    list_filter = ['group', 'model_name', 'created_at']
+    search_fields = ['group__title', 'summary']
+    readonly_fields = ['prompt_hash', 'fingerprint', 'created_at']
+    date_hierarchy = 'created_at'
+
+
+@admin.register(SummaryJob)
+class SummaryJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'group', 'start_datetime', 'end_datetime', 'status', 'created_at', 'finished_at']
+    list_filter = ['status', 'group', 'created_at']
+    readonly_fields = ['partial_output', 'timings', 'error', 'created_at', 'started_at', 'finished_at']
+
+
+@admin.register(DailySummary)
+class DailySummaryAdmin(admin.ModelAdmin):
+    list_display = ['group', 'day', 'message_count', 'created_at']
+    list_filter = ['group', 'day']
+    search_fields = ['group__title', 'summary']
+    date_hierarchy = 'day'
+
+
+@admin.register(DigestPost)
+class DigestPostAdmin(admin.ModelAdmin):
+    list_display = ['group', 'period', 'start_day', 'posted_at']
+    list_filter = ['group', 'period']
+
+
+@admin.register(ScheduledTaskRun)
+class ScheduledTaskRunAdmin(admin.ModelAdmin):
+    list_display = ['name', 'last_run']
+
+
+@admin.register(Interaction)
+class InteractionAdmin(admin.ModelAdmin):
+    list_display = ['group', 'from_user', 'to_user', 'reply_count', 'last_at']
+    list_filter = ['group']
+    search_fields = ['from_user__first_name', 'from_user__username', 'to_user__first_name', 'to_user__username']
+    ordering = ['-reply_count']
+
+
+@admin.register(ScoreHistogram)
+class ScoreHistogramAdmin(admin.ModelAdmin):
+    list_display = ['group', 'user', 'message_type', 'streak', 'count']
+    list_filter = ['group', 'message_type']
+    search_fields = ['user__first_name', 'user__username']
+    readonly_fields = ['group', 'user', 'message_type', 'streak', 'count']
+
+
+@admin.register(RankNotification)
+class RankNotificationAdmin(admin.ModelAdmin):
+    list_display = ['group', 'user', 'old_rank', 'new_rank', 'created_at', 'sent_at', 'attempts']
+    list_filter = ['group', 'new_rank']
+    search_fields = ['user__first_name', 'user__username']
+
+
+@admin.register(PointsLedger)
+class PointsLedgerAdmin(admin.ModelAdmin):
+    list_display = ['date', 'group', 'user', 'base_points', 'coefficient', 'awarded']
+    list_filter = ['group']
+    search_fields = ['user__first_name', 'user__username']
+    date_hierarchy = 'date'
+    raw_id_fields = ['message']
+    readonly_fields = ['message', 'group', 'user', 'base_points', 'coefficient', 'awarded', 'date']
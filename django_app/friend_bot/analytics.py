@@ -0,0 +1,56 @@
+"""Локальные запросы к снимку аналитики (snapshot_analytics) через DuckDB, без Django и без Postgres.
+
+Пример: python analytics.py ./analytics "SELECT month, count(*) FROM messages GROUP BY 1 ORDER BY 1"
+"""
+import os
+import sys
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+# Таблицы снимка, доступные в запросах как представления
+TABLES = ['messages', 'ledger', 'memberships']
+
+
+def connect(snapshot_dir):
+    """Соединение DuckDB в памяти с представлениями messages, ledger и memberships над Parquet-файлами"""
+    if duckdb is None:
+        raise RuntimeError('Для запросов к снимку нужен duckdb: pip install duckdb')
+    connection = duckdb.connect()
+    for table in TABLES:
+        pattern = os.path.join(snapshot_dir, table, '**', '*.parquet')
+        if not any(files for _, _, files in os.walk(os.path.join(snapshot_dir, table))):
+            continue
+        # union_by_name: в старых снимках пачки могли различаться колонкой text (до запрета менять --with-text)
+        connection.execute(
+            f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{pattern}', hive_partitioning = true, union_by_name = true)"
+        )
+    return connection
+
+
+def query(snapshot_dir, sql, params=None):
+    """Выполняет запрос к снимку и возвращает (колонки, строки)"""
+    connection = connect(snapshot_dir)
+    try:
+        cursor = connection.execute(sql, params or [])
+        return [column[0] for column in cursor.description], cursor.fetchall()
+    finally:
+        connection.close()
+
+
+def main(argv):
+    if len(argv) != 3:
+        print(__doc__.strip())
+        return 1
+    columns, rows = query(argv[1], argv[2])
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if value is None else str(value) for value in row))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
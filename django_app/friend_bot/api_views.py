@@ -3,8 +3,17 @@ from rest_framework.response import Response
 from rest_framework import status
 from django.utils import timezone
 from django.conf import settings
+from django.db import transaction
 from friend_bot.models import User, TelegramGroup, UserInGroup, Message, DailyCheckin, MessageTypePoints, Rank
 from .serializers import IngestMessageSerializer
+from .summary import format_message_link
+from .threads import fetch_thread
+from .scoring import coefficient_for_streak, effective_streak, moscow_day
+from .simulator import record_score, parse_proposal, simulate_group
+from .ledger import PERIOD_DAYS, record_points, period_bounds, period_leaderboard
+from .exports import DATASETS, FORMATS, export_filename, export_response, parse_period
+from .interactions import record_reply, get_best_friends, get_network_stats, display_name
+from .members import member_snapshot, group_snapshots
 from datetime import timedelta
 import os
 
@@ -62,124 +71,104 @@ class IngestMessageView(APIView):
             }
         )
 
-        # Message
-        msg, created = Message.objects.get_or_create(
-            telegram_id=data['telegram_message_id'],
-            chat=group,
-            defaults={
-                'date': data['date_iso'],
-                'user': user,
-                'message_type': data['message_type'],
-                'text': data.get('text') or '',
-                'related_message': data.get('related_telegram_message_id'),
-            }
-        )
-        if not created:
-            # idempotency update
-            updated = False
-            for field, key in [('message_type','message_type'), ('text','text')]:
-                val = data.get(key)
-                if val is not None and getattr(msg, field) != val:
-                    setattr(msg, field, val)
-                    updated = True
-            if updated:
-                msg.save()
-
-        # Add message points to UserInGroup
-        result = user_in_group.add_message_points(data['message_type'])
-        
-        # Check if this is the first message and assign initial rank
-        if not user_in_group.rank:
-            user_in_group.update_rank()
-        
-        # Если звание изменилось, отправляем уведомление в чат
-        if result.get('rank_changed') and result.get('new_rank'):
-            self._send_rank_notification(group, user, result['old_rank'], result['new_rank'])
-
-        # DailyCheckin - используем timezone.now() для корректной работы с часовыми поясами
-        checkin, created = DailyCheckin.objects.get_or_create(
-            user=user, 
-            group=group, 
-            defaults={
-                'consecutive_days': 0,  # Начинаем с 0 дней
-                'last_checkin': timezone.now()  # Используем Django timezone.now() с учетом часового пояса
-            }
-        )
-        if not created:
-            # Используем московское время для корректного сравнения дат
-            import pytz
-            moscow_tz = pytz.timezone('Europe/Moscow')
-            
-            # Конвертируем last_checkin в московское время
-            if checkin.last_checkin.tzinfo is None:
-                # Если время без часового пояса, считаем его UTC
-                last_checkin_utc = pytz.utc.localize(checkin.last_checkin)
-            else:
-                last_checkin_utc = checkin.last_checkin
-            last_checkin_moscow = last_checkin_utc.astimezone(moscow_tz)
-            last_date = last_checkin_moscow.date()
-            
-            # Конвертируем текущее время в московское
-            current_time = timezone.now()  # Используем Django timezone.now() вместо data['date_iso']
-            if current_time.tzinfo is None:
-                # Если время без часового пояса, считаем его UTC
-                current_utc = pytz.utc.localize(current_time)
-            else:
-                current_utc = current_time
-            current_moscow = current_utc.astimezone(moscow_tz)
-            today = current_moscow.date()
-            
-            diff = (today - last_date).days
-            print(f"🔍 DailyCheckin: last_date={last_date}, today={today}, diff={diff} дней")
-            
-            if diff == 1:
-                checkin.consecutive_days += 1
-                print(f"🔍 Увеличиваем consecutive_days до {checkin.consecutive_days}")
-            elif diff > 1:
-                checkin.consecutive_days = 0
-                print(f"🔍 Сбрасываем consecutive_days (прошло {diff} дней)")
-            elif diff == 0:
-                print(f"🔍 Уже чекинились сегодня")
-            else:
-                print(f"🔍 Отрицательная разница дней: {diff} (возможно, проблема с часовыми поясами)")
-            
-            checkin.last_checkin = timezone.now()  # Используем Django timezone.now() с учетом часового пояса
-            checkin.save()
-        else:
-            # Для нового пользователя оставляем consecutive_days = 0
-            # Первый чекин не считается как "непрерывный день"
-            print(f"🔍 Создан новый DailyCheckin для пользователя {user.first_name}")
-            pass
+        # Сообщение, очки, журнал начислений и серия записываются одной транзакцией.
+        # Очки начисляются только за новое сообщение: повторная доставка не дает очков повторно
+        with transaction.atomic():
+            # Строка участника блокируется до вставки сообщения: параллельные сообщения не теряют очки,
+            # а пересчет рейтингов (rebuild_group), заблокировав участников группы, видит все принятые сообщения
+            user_in_group = UserInGroup.objects.select_for_update().get(id=user_in_group.id)
+            msg, created = Message.objects.get_or_create(
+                telegram_id=data['telegram_message_id'],
+                chat=group,
+                defaults={
+                    'date': data['date_iso'],
+                    'user': user,
+                    'message_type': data['message_type'],
+                    'text': data.get('text') or '',
+                    'related_message': data.get('related_telegram_message_id'),
+                }
+            )
+            if not created:
+                # idempotency update
+                updated = False
+                for field, key in [('message_type','message_type'), ('text','text')]:
+                    val = data.get(key)
+                    if val is not None and getattr(msg, field) != val:
+                        setattr(msg, field, val)
+                        updated = True
+                if updated:
+                    msg.save()
+                checkin = DailyCheckin.objects.filter(user=user, group=group).first()
+                return Response({
+                    'status': 'ok',
+                    'duplicate': True,
+                    'member': member_snapshot(user_in_group, checkin),
+                }, status=status.HTTP_200_OK)
 
-        # Обновляем коэффициент на основе DailyCheckin
-        try:
-            checkin = DailyCheckin.objects.get(user=user, group=group)
-            if checkin.consecutive_days == 0:
-                user_in_group.coefficient = 0.5
-            elif checkin.consecutive_days == 1:
-                user_in_group.coefficient = 1.0
-            else:
-                user_in_group.coefficient = 1.0 + (checkin.consecutive_days - 1) * 0.1
-            user_in_group.save()
-        except DailyCheckin.DoesNotExist:
-            pass
+            # Ответ на известное сообщение - ребро в графе общения
+            record_reply(msg)
+
+            # Add message points to UserInGroup
+            result = user_in_group.add_message_points(data['message_type'])
+            record_points(msg, user_in_group, result)
+            record_score(group, user, data['message_type'], result['streak'])
+            
+            # Check if this is the first message and assign initial rank
+            if not user_in_group.rank:
+                user_in_group.update_rank()
+            
+            # Если звание изменилось, отправляем уведомление в чат после фиксации транзакции
+            if result.get('rank_changed') and result.get('new_rank'):
+                transaction.on_commit(
+                    lambda: self._send_rank_notification(group, user, result['old_rank'], result['new_rank'])
+                )
 
-        return Response({'status': 'ok'}, status=status.HTTP_200_OK)
+            # DailyCheckin: день храним московским номером, так что проверка - сравнение двух чисел
+            checkin, created = DailyCheckin.objects.get_or_create(
+                user=user, 
+                group=group, 
+                defaults={
+                    'consecutive_days': 0,  # Первый чекин не считается как "непрерывный день"
+                    'last_checkin': timezone.now(),
+                    'last_checkin_day': moscow_day(),
+                }
+            )
+            if created:
+                print(f"🔍 Создан новый DailyCheckin для пользователя {user.first_name}")
+            elif checkin.update_checkin():
+                print(f"🔍 DailyCheckin: новый день, непрерывных дней {checkin.consecutive_days}")
+
+            # Обновляем коэффициент на основе серии
+            coefficient = coefficient_for_streak(checkin.consecutive_days)
+            if user_in_group.coefficient != coefficient:
+                user_in_group.coefficient = coefficient
+                user_in_group.save(update_fields=['coefficient'])
+
+        # Новое состояние участника и рейтинг до сообщения: по нему бот проверяет, что его копия не отстала
+        return Response({
+            'status': 'ok',
+            'member': member_snapshot(user_in_group, checkin),
+            'old_rating': result['old_rating'],
+        }, status=status.HTTP_200_OK)
 
     def _send_rank_notification(self, group, user, old_rank, new_rank):
-        """Отправляет уведомление о новом звании пользователя"""
+        """Отправляет уведомление о новом звании пользователя, возвращает True при успехе"""
         try:
             # Формируем текст уведомления
             if old_rank is None:
                 message = f"🎉 <b>Поздравляем!</b>\n\n@{user.username or user.first_name} получил первое звание: <b>{new_rank.name}</b>"
+            elif new_rank.required_rating < old_rank.required_rating:
+                # Понижение бывает только после изменения порогов званий в админке
+                message = f"📉 <b>Звание изменилось</b>\n\n@{user.username or user.first_name} теперь <b>{new_rank.name}</b> (было <b>{old_rank.name}</b>)"
             else:
                 message = f"🏆 <b>Новое звание!</b>\n\n@{user.username or user.first_name} повысился с <b>{old_rank.name}</b> до <b>{new_rank.name}</b>"
             
             # Отправляем уведомление в чат через Bot API
-            self._send_telegram_message_direct(group.telegram_id, message)
+            return self._send_telegram_message_direct(group.telegram_id, message)
             
         except Exception as e:
             print(f"Ошибка при отправке уведомления о звании: {e}")
+            return False
     
     def _send_telegram_message_direct(self, chat_id, message_text):
         """Отправляет сообщение напрямую через Bot API (для уведомлений)"""
@@ -290,7 +279,8 @@ class StatisticsView(APIView):
                 # Получаем количество непрерывных дней из DailyCheckin
                 try:
                     checkin = DailyCheckin.objects.get(user=user_in_group.user, group=group)
-                    consecutive_days = checkin.consecutive_days
+                    # Серия могла прерваться после ночного сброса - показываем актуальную
+                    consecutive_days = effective_streak(checkin.consecutive_days, checkin.get_last_day(), moscow_day())
                 except DailyCheckin.DoesNotExist:
                     consecutive_days = 0
                 
@@ -524,3 +514,281 @@ class SendMessageView(APIView):
             print(f"❌ Traceback:")
             traceback.print_exc()
             return False
+
+
+class ThreadView(APIView):
+    """API для получения всей ветки ответов, в которую входит сообщение"""
+    authentication_classes = []
+    permission_classes = []
+
+    def post(self, request, group_id, telegram_id):
+        # Токен в теле запроса, как у остальных API бота: в строке запроса он попал бы в логи прокси
+        auth_token = request.data.get('auth_token')
+        if not auth_token:
+            return Response({'detail': 'Missing auth_token'}, status=status.HTTP_400_BAD_REQUEST)
+        if auth_token != settings.SECRET_KEY:
+            return Response({'detail': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            group = TelegramGroup.objects.get(id=group_id)
+        except TelegramGroup.DoesNotExist:
+            return Response({'detail': 'Group not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        thread = fetch_thread(group, telegram_id)
+        if not thread:
+            return Response({'detail': 'Message not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        messages = [{
+            'telegram_id': row['telegram_id'],
+            'related_message': row['related_message'],
+            'depth': row['depth'],
+            'date': row['date'],
+            'message_type': row['message_type'],
+            'text': row['text'],
+            'user': {
+                'telegram_id': row['user_telegram_id'],
+                'username': row['username'],
+                'first_name': row['first_name'],
+            },
+            'link': format_message_link(group, row['telegram_id']),
+        } for row in thread]
+
+        return Response({
+            'success': True,
+            'root_id': next(row['telegram_id'] for row in thread if row['depth'] == 0),
+            'message_count': len(messages),
+            'messages': messages,
+        }, status=status.HTTP_200_OK)
+
+
+class FriendsView(APIView):
+    """API для получения лучших друзей пользователя и сводки по графу общения группы"""
+    authentication_classes = []
+    permission_classes = []
+
+    def post(self, request):
+        auth_token = request.data.get('auth_token')
+        chat_id = request.data.get('chat_id')
+        user_id = request.data.get('user_id')
+
+        if not auth_token or not chat_id:
+            return Response({'detail': 'Missing auth_token or chat_id'}, status=status.HTTP_400_BAD_REQUEST)
+        if auth_token != settings.SECRET_KEY:
+            return Response({'detail': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            group = TelegramGroup.objects.get(telegram_id=chat_id)
+        except TelegramGroup.DoesNotExist:
+            return Response({'detail': 'Group not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        text = ""
+        best_friends = []
+        if user_id:
+            user = User.objects.filter(telegram_id=user_id).first()
+            if user:
+                best_friends = get_best_friends(group, user)
+                text += f"🤝 <b>Лучшие друзья {display_name(user)}:</b>\n\n"
+                if best_friends:
+                    for i, friend in enumerate(best_friends, 1):
+                        text += f"{i}. <b>{display_name(friend['user'])}</b> - ответов: {friend['sent']} ↔ {friend['received']}\n"
+                else:
+                    text += "Пока ни с кем не переписывался через ответы.\n"
+                text += "\n"
+
+        network = get_network_stats(group)
+        text += (
+            f"🕸 <b>Граф общения группы:</b>\n"
+            f"🔗 Пар собеседников: {network['edge_count']}\n"
+            f"💬 Всего ответов: {network['total_replies']}\n"
+        )
+        if network['top_pairs']:
+            text += "\n👯 <b>Самые болтливые пары:</b>\n"
+            for i, (first, second, count) in enumerate(network['top_pairs'], 1):
+                text += f"{i}. {display_name(first)} и {display_name(second)} - {count}\n"
+        if network['most_replied']:
+            text += "\n🎯 <b>Больше всего ответов получают:</b>\n"
+            for i, (user, count) in enumerate(network['most_replied'], 1):
+                text += f"{i}. {display_name(user)} - {count}\n"
+
+        return Response({
+            'success': True,
+            'text': text,
+            'best_friends': [{
+                'telegram_id': friend['user'].telegram_id,
+                'name': display_name(friend['user']),
+                'sent': friend['sent'],
+                'received': friend['received'],
+            } for friend in best_friends],
+            'network': {
+                'edge_count': network['edge_count'],
+                'total_replies': network['total_replies'],
+            },
+        }, status=status.HTTP_200_OK)
+
+
+class SimulateView(APIView):
+    """API симулятора: рейтинги и звания при предложенных баллах за типы и лестнице званий.
+
+    Ничего не записывает; считается по счетчикам ScoreHistogram, а не по таблице сообщений.
+    """
+    authentication_classes = []
+    permission_classes = []
+
+    def post(self, request):
+        auth_token = request.data.get('auth_token')
+        if not auth_token:
+            return Response({'detail': 'Missing auth_token'}, status=status.HTTP_400_BAD_REQUEST)
+        if auth_token != settings.SECRET_KEY:
+            return Response({'detail': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            points_table, rank_ladder = parse_proposal(request.data.get('points'), request.data.get('ranks'))
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.data.get('limit', 20))
+        except (TypeError, ValueError):
+            return Response({'detail': 'Invalid limit'}, status=status.HTTP_400_BAD_REQUEST)
+
+        groups = TelegramGroup.objects.filter(is_active=True)
+        chat_id = request.data.get('chat_id')
+        if chat_id:
+            groups = groups.filter(telegram_id=chat_id)
+            if not groups.exists():
+                return Response({'detail': 'Group not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        results = []
+        for group in groups:
+            simulation = simulate_group(group, points_table, rank_ladder, limit=limit)
+            results.append({
+                'chat_id': group.telegram_id,
+                'title': group.title,
+                'member_count': simulation['member_count'],
+                'indexed_users': simulation['indexed_users'],
+                'leaderboard': [{
+                    'position': row['position'],
+                    'current_position': row['current_position'],
+                    'telegram_id': row['user'].telegram_id,
+                    'name': display_name(row['user']),
+                    'rating': row['rating'],
+                    'current_rating': row['current_rating'],
+                    'rank': row['rank'],
+                    'current_rank': row['current_rank'],
+                } for row in simulation['leaderboard']],
+                'rank_distribution': [
+                    {'name': name, 'count': count} for name, count in simulation['rank_distribution']
+                ],
+                'without_rank': simulation['without_rank'],
+            })
+
+        return Response({
+            'success': True,
+            'points': points_table,
+            'ranks': [{'name': name, 'required_rating': required} for required, name in rank_ladder],
+            'groups': results,
+        }, status=status.HTTP_200_OK)
+
+
+class LeaderboardView(APIView):
+    """API таблицы лидеров группы по очкам за период (день, неделя, месяц) из журнала начислений"""
+    authentication_classes = []
+    permission_classes = []
+
+    def post(self, request):
+        auth_token = request.data.get('auth_token')
+        chat_id = request.data.get('chat_id')
+        if not auth_token or not chat_id:
+            return Response({'detail': 'Missing auth_token or chat_id'}, status=status.HTTP_400_BAD_REQUEST)
+        if auth_token != settings.SECRET_KEY:
+            return Response({'detail': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        period = request.data.get('period', 'week')
+        if period not in PERIOD_DAYS:
+            return Response({'detail': f'Unknown period, expected one of: {", ".join(PERIOD_DAYS)}'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.data.get('limit', 10))
+        except (TypeError, ValueError):
+            return Response({'detail': 'Invalid limit'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            group = TelegramGroup.objects.get(telegram_id=chat_id)
+        except TelegramGroup.DoesNotExist:
+            return Response({'detail': 'Group not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        start, end = period_bounds(period)
+        leaders = period_leaderboard(group, start, end, limit=limit)
+        return Response({
+            'success': True,
+            'period': period,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'leaderboard': [{
+                'position': position,
+                'telegram_id': row['user'].telegram_id,
+                'name': display_name(row['user']),
+                'points': row['points'],
+                'messages': row['messages'],
+            } for position, row in enumerate(leaders, 1)],
+        }, status=status.HTTP_200_OK)
+
+
+class MembersView(APIView):
+    """API состояния участников группы (или всех активных групп без chat_id) для копии таблицы лидеров в боте"""
+    authentication_classes = []
+    permission_classes = []
+
+    def post(self, request):
+        auth_token = request.data.get('auth_token')
+        if not auth_token:
+            return Response({'detail': 'Missing auth_token'}, status=status.HTTP_400_BAD_REQUEST)
+        if auth_token != settings.SECRET_KEY:
+            return Response({'detail': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        chat_id = request.data.get('chat_id')
+        if chat_id:
+            groups = list(TelegramGroup.objects.filter(telegram_id=chat_id))
+            if not groups:
+                return Response({'detail': 'Group not found'}, status=status.HTTP_404_NOT_FOUND)
+        else:
+            groups = list(TelegramGroup.objects.filter(is_active=True))
+
+        return Response({'success': True, 'groups': group_snapshots(groups)}, status=status.HTTP_200_OK)
+
+
+class ExportView(APIView):
+    """Потоковая выгрузка сообщений, участников или таблицы лидеров группы в CSV или JSONL (опционально gzip).
+
+    Токен - в заголовке X-Auth-Token (в строке запроса он попал бы в логи прокси и историю браузера;
+    из браузера выгрузка доступна сотрудникам на странице группы).
+    Параметры: start и end (YYYY-MM-DD), output (csv или jsonl), gzip=1.
+    """
+    authentication_classes = []
+    permission_classes = []
+
+    def get(self, request, group_id, dataset):
+        auth_token = request.headers.get('X-Auth-Token')
+        if not auth_token:
+            return Response({'detail': 'Missing auth_token'}, status=status.HTTP_400_BAD_REQUEST)
+        if auth_token != settings.SECRET_KEY:
+            return Response({'detail': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        if dataset not in DATASETS:
+            return Response({'detail': f'Unknown dataset, expected one of: {", ".join(DATASETS)}'}, status=status.HTTP_404_NOT_FOUND)
+        output = request.query_params.get('output', 'csv')
+        if output not in FORMATS:
+            return Response({'detail': f'Unknown output, expected one of: {", ".join(FORMATS)}'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            start, end = parse_period(request.query_params.get('start'), request.query_params.get('end'))
+        except ValueError as e:
+            return Response({'detail': f'Invalid period: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            group = TelegramGroup.objects.get(id=group_id)
+        except TelegramGroup.DoesNotExist:
+            return Response({'detail': 'Group not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        return export_response(
+            dataset, [group.id], start, end, output=output,
+            compress=request.query_params.get('gzip') in ('1', 'true'),
+            filename=export_filename(dataset, group, start, end),
+        )
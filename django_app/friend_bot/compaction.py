@@ -0,0 +1,136 @@
+import re
+from datetime import timedelta
+
+
+# Сообщения одного автора, написанные с паузой не больше MERGE_GAP, склеиваются в одну строку
+MERGE_GAP = timedelta(minutes=3)
+
+# Сообщения без текста в промпте заменяются счетчиками по типу
+MEDIA_LABELS = {
+    'sticker': 'стикер',
+    'voice': 'голосовое',
+    'video_note': 'кружок',
+    'photo': 'фото',
+    'video': 'видео',
+    'document': 'документ',
+    'audio': 'аудио',
+    'forward': 'пересланное',
+    'other': 'вложение',
+}
+
+# Реплики, которые сами по себе ничего не сообщают модели
+LOW_SIGNAL_TEXTS = {
+    'ок', 'ok', 'окей', 'да', 'нет', 'ага', 'угу', 'неа', 'лол', 'lol', 'ахах', 'ахаха', 'хах', 'хаха',
+    'ха', '+', 'спс', 'спасибо', 'норм', 'пон', 'ясно', 'понятно', 'ну', 'мм', 'ммм', 'хм',
+}
+
+# Сколько последних строк проверять на повтор
+DEDUPE_LOOKBACK = 50
+
+_NON_WORD = re.compile(r'[^\w+]+')
+
+
+def normalize_text(text):
+    """Приводит текст к виду для сравнения: нижний регистр, без знаков препинания и эмодзи"""
+    return _NON_WORD.sub(' ', text.lower()).strip()
+
+
+def compact_messages(messages):
+    """Сжимает поток сообщений перед отправкой модели.
+
+    messages - словари с ключами telegram_id, related_message, user_key, user_label, date,
+    message_type, text в хронологическом порядке. Подряд идущие сообщения одного автора
+    склеиваются, стикеры/голосовые/кружки превращаются в счетчики, почти одинаковые
+    реплики и одиночные "ок" отбрасываются. Ссылки на поглощенные сообщения
+    перенаправляются на сохраненные, чтобы не рвать ветки ответов.
+
+    Возвращает список строк: словари с telegram_id, related_message, user_labels,
+    texts (пары [текст, сколько раз повторен]) и media (тип -> количество).
+    """
+    replied_to = {message['related_message'] for message in messages if message['related_message'] is not None}
+    aliases = {}
+    runs = []
+    recent = {}
+
+    for message in messages:
+        related = aliases.get(message['related_message'], message['related_message'])
+        text = message['text'].strip()
+        normalized = normalize_text(text)
+        is_media = not text and message['message_type'] in MEDIA_LABELS
+        is_parent = message['telegram_id'] in replied_to
+
+        # Повтор недавней реплики: считаем его у первой, а саму строку не выводим.
+        # Ответы и сообщения, на которые отвечали, не трогаем - они держат ветку
+        duplicate_of = recent.get(normalized) if normalized and related is None and not is_parent else None
+        if duplicate_of is not None and len(runs) - duplicate_of[0]['index'] <= DEDUPE_LOOKBACK:
+            duplicate_of[1][1] += 1
+            aliases[message['telegram_id']] = duplicate_of[0]['telegram_id']
+            continue
+
+        last = runs[-1] if runs else None
+        can_merge = (
+            last is not None
+            and last['user_key'] == message['user_key']
+            and message['date'] - last['last_date'] <= MERGE_GAP
+            # Ответ другому сообщению начинает новую строку, чтобы ветка осталась видна
+            and (related is None or related == last['telegram_id'])
+        )
+        # Подряд идущие медиа без текста схлопываются в один счетчик, кто бы их ни прислал
+        is_media_burst = (
+            not can_merge
+            and is_media
+            and related is None
+            and not is_parent
+            and last is not None
+            and not last['texts']
+            and not last['replied']
+        )
+        if is_media_burst:
+            run = last
+            aliases[message['telegram_id']] = run['telegram_id']
+            if message['user_key'] != run['user_key']:
+                run['user_key'] = None
+                if message['user_label'] not in run['user_labels']:
+                    run['user_labels'].append(message['user_label'])
+        elif can_merge:
+            run = last
+            aliases[message['telegram_id']] = run['telegram_id']
+        else:
+            run = {
+                'index': len(runs),
+                'telegram_id': message['telegram_id'],
+                'related_message': related,
+                'user_key': message['user_key'],
+                'user_labels': [message['user_label']],
+                'texts': [],
+                'media': {},
+                'replied': False,
+            }
+            runs.append(run)
+
+        run['last_date'] = message['date']
+        run['replied'] = run['replied'] or is_parent
+        if is_media:
+            run['media'][message['message_type']] = run['media'].get(message['message_type'], 0) + 1
+        elif text:
+            entry = [text, 1]
+            run['texts'].append(entry)
+            if normalized:
+                recent[normalized] = (run, entry)
+
+    return [run for run in runs if run['replied'] or not is_low_signal(run)]
+
+
+def is_low_signal(run):
+    """Строка из одних коротких реплик вроде "ок" или пустая"""
+    if run['media']:
+        return False
+    return all(normalize_text(text) in LOW_SIGNAL_TEXTS for text, _ in run['texts'])
+
+
+def format_media_counts(media):
+    """Форматирует счетчики медиа: 'стикер ×3, голосовое'"""
+    return ", ".join(
+        f"{MEDIA_LABELS[message_type]} ×{count}" if count > 1 else MEDIA_LABELS[message_type]
+        for message_type, count in media.items()
+    )
@@ -0,0 +1,151 @@
+import csv
+import json
+import zlib
+from datetime import date
+from django.db.models import Count, F, Sum
+from django.http import StreamingHttpResponse
+from .models import Message, PointsLedger, UserInGroup
+from .summary import day_bounds
+
+
+# Сколько строк забирать из серверного курсора за раз
+EXPORT_CHUNK_SIZE = 2000
+
+# Сколько байт копить перед отправкой очередного куска ответа
+FLUSH_SIZE = 64 * 1024
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def export_messages(group_ids, start=None, end=None):
+    """Сообщения групп за период: (колонки, итератор строк) в порядке времени"""
+    columns = ['chat_id', 'telegram_id', 'date', 'user_telegram_id', 'username', 'first_name', 'message_type', 'text', 'related_message']
+    queryset = Message.objects.filter(chat_id__in=group_ids)
+    if start:
+        queryset = queryset.filter(date__gte=start)
+    if end:
+        queryset = queryset.filter(date__lte=end)
+    rows = queryset.order_by('chat_id', 'date', 'id').values_list(
+        'chat__telegram_id', 'telegram_id', 'date', 'user__telegram_id', 'user__username', 'user__first_name',
+        'message_type', 'text', 'related_message'
+    )
+    return columns, rows.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def export_memberships(group_ids, start=None, end=None):
+    """Участники групп с рейтингом, званием и активностью (период не учитывается)"""
+    columns = ['chat_id', 'user_telegram_id', 'username', 'first_name', 'rating', 'message_count', 'coefficient', 'rank', 'joined_at', 'last_activity', 'is_active']
+    rows = UserInGroup.objects.filter(group_id__in=group_ids).order_by('group_id', '-rating', 'id').values_list(
+        'group__telegram_id', 'user__telegram_id', 'user__username', 'user__first_name', 'rating', 'message_count',
+        'coefficient', 'rank__name', 'joined_at', 'last_activity', 'is_active'
+    )
+    return columns, rows.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def export_leaderboard(group_ids, start=None, end=None):
+    """Таблица лидеров: очки за период из журнала начислений, без периода - текущий рейтинг"""
+    if not start and not end:
+        columns = ['chat_id', 'user_telegram_id', 'username', 'first_name', 'points', 'messages', 'rank']
+        rows = UserInGroup.objects.filter(group_id__in=group_ids, is_active=True).order_by('group_id', '-rating', 'id').values_list(
+            'group__telegram_id', 'user__telegram_id', 'user__username', 'user__first_name', 'rating', 'message_count', 'rank__name'
+        )
+        return columns, rows.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    columns = ['chat_id', 'user_telegram_id', 'username', 'first_name', 'points', 'messages']
+    queryset = PointsLedger.objects.filter(group_id__in=group_ids)
+    if start:
+        queryset = queryset.filter(date__gte=start)
+    if end:
+        queryset = queryset.filter(date__lte=end)
+    rows = queryset.values('group_id', 'user_id').annotate(
+        chat_id=F('group__telegram_id'), user_telegram_id=F('user__telegram_id'),
+        username=F('user__username'), first_name=F('user__first_name'),
+        points=Sum('awarded'), messages=Count('id'),
+    ).order_by('group_id', '-points', 'user_id').values_list(*columns)
+    return columns, rows.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+DATASETS = {
+    'messages': export_messages,
+    'memberships': export_memberships,
+    'leaderboard': export_leaderboard,
+}
+
+
+class Echo:
+    """Файлоподобный объект для csv.writer: возвращает строку вместо записи"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(columns, rows):
+    """Строки CSV с заголовком"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_jsonl(columns, rows):
+    """Строки JSON по одной на запись (NDJSON)"""
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n'
+
+
+def iter_buffered(lines, compress=False):
+    """Склеивает строки в куски по FLUSH_SIZE байт и при необходимости сжимает их gzip на лету"""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = []
+    size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= FLUSH_SIZE:
+            chunk = b''.join(buffer)
+            buffer, size = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    chunk = b''.join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def parse_period(start=None, end=None):
+    """Период выгрузки из дат YYYY-MM-DD (включительно, по московскому времени); пустые - без границы"""
+    start = day_bounds(date.fromisoformat(start))[0] if start else None
+    end = day_bounds(date.fromisoformat(end))[1] if end else None
+    if start and end and start > end:
+        raise ValueError('Начало периода позже конца')
+    return start, end
+
+
+def export_filename(dataset, group, start=None, end=None):
+    """Имя файла выгрузки без расширения"""
+    parts = [dataset, str(group.telegram_id) if group else 'groups']
+    if start or end:
+        parts.append(f'{start:%Y%m%d}' if start else 'begin')
+        parts.append(f'{end:%Y%m%d}' if end else 'now')
+    return '_'.join(parts)
+
+
+def export_response(dataset, group_ids, start=None, end=None, output='csv', compress=False, filename='export'):
+    """Потоковый ответ с выгрузкой: память не зависит от объема, строки идут из серверного курсора"""
+    columns, rows = DATASETS[dataset](group_ids, start, end)
+    lines = iter_csv(columns, rows) if output == 'csv' else iter_jsonl(columns, rows)
+    filename = f'{filename}.{output}'
+    if compress:
+        content_type = 'application/gzip'
+        filename += '.gz'
+    else:
+        content_type = f'{FORMATS[output]}; charset=utf-8'
+    response = StreamingHttpResponse(iter_buffered(lines, compress), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
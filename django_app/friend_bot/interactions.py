@@ -0,0 +1,130 @@
+from django.db import transaction
+from django.db.models import F, Q, Sum, Value
+from django.db.models.functions import Greatest
+from .models import Interaction, Message, User
+
+
+def record_reply(msg):
+    """Учитывает ответ в графе общения, если сообщение-родитель известно и написано другим человеком"""
+    if msg.related_message is None:
+        return None
+
+    to_user_id = Message.objects.filter(
+        chat_id=msg.chat_id,
+        telegram_id=msg.related_message
+    ).values_list('user_id', flat=True).first()
+    if to_user_id is None or to_user_id == msg.user_id:
+        return None
+
+    edge, created = Interaction.objects.get_or_create(
+        group_id=msg.chat_id,
+        from_user_id=msg.user_id,
+        to_user_id=to_user_id,
+        defaults={'reply_count': 1, 'last_at': msg.date}
+    )
+    if not created:
+        # Инкремент в БД, чтобы параллельные запросы не теряли ответы
+        Interaction.objects.filter(id=edge.id).update(
+            reply_count=F('reply_count') + 1,
+            last_at=Greatest('last_at', Value(msg.date))
+        )
+    return edge
+
+
+def get_best_friends(group, user, limit=5):
+    """Возвращает самых близких собеседников пользователя по ответам в обе стороны.
+
+    Читаются только ребра самого пользователя, так что запрос пропорционален числу его собеседников.
+    """
+    friends = {}
+    edges = Interaction.objects.filter(group=group).filter(Q(from_user=user) | Q(to_user=user))
+    for from_user_id, to_user_id, reply_count, last_at in edges.values_list('from_user_id', 'to_user_id', 'reply_count', 'last_at'):
+        outgoing = from_user_id == user.id
+        friend_id = to_user_id if outgoing else from_user_id
+        friend = friends.setdefault(friend_id, {'sent': 0, 'received': 0, 'last_at': last_at})
+        friend['sent' if outgoing else 'received'] += reply_count
+        friend['last_at'] = max(friend['last_at'], last_at)
+
+    ranked = sorted(friends.items(), key=lambda item: item[1]['sent'] + item[1]['received'], reverse=True)[:limit]
+    users = User.objects.in_bulk([friend_id for friend_id, _ in ranked])
+    return [
+        {'user': users[friend_id], 'total': stats['sent'] + stats['received'], **stats}
+        for friend_id, stats in ranked
+    ]
+
+
+def get_network_stats(group, limit=5):
+    """Считает сводку по графу общения группы только по таблице ребер"""
+    edges = Interaction.objects.filter(group=group)
+    totals = edges.aggregate(total_replies=Sum('reply_count'))
+
+    # Пары считаем без учета направления: a → b и b → a складываются
+    pairs = {}
+    for from_user_id, to_user_id, reply_count in edges.values_list('from_user_id', 'to_user_id', 'reply_count'):
+        key = (min(from_user_id, to_user_id), max(from_user_id, to_user_id))
+        pairs[key] = pairs.get(key, 0) + reply_count
+    top_pairs = sorted(pairs.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    most_replied = list(edges.values('to_user').annotate(total=Sum('reply_count')).order_by('-total')[:limit])
+    most_replying = list(edges.values('from_user').annotate(total=Sum('reply_count')).order_by('-total')[:limit])
+
+    user_ids = {user_id for pair, _ in top_pairs for user_id in pair}
+    user_ids.update(row['to_user'] for row in most_replied)
+    user_ids.update(row['from_user'] for row in most_replying)
+    users = User.objects.in_bulk(user_ids)
+
+    return {
+        'edge_count': len(pairs),
+        'total_replies': totals['total_replies'] or 0,
+        'top_pairs': [(users[a], users[b], count) for (a, b), count in top_pairs],
+        'most_replied': [(users[row['to_user']], row['total']) for row in most_replied],
+        'most_replying': [(users[row['from_user']], row['total']) for row in most_replying],
+    }
+
+
+def rebuild_interactions(group, chunk_size=5000, stdout=None):
+    """Пересчитывает граф общения группы по истории сообщений, читая ответы частями"""
+    edges = {}
+    last_id = 0
+    processed = 0
+    replies = Message.objects.filter(chat=group, related_message__isnull=False).order_by('id')
+
+    while True:
+        chunk = list(replies.filter(id__gt=last_id).values_list('id', 'user_id', 'related_message', 'date')[:chunk_size])
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+        processed += len(chunk)
+
+        parents = dict(Message.objects.filter(
+            chat=group,
+            telegram_id__in={related for _, _, related, _ in chunk}
+        ).values_list('telegram_id', 'user_id'))
+
+        for _, from_user_id, related, date in chunk:
+            to_user_id = parents.get(related)
+            if to_user_id is None or to_user_id == from_user_id:
+                continue
+            edge = edges.get((from_user_id, to_user_id))
+            if edge is None:
+                edges[(from_user_id, to_user_id)] = [1, date]
+            else:
+                edge[0] += 1
+                edge[1] = max(edge[1], date)
+
+        if stdout:
+            stdout.write(f'  … {group.title}: обработано ответов {processed}, ребер {len(edges)}')
+
+    with transaction.atomic():
+        Interaction.objects.filter(group=group).delete()
+        Interaction.objects.bulk_create([
+            Interaction(group=group, from_user_id=from_user_id, to_user_id=to_user_id, reply_count=count, last_at=last_at)
+            for (from_user_id, to_user_id), (count, last_at) in edges.items()
+        ], batch_size=1000)
+
+    return len(edges)
+
+
+def display_name(user):
+    """Имя пользователя для сообщений в чат"""
+    return f"@{user.username}" if user.username else user.first_name
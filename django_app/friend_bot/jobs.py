@@ -0,0 +1,138 @@
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import SummaryJob
+from .summary import get_or_create_summary
+
+
+# Пул потоков для задач резюме внутри веб-процесса (SUMMARY_JOB_BACKEND = 'thread')
+_executor = None
+
+# Как часто сохранять потоковый вывод модели в БД, секунд
+PROGRESS_SAVE_INTERVAL = 1.0
+
+# Задачи, уже переданные в пул этого процесса из requeue_orphaned_jobs
+_requeued = set()
+
+
+def get_executor():
+    """Возвращает пул потоков для фоновых задач, создавая его при первом обращении"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.SUMMARY_JOB_WORKERS,
+            thread_name_prefix='summary-job'
+        )
+    return _executor
+
+
+def enqueue_summary_job(group, start_datetime, end_datetime, custom_prompt=None, force=False):
+    """Создает задачу резюме и, если задачи выполняются в веб-процессе, ставит ее в пул"""
+    job = SummaryJob.objects.create(
+        group=group,
+        start_datetime=start_datetime,
+        end_datetime=end_datetime,
+        custom_prompt=custom_prompt or '',
+        force_regenerate=force,
+    )
+    if settings.SUMMARY_JOB_BACKEND == 'thread':
+        # Запускаем только после коммита, чтобы поток точно увидел задачу
+        transaction.on_commit(lambda: get_executor().submit(run_summary_job, job.id))
+    print(f"📝 Создана задача резюме #{job.id} для группы {group.title}")
+    return job
+
+
+def claim_job(job_id):
+    """Атомарно переводит задачу из очереди в работу; False, если ее уже взял другой воркер"""
+    return SummaryJob.objects.filter(id=job_id, status='queued').update(
+        status='running',
+        started_at=timezone.now()
+    ) == 1
+
+
+def run_summary_job(job_id):
+    """Выполняет задачу резюме и сохраняет промежуточный и итоговый результат"""
+    try:
+        if not claim_job(job_id):
+            return
+        job = SummaryJob.objects.select_related('group').get(id=job_id)
+        print(f"🚀 Начинаем задачу резюме #{job.id} для группы {job.group.title}")
+
+        last_saved = [0.0]
+
+        def on_progress(stage, text):
+            # Потоковый вывод приходит часто - пишем в БД не чаще раза в секунду
+            now = time.monotonic()
+            if now - last_saved[0] < PROGRESS_SAVE_INTERVAL:
+                return
+            last_saved[0] = now
+            SummaryJob.objects.filter(id=job.id).update(stage=stage, partial_output=text)
+
+        saved_summary, result = get_or_create_summary(
+            job.group, job.start_datetime, job.end_datetime, job.custom_prompt,
+            force=job.force_regenerate, on_progress=on_progress
+        )
+
+        if saved_summary is None:
+            SummaryJob.objects.filter(id=job.id).update(
+                status='failed',
+                error=result['summary'],
+                timings=result['timings'],
+                finished_at=timezone.now()
+            )
+            print(f"❌ Задача резюме #{job.id} завершилась ошибкой")
+            return
+
+        SummaryJob.objects.filter(id=job.id).update(
+            status='done',
+            stage='',
+            summary=saved_summary,
+            partial_output=saved_summary.summary,
+            timings=result['timings'] if result else {},
+            finished_at=timezone.now()
+        )
+        print(f"✅ Задача резюме #{job.id} выполнена")
+
+    except Exception as e:
+        traceback.print_exc()
+        SummaryJob.objects.filter(id=job_id).update(
+            status='failed',
+            error=str(e),
+            finished_at=timezone.now()
+        )
+    finally:
+        # Соединение с БД принадлежит потоку пула - закрываем его сами
+        connection.close()
+
+
+def fail_stale_jobs(timeout_minutes):
+    """Помечает ошибкой задачи, которые слишком долго висят в работе (упавший процесс)"""
+    deadline = timezone.now() - timedelta(minutes=timeout_minutes)
+    return SummaryJob.objects.filter(status='running', started_at__lt=deadline).update(
+        status='failed',
+        error='Задача прервана: процесс, выполнявший ее, не ответил вовремя',
+        finished_at=timezone.now()
+    )
+
+
+def requeue_orphaned_jobs(timeout_minutes):
+    """Передает в пул этого процесса задачи, которые слишком долго ждут в очереди.
+
+    При SUMMARY_JOB_BACKEND = 'thread' очередь живет в памяти веб-процесса: после его перезапуска
+    задачи остаются в статусе queued навсегда. Если веб-процесс все же доберется до задачи,
+    выполнит ее только один из двух (claim_job).
+    """
+    deadline = timezone.now() - timedelta(minutes=timeout_minutes)
+    job_ids = [
+        job_id for job_id in SummaryJob.objects.filter(status='queued', created_at__lt=deadline)
+        .order_by('created_at').values_list('id', flat=True)
+        if job_id not in _requeued
+    ]
+    for job_id in job_ids:
+        _requeued.add(job_id)
+        get_executor().submit(run_summary_job, job_id)
+    return len(job_ids)
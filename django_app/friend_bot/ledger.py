@@ -0,0 +1,57 @@
+from datetime import timedelta
+from django.db.models import Count, Sum
+from django.utils import timezone
+from .models import PointsLedger, User
+from .summary import day_bounds
+
+
+# Периоды для таблиц лидеров: сколько последних дней (включая сегодня) в них входит
+PERIOD_DAYS = {
+    'day': 1,
+    'week': 7,
+    'month': 30,
+}
+
+
+def record_points(message, user_in_group, result):
+    """Записывает в журнал начисление за сообщение (результат UserInGroup.add_message_points)"""
+    return PointsLedger.objects.create(
+        message=message,
+        group_id=user_in_group.group_id,
+        user_id=user_in_group.user_id,
+        base_points=result['base_points'],
+        coefficient=result['coefficient'],
+        awarded=result['points'],
+        date=message.date,
+    )
+
+
+def period_bounds(period, today=None):
+    """Начало и конец периода по московскому времени: последние PERIOD_DAYS[period] дней"""
+    if today is None:
+        today = timezone.localdate()
+    start = day_bounds(today - timedelta(days=PERIOD_DAYS[period] - 1))[0]
+    return start, day_bounds(today)[1]
+
+
+def period_leaderboard(group, start, end, limit=10):
+    """Таблица лидеров группы по очкам за период из журнала начислений.
+
+    Возвращает список словарей: user, points, messages - по убыванию очков.
+    """
+    rows = list(
+        PointsLedger.objects.filter(group=group, date__gte=start, date__lte=end)
+        .values('user_id')
+        .annotate(points=Sum('awarded'), messages=Count('id'))
+        .order_by('-points', 'user_id')[:limit]
+    )
+    users = User.objects.in_bulk([row['user_id'] for row in rows])
+    return [{'user': users[row['user_id']], 'points': row['points'], 'messages': row['messages']} for row in rows]
+
+
+def period_points(group, user, start, end):
+    """Очки и число засчитанных сообщений участника за период"""
+    totals = PointsLedger.objects.filter(group=group, user=user, date__gte=start, date__lte=end).aggregate(
+        points=Sum('awarded'), messages=Count('id')
+    )
+    return totals['points'] or 0, totals['messages']
@@ -0,0 +1,111 @@
+from collections import Counter
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+
+# Сколько id передавать в одном IN (...)
+ID_CHUNK_SIZE = 1000
+
+DUPLICATES_SQL = """
+    SELECT m.id, m.chat_id, m.user_id, m.related_message
+    FROM friend_bot_message m
+    JOIN (
+        SELECT chat_id, telegram_id, MIN(id) AS keep_id
+        FROM friend_bot_message
+        GROUP BY chat_id, telegram_id
+        HAVING COUNT(*) > 1
+    ) d ON d.chat_id = m.chat_id AND d.telegram_id = m.telegram_id
+    WHERE m.id <> d.keep_id
+"""
+
+
+def chunks(items, size=ID_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def in_clause(ids):
+    return ', '.join(['%s'] * len(ids))
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет повторные строки сообщений (chat, telegram_id) перед добавлением уникального ограничения '
+        'unique_message_in_chat; запускается до migrate, поэтому работает чистым SQL'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, сколько повторов найдено')
+
+    def handle(self, *args, **options):
+        tables = set(connection.introspection.table_names())
+        if 'friend_bot_message' not in tables:
+            self.stdout.write('ℹ️ Таблицы сообщений еще нет - чистить нечего')
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute(DUPLICATES_SQL)
+            duplicates = cursor.fetchall()
+        if not duplicates:
+            self.stdout.write('✅ Повторных сообщений нет')
+            return
+
+        group_ids = sorted({chat_id for _, chat_id, _, _ in duplicates})
+        self.stdout.write(f'⚠️ Повторных сообщений: {len(duplicates)} в группах: {len(group_ids)}')
+        if options['dry_run']:
+            return
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            ids = [message_id for message_id, _, _, _ in duplicates]
+
+            # Очки, начисленные за повторы по журналу, и сами повторы вычитаются из участников
+            awarded = {}
+            if 'friend_bot_pointsledger' in tables:
+                for chunk in chunks(ids):
+                    cursor.execute(
+                        f'SELECT message_id, awarded FROM friend_bot_pointsledger WHERE message_id IN ({in_clause(chunk)})', chunk
+                    )
+                    awarded.update(cursor.fetchall())
+            points = Counter()
+            counts = Counter()
+            for message_id, chat_id, user_id, _ in duplicates:
+                points[(user_id, chat_id)] += awarded.get(message_id, 0)
+                counts[(user_id, chat_id)] += 1
+            cursor.executemany(
+                'UPDATE friend_bot_useringroup SET rating = rating - %s, message_count = message_count - %s '
+                'WHERE user_id = %s AND group_id = %s',
+                [(points[key], counts[key], key[0], key[1]) for key in counts]
+            )
+
+            # Повторный ответ засчитывался в графе общения еще раз
+            if 'friend_bot_interaction' in tables:
+                edges = Counter()
+                for message_id, chat_id, user_id, related_message in duplicates:
+                    if related_message is None:
+                        continue
+                    cursor.execute(
+                        'SELECT user_id FROM friend_bot_message WHERE chat_id = %s AND telegram_id = %s ORDER BY id LIMIT 1',
+                        [chat_id, related_message]
+                    )
+                    row = cursor.fetchone()
+                    if row and row[0] != user_id:
+                        edges[(chat_id, user_id, row[0])] += 1
+                cursor.executemany(
+                    'UPDATE friend_bot_interaction SET reply_count = reply_count - %s '
+                    'WHERE group_id = %s AND from_user_id = %s AND to_user_id = %s',
+                    [(count, *edge) for edge, count in edges.items()]
+                )
+                cursor.execute('DELETE FROM friend_bot_interaction WHERE reply_count <= 0')
+
+            for chunk in chunks(ids):
+                if 'friend_bot_pointsledger' in tables:
+                    cursor.execute(f'DELETE FROM friend_bot_pointsledger WHERE message_id IN ({in_clause(chunk)})', chunk)
+                cursor.execute(f'DELETE FROM friend_bot_message WHERE id IN ({in_clause(chunk)})', chunk)
+
+            cursor.execute(f'SELECT telegram_id FROM friend_bot_telegramgroup WHERE id IN ({in_clause(group_ids)})', group_ids)
+            telegram_ids = [row[0] for row in cursor.fetchall()]
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Удалено повторных сообщений: {len(ids)}'))
+        # Серии, звания и счетчики симулятора пересчитываются по истории уже после migrate
+        for telegram_id in telegram_ids:
+            self.stdout.write(f'  👉 python manage.py rebuild_ratings --group {telegram_id}')
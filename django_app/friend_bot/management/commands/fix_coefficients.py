@@ -1,62 +1,61 @@
 from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
 from friend_bot.models import UserInGroup, DailyCheckin
+from friend_bot.ranks import iter_id_ranges
+from friend_bot.scoring import coefficient_for_streak, effective_streak, moscow_day
+
+
+# Сколько id передавать в один UPDATE ... WHERE id IN (...)
+UPDATE_BATCH_SIZE = 5000
 
 
 class Command(BaseCommand):
     help = 'Исправляет коэффициенты для существующих пользователей'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, help='telegram_id группы (по умолчанию все)')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, сколько коэффициентов изменится')
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Сколько строк обрабатывать за проход')
+
     def handle(self, *args, **options):
         self.stdout.write('Исправляю коэффициенты для существующих пользователей...\n')
-        
-        users = UserInGroup.objects.all()
-        fixed_count = 0
-        
-        for uig in users:
-            try:
-                checkin = DailyCheckin.objects.get(user=uig.user, group=uig.group)
-                
-                # Рассчитываем правильный коэффициент
-                if checkin.consecutive_days == 0:
-                    new_coefficient = 0.5
-                elif checkin.consecutive_days == 1:
-                    new_coefficient = 1.0
-                else:
-                    new_coefficient = 1.0 + (checkin.consecutive_days - 1) * 0.1
-                
-                # Обновляем только если коэффициент изменился
-                if abs(uig.coefficient - new_coefficient) > 0.01:
-                    old_coefficient = uig.coefficient
-                    uig.coefficient = new_coefficient
-                    uig.save()
-                    self.stdout.write(
-                        f'  {uig.user.first_name}: {checkin.consecutive_days} дней '
-                        f'→ коэффициент {old_coefficient:.1f} → {new_coefficient:.1f}'
-                    )
-                    fixed_count += 1
-                else:
-                    self.stdout.write(
-                        f'  {uig.user.first_name}: {checkin.consecutive_days} дней '
-                        f'→ коэффициент {uig.coefficient:.1f} (уже правильный)'
-                    )
-                    
-            except DailyCheckin.DoesNotExist:
-                # Если чекина нет, устанавливаем коэффициент 0.5
-                if abs(uig.coefficient - 0.5) > 0.01:
-                    old_coefficient = uig.coefficient
-                    uig.coefficient = 0.5
-                    uig.save()
-                    self.stdout.write(
-                        f'  {uig.user.first_name}: нет чекина '
-                        f'→ коэффициент {old_coefficient:.1f} → 0.5'
-                    )
-                    fixed_count += 1
-                else:
-                    self.stdout.write(
-                        f'  {uig.user.first_name}: нет чекина '
-                        f'→ коэффициент {uig.coefficient:.1f} (уже правильный)'
-                    )
-        
-        self.stdout.write(
-            self.style.SUCCESS(f'\n✅ Исправлено коэффициентов: {fixed_count}')
+
+        memberships = UserInGroup.objects.all()
+        if options['group']:
+            memberships = memberships.filter(group__telegram_id=options['group'])
+
+        # Серию берем из DailyCheckin подзапросом, а не отдельным запросом на каждую строку
+        checkins = DailyCheckin.objects.filter(user=OuterRef('user_id'), group=OuterRef('group_id'))
+        memberships = memberships.annotate(
+            streak=Subquery(checkins.values('consecutive_days')[:1]),
+            last_day=Subquery(checkins.values('last_checkin_day')[:1]),
         )
 
+        today = moscow_day()
+        id_ranges = list(iter_id_ranges(memberships, options['chunk_size']))
+        fixed_count = 0
+        for done, (start, end) in enumerate(id_ranges, 1):
+            # Различных коэффициентов немного - группируем строки по новому значению
+            changed = {}
+            rows = memberships.filter(id__gte=start, id__lt=end).values_list('id', 'coefficient', 'streak', 'last_day')
+            for membership_id, coefficient, streak, last_day in rows.iterator():
+                if streak is None:
+                    # Нет чекина - серии нет
+                    streak = 0
+                elif last_day is not None:
+                    streak = effective_streak(streak, last_day, today)
+                new_coefficient = coefficient_for_streak(streak)
+                if abs(coefficient - new_coefficient) > 0.01:
+                    changed.setdefault(new_coefficient, []).append(membership_id)
+
+            for new_coefficient, ids in changed.items():
+                if not options['dry_run']:
+                    for offset in range(0, len(ids), UPDATE_BATCH_SIZE):
+                        UserInGroup.objects.filter(id__in=ids[offset:offset + UPDATE_BATCH_SIZE]).update(coefficient=new_coefficient)
+                fixed_count += len(ids)
+            self.stdout.write(f'  … пачка {done}/{len(id_ranges)}, исправлено: {fixed_count}')
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'\n🔎 Пробный запуск: исправилось бы коэффициентов {fixed_count}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'\n✅ Исправлено коэффициентов: {fixed_count}'))
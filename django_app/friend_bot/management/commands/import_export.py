@@ -0,0 +1,117 @@
+import time
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from friend_bot.interactions import rebuild_interactions
+from friend_bot.models import Message, TelegramGroup, User, UserInGroup
+from friend_bot.rebuild import rebuild_group
+from friend_bot.telegram_export import ExportReader, export_chat_id, parse_export_message
+
+
+# Как часто печатать прогресс, сообщений
+PROGRESS_EVERY = 50000
+
+
+class Command(BaseCommand):
+    help = 'Импортирует историю группы из экспорта Telegram Desktop (result.json) и пересчитывает рейтинги'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к result.json')
+        parser.add_argument('--chat-id', type=int, help='telegram_id группы, если он отличается от вычисленного по экспорту')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Сколько сообщений записывать за раз')
+        parser.add_argument('--skip-rebuild', action='store_true', help='Не пересчитывать рейтинги и граф общения после импорта')
+
+    def handle(self, *args, **options):
+        try:
+            stream = open(options['path'], encoding='utf-8')
+        except OSError as e:
+            raise CommandError(f'Не удалось открыть файл: {e}')
+
+        with stream:
+            reader = ExportReader(stream)
+            try:
+                header = reader.read_header()
+                chat_id = options['chat_id'] or export_chat_id(header)
+            except (ValueError, KeyError) as e:
+                raise CommandError(f'Неверный файл экспорта: {e}')
+
+            group, created = TelegramGroup.objects.get_or_create(
+                telegram_id=chat_id,
+                defaults={'title': header.get('name') or f'Group {chat_id}', 'is_active': True}
+            )
+            self.stdout.write(f'📥 Импорт в группу {group.title} ({chat_id}){" - создана" if created else ""}')
+
+            before = Message.objects.filter(chat=group).count()
+            started = time.monotonic()
+            user_ids = {}
+            read = 0
+            next_report = PROGRESS_EVERY
+            try:
+                messages = reader.messages()
+                while True:
+                    chunk = list(islice(messages, options['chunk_size']))
+                    if not chunk:
+                        break
+                    read += len(chunk)
+                    self.import_chunk(group, [parsed for parsed in map(parse_export_message, chunk) if parsed], user_ids)
+                    if read >= next_report:
+                        next_report += PROGRESS_EVERY
+                        elapsed = time.monotonic() - started
+                        self.stdout.write(f'  ... прочитано {read} сообщений ({read / max(elapsed, 0.001):.0f}/с)')
+            except ValueError as e:
+                raise CommandError(f'Ошибка разбора файла после {read} сообщений: {e}')
+
+        added = Message.objects.filter(chat=group).count() - before
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ Импортировано: новых сообщений {added} из {read}, участников {len(user_ids)} '
+            f'за {time.monotonic() - started:.1f}с'
+        ))
+
+        if options['skip_rebuild']:
+            return
+
+        self.stdout.write('🔄 Пересчитываю рейтинги, серии и звания...')
+        stats = rebuild_group(group.id)
+        self.stdout.write(
+            f'  ✓ сообщений {stats["messages"]}, участников {stats["members"]}, изменено {stats["changed"]}, '
+            f'записей журнала {stats["ledger_added"]}'
+        )
+        self.stdout.write('🔄 Пересчитываю граф общения...')
+        self.stdout.write(f'  ✓ ребер {rebuild_interactions(group)}')
+
+    def import_chunk(self, group, parsed_messages, user_ids):
+        """Создает недостающих пользователей и участников и записывает сообщения, пропуская уже загруженные"""
+        new_users = {}
+        for parsed in parsed_messages:
+            if parsed['user_telegram_id'] not in user_ids:
+                new_users[parsed['user_telegram_id']] = parsed['user_name']
+
+        if new_users:
+            # Имена существующих пользователей не трогаем: бот знает их точнее, чем экспорт
+            User.objects.bulk_create([
+                User(
+                    telegram_id=telegram_id,
+                    first_name=name.split(' ', 1)[0],
+                    last_name=name.split(' ', 1)[1] if ' ' in name else '',
+                    is_active=True,
+                )
+                for telegram_id, name in new_users.items()
+            ], ignore_conflicts=True)
+            created_ids = dict(User.objects.filter(telegram_id__in=new_users).values_list('telegram_id', 'id'))
+            UserInGroup.objects.bulk_create([
+                UserInGroup(user_id=user_id, group=group, is_active=True) for user_id in created_ids.values()
+            ], ignore_conflicts=True)
+            user_ids.update(created_ids)
+
+        # Уникальность (chat, telegram_id) отбрасывает сообщения, которые уже есть в базе
+        Message.objects.bulk_create([
+            Message(
+                telegram_id=parsed['telegram_id'],
+                chat=group,
+                user_id=user_ids[parsed['user_telegram_id']],
+                date=parsed['date'],
+                message_type=parsed['message_type'],
+                text=parsed['text'],
+                related_message=parsed['related_message'],
+            )
+            for parsed in parsed_messages
+        ], ignore_conflicts=True)
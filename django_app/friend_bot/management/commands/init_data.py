@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from friend_bot.models import Rank, MessageTypePoints, UserInGroup
+from friend_bot.models import Rank, MessageTypePoints
+from friend_bot.ranks import rerank_memberships
 
 
 class Command(BaseCommand):
@@ -10,44 +11,16 @@ class Command(BaseCommand):
         """Восстанавливает звания для всех пользователей на основе их рейтинга"""
         self.stdout.write('  🔄 Восстанавливаю звания для существующих пользователей...')
         
-        ranks_restored = 0
-        users_processed = 0
-        
-        # Получаем все звания, отсортированные по возрастанию required_rating
-        ranks = list(Rank.objects.all().order_by('required_rating'))
-        
-        if not ranks:
+        if not Rank.objects.exists():
             self.stdout.write('  ❌ Нет званий для восстановления!')
             return
         
-        # Обрабатываем всех пользователей во всех группах
-        user_in_groups = UserInGroup.objects.select_related('user', 'group').all()
+        # Пачками UPDATE по диапазонам рейтинга, без загрузки строк в Python
+        changed = rerank_memberships()
+        ranks_restored = sum(changed.values())
         
-        for user_in_group in user_in_groups:
-            users_processed += 1
-            
-            # Находим самое высокое звание, которое может получить пользователь
-            new_rank = None
-            for rank in ranks:
-                if user_in_group.rating >= rank.required_rating:
-                    new_rank = rank
-                else:
-                    break
-            
-            # Если нашли звание и оно отличается от текущего
-            if new_rank and user_in_group.rank != new_rank:
-                old_rank = user_in_group.rank
-                user_in_group.rank = new_rank
-                user_in_group.save()
-                ranks_restored += 1
-                
-                if old_rank:
-                    self.stdout.write(f'    ✓ {user_in_group.user.first_name} в группе {user_in_group.group.title}: {old_rank.name} → {new_rank.name}')
-                else:
-                    self.stdout.write(f'    ✓ {user_in_group.user.first_name} в группе {user_in_group.group.title}: получил звание {new_rank.name}')
-        
-        self.stdout.write(f'  ✅ Обработано пользователей: {users_processed}, восстановлено званий: {ranks_restored}')
-
+        self.stdout.write(f'  ✅ Восстановлено званий: {ranks_restored}')
+    
     def handle(self, *args, **options):
         self.stdout.write('Начинаю инициализацию базовых данных...')
         
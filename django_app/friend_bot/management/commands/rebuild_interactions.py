@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from friend_bot.interactions import rebuild_interactions
+from friend_bot.models import TelegramGroup
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает граф "кто кому отвечает" по истории сообщений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, help='telegram_id группы (по умолчанию все)')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Сколько ответов читать за один запрос')
+
+    def handle(self, *args, **options):
+        groups = TelegramGroup.objects.all()
+        if options['group']:
+            groups = groups.filter(telegram_id=options['group'])
+
+        total = 0
+        for group in groups:
+            self.stdout.write(f'🔄 Пересчитываю граф общения: {group.title}')
+            edge_count = rebuild_interactions(group, chunk_size=options['chunk_size'], stdout=self.stdout)
+            total += edge_count
+            self.stdout.write(f'  ✓ {group.title}: ребер {edge_count}')
+
+        self.stdout.write(self.style.SUCCESS(f'\n✅ Готово, всего ребер: {total}'))
@@ -0,0 +1,77 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management.base import BaseCommand
+from django.db import connections
+from friend_bot.models import TelegramGroup
+from friend_bot.rebuild import SOURCE_HISTORY, SOURCE_LEDGER, rebuild_group
+
+
+def rebuild_group_in_worker(group_id, dry_run, source):
+    """Точка входа для процесса пула: у каждого процесса свое соединение с БД"""
+    try:
+        return rebuild_group(group_id, dry_run=dry_run, source=source)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает рейтинги, серии, коэффициенты и звания по истории сообщений и журналу начислений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, help='telegram_id группы (по умолчанию все)')
+        parser.add_argument('--workers', type=int, default=1, help='Сколько групп пересчитывать параллельно (процессы)')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, что изменится')
+        parser.add_argument(
+            '--source', choices=[SOURCE_LEDGER, SOURCE_HISTORY], default=SOURCE_LEDGER,
+            help='Очки из журнала начислений (ledger) или заново по текущим баллам за типы (history)'
+        )
+
+    def handle(self, *args, **options):
+        groups = TelegramGroup.objects.order_by('id')
+        if options['group']:
+            groups = groups.filter(telegram_id=options['group'])
+        titles = dict(groups.values_list('id', 'title'))
+        if not titles:
+            self.stdout.write('ℹ️ Нет групп для пересчета')
+            return
+
+        self.stdout.write(f'🔄 Пересчитываю рейтинги групп: {len(titles)}, процессов: {options["workers"]}')
+        started = time.monotonic()
+        totals = {'messages': 0, 'members': 0, 'changed': 0, 'ledger_added': 0}
+
+        if options['workers'] > 1:
+            # Открытые соединения нельзя делить с дочерними процессами
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=options['workers'],
+                mp_context=multiprocessing.get_context('fork')
+            ) as pool:
+                futures = [pool.submit(rebuild_group_in_worker, group_id, options['dry_run'], options['source']) for group_id in titles]
+                for future in as_completed(futures):
+                    self.report(future.result(), titles, totals)
+        else:
+            for group_id in titles:
+                self.report(rebuild_group(group_id, dry_run=options['dry_run'], source=options['source']), titles, totals)
+
+        elapsed = time.monotonic() - started
+        prefix = '🔎 Пробный запуск: изменилось бы' if options['dry_run'] else '✅ Готово: изменено'
+        self.stdout.write(self.style.SUCCESS(
+            f'\n{prefix} участников {totals["changed"]} из {totals["members"]}, '
+            f'сообщений обработано {totals["messages"]} за {elapsed:.1f}с'
+        ))
+
+    def report(self, stats, titles, totals):
+        for key in totals:
+            totals[key] += stats[key]
+        line = (
+            f'  ✓ {titles[stats["group_id"]]}: сообщений {stats["messages"]}, '
+            f'участников {stats["members"]}, изменено {stats["changed"]}'
+        )
+        if stats['ledger_added']:
+            line += f', записей журнала {stats["ledger_added"]}'
+        if stats.get('late_messages'):
+            line += f', пришло во время пересчета {stats["late_messages"]}'
+        if stats['missing_members']:
+            line += f', без записи участника {stats["missing_members"]}'
+        self.stdout.write(line)
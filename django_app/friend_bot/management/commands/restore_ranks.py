@@ -1,72 +1,50 @@
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from friend_bot.models import Rank, UserInGroup
+from friend_bot.ranks import rerank_memberships
 
 
 class Command(BaseCommand):
     help = 'Восстанавливает звания для всех пользователей на основе их рейтинга'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, help='telegram_id группы (по умолчанию все)')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, сколько званий изменится')
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Сколько строк обрабатывать за проход')
+
     def handle(self, *args, **options):
         self.stdout.write('🔄 Начинаю восстановление званий для пользователей...')
-        
-        with transaction.atomic():
-            # Получаем все звания, отсортированные по возрастанию required_rating
-            ranks = list(Rank.objects.all().order_by('required_rating'))
-            
-            if not ranks:
-                self.stdout.write(self.style.ERROR('❌ Нет званий в базе данных! Сначала запустите init_data'))
-                return
-            
-            self.stdout.write(f'  📋 Найдено званий: {len(ranks)}')
-            
-            # Обрабатываем всех пользователей во всех группах
-            user_in_groups = UserInGroup.objects.select_related('user', 'group', 'rank').all()
-            
-            if not user_in_groups:
-                self.stdout.write('  ℹ️ Нет пользователей в группах для восстановления званий')
-                return
-            
-            self.stdout.write(f'  👥 Найдено пользователей в группах: {user_in_groups.count()}')
-            
-            ranks_restored = 0
-            users_processed = 0
-            
-            for user_in_group in user_in_groups:
-                users_processed += 1
-                
-                # Находим самое высокое звание, которое может получить пользователь
-                new_rank = None
-                for rank in ranks:
-                    if user_in_group.rating >= rank.required_rating:
-                        new_rank = rank
-                    else:
-                        break
-                
-                # Если нашли звание и оно отличается от текущего
-                if new_rank and user_in_group.rank != new_rank:
-                    old_rank = user_in_group.rank
-                    user_in_group.rank = new_rank
-                    user_in_group.save()
-                    ranks_restored += 1
-                    
-                    if old_rank:
-                        self.stdout.write(f'    ✓ {user_in_group.user.first_name} в группе {user_in_group.group.title}: {old_rank.name} → {new_rank.name} (рейтинг: {user_in_group.rating})')
-                    else:
-                        self.stdout.write(f'    ✓ {user_in_group.user.first_name} в группе {user_in_group.group.title}: получил звание {new_rank.name} (рейтинг: {user_in_group.rating})')
-                else:
-                    # Показываем текущее звание пользователя
-                    current_rank = user_in_group.rank.name if user_in_group.rank else "Нет звания"
-                    self.stdout.write(f'    ℹ️ {user_in_group.user.first_name} в группе {user_in_group.group.title}: {current_rank} (рейтинг: {user_in_group.rating})')
-            
-            self.stdout.write(f'\n📊 Результаты восстановления:')
-            self.stdout.write(f'  👥 Обработано пользователей: {users_processed}')
-            self.stdout.write(f'  🔄 Восстановлено званий: {ranks_restored}')
-            
-            if ranks_restored > 0:
-                self.stdout.write(
-                    self.style.SUCCESS(f'\n✅ Восстановление званий завершено! Восстановлено {ranks_restored} званий.')
-                )
-            else:
-                self.stdout.write(
-                    self.style.WARNING(f'\n⚠️ Все звания уже актуальны! Восстановление не требуется.')
-                )
+
+        if not Rank.objects.exists():
+            self.stdout.write(self.style.ERROR('❌ Нет званий в базе данных! Сначала запустите init_data'))
+            return
+
+        memberships = UserInGroup.objects.all()
+        if options['group']:
+            memberships = memberships.filter(group__telegram_id=options['group'])
+
+        def progress(done, total, changed):
+            self.stdout.write(f'  … пачка {done}/{total}, изменено званий: {changed}')
+
+        changed = rerank_memberships(
+            memberships,
+            chunk_size=options['chunk_size'],
+            dry_run=options['dry_run'],
+            progress=progress
+        )
+
+        self.stdout.write(f'\n📊 Результаты восстановления:')
+        for rank, count in changed.items():
+            if count:
+                self.stdout.write(f'  🏆 {rank.name}: {count}')
+
+        total = sum(changed.values())
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'\n🔎 Пробный запуск: изменилось бы званий {total}'))
+        elif total > 0:
+            self.stdout.write(
+                self.style.SUCCESS(f'\n✅ Восстановление званий завершено! Восстановлено {total} званий.')
+            )
+        else:
+            self.stdout.write(
+                self.style.WARNING(f'\n⚠️ Все звания уже актуальны! Восстановление не требуется.')
+            )
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from friend_bot.models import DailyCheckin, UserInGroup
+from friend_bot.scoring import BASE_COEFFICIENT, expired_before, moscow_day
+
+
+class Command(BaseCommand):
+    help = 'Сбрасывает прерванные серии и коэффициенты во всех группах (запускается после полуночи по Москве)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, что будет сброшено')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Размер пачки при заполнении номеров дней')
+
+    def handle(self, *args, **options):
+        backfilled = self.backfill_checkin_days(options['chunk_size'], options['dry_run'])
+        if backfilled:
+            self.stdout.write(f'🗓 Заполнен номер дня у старых чекинов: {backfilled}')
+
+        today = moscow_day()
+        expired = DailyCheckin.objects.filter(last_checkin_day__lt=expired_before(today))
+        stale_streaks = expired.filter(consecutive_days__gt=0)
+        stale_coefficients = UserInGroup.objects.filter(
+            Exists(expired.filter(user=OuterRef('user_id'), group=OuterRef('group_id')))
+        ).exclude(coefficient=BASE_COEFFICIENT)
+
+        if options['dry_run']:
+            self.stdout.write(
+                f'🔎 Будет сброшено серий: {stale_streaks.count()}, коэффициентов: {stale_coefficients.count()}'
+            )
+            return
+
+        # По одному UPDATE на таблицу для всех групп сразу
+        with transaction.atomic():
+            coefficients = stale_coefficients.update(coefficient=BASE_COEFFICIENT)
+            streaks = stale_streaks.update(consecutive_days=0)
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Сброшено серий: {streaks}, коэффициентов: {coefficients}'))
+
+    def backfill_checkin_days(self, chunk_size, dry_run):
+        """Проставляет last_checkin_day записям, созданным до появления этого поля"""
+        missing = DailyCheckin.objects.filter(last_checkin_day__isnull=True)
+        if dry_run:
+            return missing.count()
+
+        total = 0
+        while True:
+            chunk = list(missing.only('id', 'last_checkin')[:chunk_size])
+            if not chunk:
+                return total
+            for checkin in chunk:
+                checkin.last_checkin_day = checkin.get_last_day()
+            DailyCheckin.objects.bulk_update(chunk, ['last_checkin_day'])
+            total += len(chunk)
@@ -0,0 +1,92 @@
+import time
+import traceback
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections
+from django.utils import timezone
+from friend_bot.models import ScheduledTaskRun
+
+
+def get_daily_tasks():
+    """Ежедневные задачи: (название, час по Москве, день недели или None, команда, аргументы)"""
+    tasks = [
+        # Сразу после полуночи по Москве сбрасываем серии тех, кто пропустил вчерашний день
+        ('streak_rollover', 0, None, 'rollover_streaks', []),
+        ('daily_summaries', settings.DAILY_SUMMARY_HOUR, None, 'summarize_daily', []),
+    ]
+    if settings.WEEKLY_DIGEST_WEEKDAY is not None:
+        tasks.append(
+            ('weekly_digest', settings.DAILY_SUMMARY_HOUR + 1, settings.WEEKLY_DIGEST_WEEKDAY,
+             'send_digest', ['--period', 'week', '--post'])
+        )
+    if settings.ANALYTICS_SNAPSHOT_HOUR is not None:
+        tasks.append(('analytics_snapshot', settings.ANALYTICS_SNAPSHOT_HOUR, None, 'snapshot_analytics', []))
+    return tasks
+
+
+def get_periodic_tasks():
+    """Задачи, которые запускаются на каждой проверке расписания: (название, команда, аргументы)"""
+    tasks = [
+        # Очередь уведомлений о званиях после пересчета порогов в админке
+        ('rank_notifications', 'send_rank_notifications', []),
+    ]
+    if settings.SUMMARY_JOB_BACKEND == 'thread':
+        # Задачи резюме, брошенные перезапущенным веб-процессом (при 'worker' это делает run_summary_worker)
+        tasks.append(('summary_jobs', 'sweep_summary_jobs', []))
+    return tasks
+
+
+class Command(BaseCommand):
+    help = 'Простой планировщик: раз в сутки в нерабочее время запускает фоновые команды, а очереди разбирает на каждой проверке'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=60, help='Пауза между проверками расписания, секунд')
+
+    def handle(self, *args, **options):
+        tasks = get_daily_tasks()
+        periodic_tasks = get_periodic_tasks()
+        self.stdout.write('⏰ Планировщик запущен:')
+        for name, hour, weekday, command, command_args in tasks:
+            when = f'день недели {weekday}, ' if weekday is not None else ''
+            self.stdout.write(f'  - {name}: {when}{hour}:00 -> {command} {" ".join(command_args)}')
+        for name, command, command_args in periodic_tasks:
+            self.stdout.write(f'  - {name}: каждые {options["interval"]} с -> {command} {" ".join(command_args)}')
+
+        while True:
+            self.run_daily_tasks(tasks)
+
+            for name, command, command_args in periodic_tasks:
+                close_old_connections()
+                try:
+                    call_command(command, *command_args)
+                except Exception:
+                    traceback.print_exc()
+
+            time.sleep(options['interval'])
+
+    def run_daily_tasks(self, tasks):
+        """Запускает ежедневные задачи, которые сегодня еще не выполнялись; отметки хранятся в БД"""
+        now = timezone.localtime()
+        close_old_connections()
+        try:
+            last_run = dict(ScheduledTaskRun.objects.values_list('name', 'last_run'))
+        except DatabaseError:
+            # БД еще не готова (например, идут миграции) - попробуем на следующей проверке
+            traceback.print_exc()
+            return
+
+        for name, hour, weekday, command, command_args in tasks:
+            if now.hour < hour or last_run.get(name) == now.date():
+                continue
+            if weekday is not None and now.weekday() != weekday:
+                continue
+
+            self.stdout.write(f'▶️ {now:%d.%m.%Y %H:%M} запускаю {name}')
+            close_old_connections()
+            try:
+                # Отметка ставится до запуска: упавшая задача не перезапускается в тот же день, как и раньше
+                ScheduledTaskRun.objects.update_or_create(name=name, defaults={'last_run': now.date()})
+                call_command(command, *command_args)
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,37 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from friend_bot.jobs import run_summary_job, fail_stale_jobs, get_executor
+from friend_bot.models import SummaryJob
+
+
+class Command(BaseCommand):
+    help = 'Выполняет фоновые задачи резюме из очереди (для SUMMARY_JOB_BACKEND=worker)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Обработать текущую очередь и выйти')
+        parser.add_argument('--interval', type=float, default=2.0, help='Пауза между проверками очереди, секунд')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'🔄 Воркер резюме запущен (потоков: {settings.SUMMARY_JOB_WORKERS})')
+        executor = get_executor()
+
+        while True:
+            stale = fail_stale_jobs(settings.SUMMARY_JOB_TIMEOUT_MINUTES)
+            if stale:
+                self.stdout.write(self.style.WARNING(f'  ⚠️ Помечено зависших задач: {stale}'))
+
+            job_ids = list(
+                SummaryJob.objects.filter(status='queued').order_by('created_at').values_list('id', flat=True)
+            )
+            # Задачу забирает тот, кто первым переведет ее в работу (claim_job)
+            futures = [executor.submit(run_summary_job, job_id) for job_id in job_ids]
+            for future in futures:
+                future.result()
+
+            if job_ids:
+                self.stdout.write(f'  ✓ Обработано задач: {len(job_ids)}')
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
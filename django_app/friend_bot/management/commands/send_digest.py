@@ -0,0 +1,61 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from friend_bot.api_views import SendMessageView
+from friend_bot.models import DigestPost, TelegramGroup
+from friend_bot.summary import day_bounds, get_or_create_summary, get_summary_stats
+
+
+PERIOD_DAYS = {
+    'week': 7,
+    'month': 30,
+}
+
+
+class Command(BaseCommand):
+    help = 'Собирает дайджест за неделю или месяц из готовых резюме дней и при необходимости отправляет в группу'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', choices=sorted(PERIOD_DAYS), default='week', help='Период дайджеста')
+        parser.add_argument('--group', type=int, help='telegram_id группы (по умолчанию все активные)')
+        parser.add_argument('--post', action='store_true', help='Отправить дайджест в группу')
+
+    def handle(self, *args, **options):
+        # Полные сутки до вчерашнего дня включительно - все они должны быть в DailySummary
+        last_day = timezone.localdate() - timedelta(days=1)
+        first_day = last_day - timedelta(days=PERIOD_DAYS[options['period']] - 1)
+        start_datetime = day_bounds(first_day)[0]
+        end_datetime = day_bounds(last_day)[1]
+
+        groups = TelegramGroup.objects.filter(is_active=True)
+        if options['group']:
+            groups = groups.filter(telegram_id=options['group'])
+
+        self.stdout.write(f'📰 Дайджест за {first_day:%d.%m.%Y} - {last_day:%d.%m.%Y}')
+
+        for group in groups:
+            if options['post'] and DigestPost.objects.filter(group=group, period=options['period'], start_day=first_day).exists():
+                self.stdout.write(f'  - {group.title}: дайджест за этот период уже отправлен')
+                continue
+
+            stats = get_summary_stats(group, start_datetime, end_datetime)
+            if not stats['message_count']:
+                self.stdout.write(f'  - {group.title}: нет сообщений за период')
+                continue
+
+            saved_summary, result = get_or_create_summary(group, start_datetime, end_datetime, stats=stats)
+            if saved_summary is None:
+                self.stdout.write(self.style.ERROR(f'  ❌ {group.title}: {result["summary"]}'))
+                continue
+
+            self.stdout.write(f'  ✓ {group.title}: резюме #{saved_summary.id}')
+
+            if options['post']:
+                # Отправляем тем же путем, что и кнопка в админке
+                if SendMessageView()._send_telegram_message(group.telegram_id, saved_summary.summary):
+                    DigestPost.objects.get_or_create(
+                        group=group, period=options['period'], start_day=first_day, defaults={'summary': saved_summary}
+                    )
+                    self.stdout.write(f'    📤 Отправлено в группу')
+                else:
+                    self.stdout.write(self.style.ERROR(f'    ❌ Не удалось отправить в группу'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from friend_bot.api_views import IngestMessageView
+from friend_bot.models import RankNotification
+
+
+# После стольких неудачных попыток уведомление больше не отправляется
+MAX_ATTEMPTS = 5
+
+
+class Command(BaseCommand):
+    help = 'Отправляет накопленные уведомления о смене званий (после пересчета званий в админке)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=200, help='Сколько уведомлений отправить за запуск')
+
+    def handle(self, *args, **options):
+        pending = RankNotification.objects.filter(sent_at__isnull=True, attempts__lt=MAX_ATTEMPTS).select_related(
+            'group', 'user', 'old_rank', 'new_rank'
+        ).order_by('id')[:options['limit']]
+
+        sent = failed = 0
+        # Отправляем тем же путем, что и уведомления при начислении очков
+        sender = IngestMessageView()
+        for notification in pending:
+            if sender._send_rank_notification(notification.group, notification.user, notification.old_rank, notification.new_rank):
+                notification.sent_at = timezone.now()
+                sent += 1
+            else:
+                failed += 1
+            notification.attempts += 1
+            notification.save(update_fields=['sent_at', 'attempts'])
+
+        if sent or failed:
+            self.stdout.write(f'🏆 Уведомления о званиях: отправлено {sent}, ошибок {failed}')
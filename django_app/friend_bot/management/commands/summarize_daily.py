@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from friend_bot.models import TelegramGroup
+from friend_bot.summary import summarize_day
+
+
+class Command(BaseCommand):
+    help = 'Создает резюме за сутки для активных групп (по умолчанию - за вчера по Москве)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='День в формате ГГГГ-ММ-ДД (по умолчанию вчера)')
+        parser.add_argument('--days', type=int, default=1, help='Сколько дней подряд, заканчивая --date, резюмировать')
+        parser.add_argument('--group', type=int, help='telegram_id группы (по умолчанию все активные)')
+        parser.add_argument('--force', action='store_true', help='Пересоздать уже сохраненные резюме')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                last_day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Неверный формат даты, нужен ГГГГ-ММ-ДД')
+        else:
+            last_day = timezone.localdate() - timedelta(days=1)
+
+        groups = TelegramGroup.objects.filter(is_active=True)
+        if options['group']:
+            groups = groups.filter(telegram_id=options['group'])
+
+        days = [last_day - timedelta(days=offset) for offset in reversed(range(options['days']))]
+        self.stdout.write(f'📅 Резюмирую дни: {days[0]:%d.%m.%Y} - {days[-1]:%d.%m.%Y}')
+
+        created = 0
+        for group in groups:
+            for day in days:
+                daily_summary = summarize_day(group, day, force=options['force'])
+                if daily_summary:
+                    created += 1
+                    self.stdout.write(f'  ✓ {group.title} за {day:%d.%m.%Y}: {daily_summary.message_count} сообщений')
+                else:
+                    self.stdout.write(f'  - {group.title} за {day:%d.%m.%Y}: нет сообщений или ошибка модели')
+
+        self.stdout.write(self.style.SUCCESS(f'\n✅ Готово резюме за дни: {created}'))
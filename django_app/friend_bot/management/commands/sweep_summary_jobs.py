@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from friend_bot.jobs import fail_stale_jobs, requeue_orphaned_jobs
+
+
+class Command(BaseCommand):
+    help = 'Помечает ошибкой зависшие задачи резюме и выполняет брошенные в очереди (для SUMMARY_JOB_BACKEND=thread)'
+
+    def handle(self, *args, **options):
+        stale = fail_stale_jobs(settings.SUMMARY_JOB_TIMEOUT_MINUTES)
+        if stale:
+            self.stdout.write(self.style.WARNING(f'  ⚠️ Помечено зависших задач: {stale}'))
+        requeued = requeue_orphaned_jobs(settings.SUMMARY_JOB_QUEUE_TIMEOUT_MINUTES)
+        if requeued:
+            self.stdout.write(f'  🔁 Подхвачено задач из очереди: {requeued}')
@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
 from friend_bot.models import User, TelegramGroup, UserInGroup, DailyCheckin, Message, MessageTypePoints
+from friend_bot.scoring import moscow_day
 
 
 class Command(BaseCommand):
@@ -67,7 +68,8 @@ class Command(BaseCommand):
             group=group,
             defaults={
                 'consecutive_days': 0,
-                'last_checkin': yesterday
+                'last_checkin': yesterday,
+                'last_checkin_day': moscow_day(yesterday)
             }
         )
         
@@ -75,6 +77,7 @@ class Command(BaseCommand):
             self.stdout.write(f'✓ Создан чекин на вчера: {checkin.last_checkin}')
         else:
             checkin.last_checkin = yesterday
+            checkin.last_checkin_day = moscow_day(yesterday)
             checkin.save()
             self.stdout.write(f'- Обновлен чекин на вчера: {checkin.last_checkin}')
         
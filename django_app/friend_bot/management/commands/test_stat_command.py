@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
 from friend_bot.models import User, TelegramGroup, UserInGroup, DailyCheckin, Message
+from friend_bot.scoring import moscow_day
 
 
 class Command(BaseCommand):
@@ -76,13 +77,15 @@ class Command(BaseCommand):
                 group=group,
                 defaults={
                     'consecutive_days': user_data['consecutive_days'],
-                    'last_checkin': checkin_date
+                    'last_checkin': checkin_date,
+                    'last_checkin_day': moscow_day(checkin_date)
                 }
             )
             
             if not created:
                 checkin.consecutive_days = user_data['consecutive_days']
                 checkin.last_checkin = checkin_date
+                checkin.last_checkin_day = moscow_day(checkin_date)
                 checkin.save()
             
             # Обновляем коэффициент
@@ -0,0 +1,32 @@
+from .models import DailyCheckin, UserInGroup
+
+
+def member_snapshot(user_in_group, checkin=None):
+    """Состояние участника, по которому бот ведет свою копию таблицы лидеров"""
+    return {
+        'user_telegram_id': user_in_group.user.telegram_id,
+        'username': user_in_group.user.username,
+        'first_name': user_in_group.user.first_name,
+        'rating': user_in_group.rating,
+        'rank': user_in_group.rank.name if user_in_group.rank else None,
+        'message_count': user_in_group.message_count,
+        # Серия как есть и день последнего чекина: бот сам поймет, не прервалась ли она
+        'streak': checkin.consecutive_days if checkin else 0,
+        'streak_day': checkin.get_last_day() if checkin else None,
+        'last_activity': user_in_group.last_activity.isoformat() if user_in_group.last_activity else None,
+        'is_active': user_in_group.is_active,
+    }
+
+
+def group_snapshots(groups):
+    """Активные участники групп: {telegram_id группы: [состояния участников]}"""
+    checkins = {
+        (checkin.user_id, checkin.group_id): checkin
+        for checkin in DailyCheckin.objects.filter(group__in=groups)
+    }
+    result = {group.telegram_id: [] for group in groups}
+    members = UserInGroup.objects.filter(group__in=groups, is_active=True).select_related('user', 'rank', 'group')
+    for user_in_group in members.iterator(chunk_size=2000):
+        checkin = checkins.get((user_in_group.user_id, user_in_group.group_id))
+        result[user_in_group.group.telegram_id].append(member_snapshot(user_in_group, checkin))
+    return result
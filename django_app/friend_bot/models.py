@@ -1,5 +1,8 @@
 from django.db import models
 from django.utils import timezone
+from .scoring import (
+    DEFAULT_POINTS, advance_streak, coefficient_for_streak, effective_streak, message_points, moscow_day, rank_for_rating,
+)
 from datetime import timedelta
 
 
@@ -67,6 +70,10 @@ class UserInGroup(models.Model):
     
     class Meta:
         unique_together = ['user', 'group']
+        indexes = [
+            # Пересчет званий затрагивает только участников в диапазоне рейтинга между старым и новым порогом
+            models.Index(fields=['rating']),
+        ]
         verbose_name = "Пользователь в группе"
         verbose_name_plural = "Пользователи в группах"
         ordering = ['-rating']
@@ -74,25 +81,23 @@ class UserInGroup(models.Model):
     def __str__(self):
         return f"{self.user} в группе {self.group} (рейтинг: {self.rating})"
     
+    def get_streak(self):
+        """Серия, с которой сейчас начисляются очки: прерванная серия считается нулевой"""
+        checkin = DailyCheckin.objects.filter(user=self.user, group=self.group).first()
+        if checkin is None:
+            return 0
+        return effective_streak(checkin.consecutive_days, checkin.get_last_day(), moscow_day())
+    
     def get_coefficient(self):
-        """Вычисляет коэффициент непрерывности из DailyCheckin"""
-        try:
-            checkin = DailyCheckin.objects.get(user=self.user, group=self.group)
-            if checkin.consecutive_days == 0:
-                return 0.5
-            elif checkin.consecutive_days == 1:
-                return 1.0
-            else:
-                # Прогрессия: 2 дня = 1.1, 3 дня = 1.2, 4 дня = 1.3, и т.д.
-                return 1.0 + (checkin.consecutive_days - 1) * 0.1
-        except DailyCheckin.DoesNotExist:
-            return 0.5
+        """Вычисляет коэффициент непрерывности из DailyCheckin; прерванная серия дает 0.5"""
+        return coefficient_for_streak(self.get_streak())
     
     def add_message_points(self, message_type):
         """Добавляет очки за сообщение с учетом коэффициента"""
         base_points = self.get_base_points(message_type)
-        coefficient = self.get_coefficient()
-        points = int(base_points * coefficient)  # Округляем в меньшую сторону
+        streak = self.get_streak()
+        coefficient = coefficient_for_streak(streak)
+        points = message_points(base_points, coefficient)
         
         old_rating = self.rating
         self.rating += points
@@ -108,6 +113,9 @@ class UserInGroup(models.Model):
         rank_changed = old_rank != self.rank
         return {
             'points': points,
+            'base_points': base_points,
+            'coefficient': coefficient,
+            'streak': streak,
             'old_rating': old_rating,
             'new_rating': self.rating,
             'rank_changed': rank_changed,
@@ -116,28 +124,22 @@ class UserInGroup(models.Model):
         }
     
     def get_base_points(self, message_type):
-        """Возвращает базовые очки за тип сообщения из БД (или 5 по умолчанию)"""
+        """Возвращает базовые очки за тип сообщения из БД (или DEFAULT_POINTS по умолчанию)"""
         record = MessageTypePoints.objects.filter(message_type=message_type).values_list('points', flat=True).first()
-        return int(record) if record is not None else 5
+        return int(record) if record is not None else DEFAULT_POINTS
     
     def update_rank(self):
         """Обновляет звание пользователя на основе рейтинга"""
         try:
-            # Получаем все звания, отсортированные по возрастанию required_rating
-            ranks = Rank.objects.all().order_by('required_rating')
-            
-            # Находим самое высокое звание, которое может получить пользователь
-            new_rank = None
-            for rank in ranks:
-                if self.rating >= rank.required_rating:
-                    new_rank = rank
-                else:
-                    break
+            # Самое высокое звание, порог которого не выше рейтинга (правило общее с ботом)
+            ladder = list(Rank.objects.order_by('required_rating', 'id').values_list('required_rating', 'id'))
+            new_rank_id = rank_for_rating(ladder, self.rating)
             
             # Если нашли новое звание и оно отличается от текущего
-            if new_rank and self.rank != new_rank:
+            if new_rank_id and self.rank_id != new_rank_id:
                 old_rank = self.rank
-                self.rank = new_rank
+                self.rank = Rank.objects.get(id=new_rank_id)
+                new_rank = self.rank
                 self.save()
                 
                 # Логируем изменение звания
@@ -177,6 +179,12 @@ class Message(models.Model):
         indexes = [
             models.Index(fields=['chat', 'date']),
             models.Index(fields=['user', 'date']),
+            # Для поиска ответов на сообщение (ветки обсуждений)
+            models.Index(fields=['chat', 'related_message']),
+        ]
+        constraints = [
+            # Одно сообщение Telegram - одна строка: на этом держатся идемпотентный прием и импорт с ON CONFLICT
+            models.UniqueConstraint(fields=['chat', 'telegram_id'], name='unique_message_in_chat'),
         ]
     
     def __str__(self):
@@ -207,6 +215,8 @@ class DailyCheckin(models.Model):
     group = models.ForeignKey(TelegramGroup, on_delete=models.CASCADE, verbose_name="Группа")
     consecutive_days = models.IntegerField(default=0, verbose_name="Дней непрерывных чекинов")
     last_checkin = models.DateTimeField(verbose_name="Дата последнего чекина")
+    # Номер дня по Москве (date.toordinal), чтобы сравнивать дни без работы с часовыми поясами
+    last_checkin_day = models.IntegerField(null=True, blank=True, db_index=True, verbose_name="День последнего чекина")
     
     class Meta:
         unique_together = ['user', 'group']
@@ -216,36 +226,230 @@ class DailyCheckin(models.Model):
     def __str__(self):
         return f"{self.user} в {self.group}: {self.consecutive_days} дней подряд"
     
+    def get_last_day(self):
+        """Московский номер дня последнего чекина (для старых записей - из last_checkin)"""
+        if self.last_checkin_day is not None:
+            return self.last_checkin_day
+        return moscow_day(self.last_checkin) if self.last_checkin else None
+
     def update_checkin(self):
-        """Обновляет чекин и считает непрерывные дни"""
-        now = timezone.now()
-        today = now.date()
-        
-        if self.last_checkin:
-            last_date = self.last_checkin.date()
-            days_diff = (today - last_date).days
-            
-            if days_diff == 1:
-                # Следующий день - увеличиваем счетчик
-                self.consecutive_days += 1
-            elif days_diff > 1:
-                # Прошло больше дня - сбрасываем счетчик
-                self.consecutive_days = 0
-            # Если days_diff == 0, то уже чекинились сегодня
-        
-        self.last_checkin = now
+        """Обновляет чекин и считает непрерывные дни; возвращает True, если наступил новый день"""
+        today = moscow_day()
+        last_day = self.get_last_day()
+        if last_day == today:
+            # Уже чекинились сегодня - достаточно сравнить два числа
+            return False
+
+        self.consecutive_days = advance_streak(self.consecutive_days, last_day, today)
+        self.last_checkin = timezone.now()
+        self.last_checkin_day = today
         self.save()
-        
-        # Обновляем коэффициент в UserInGroup (используем новую логику)
-        try:
-            user_in_group = UserInGroup.objects.get(user=self.user, group=self.group)
-            if self.consecutive_days == 0:
-                user_in_group.coefficient = 0.5
-            elif self.consecutive_days == 1:
-                user_in_group.coefficient = 1.0
-            else:
-                # Прогрессия: 2 дня = 1.1, 3 дня = 1.2, 4 дня = 1.3, и т.д.
-                user_in_group.coefficient = 1.0 + (self.consecutive_days - 1) * 0.1
-            user_in_group.save()
-        except UserInGroup.DoesNotExist:
-            pass
+
+        # Обновляем коэффициент в UserInGroup
+        UserInGroup.objects.filter(user=self.user, group=self.group).update(
+            coefficient=coefficient_for_streak(self.consecutive_days)
+        )
+        return True
+
+
+class Interaction(models.Model):
+    """Сколько раз один участник группы отвечал другому (ребро графа общения)"""
+    id = models.AutoField(primary_key=True)
+    group = models.ForeignKey(TelegramGroup, on_delete=models.CASCADE, verbose_name="Группа")
+    from_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='interactions_from', verbose_name="Кто отвечал")
+    to_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='interactions_to', verbose_name="Кому отвечал")
+    reply_count = models.IntegerField(default=0, verbose_name="Количество ответов")
+    last_at = models.DateTimeField(verbose_name="Последний ответ")
+
+    class Meta:
+        # Уникальный индекс (group, from_user, to_user) покрывает и исходящие ребра пользователя
+        unique_together = ['group', 'from_user', 'to_user']
+        indexes = [
+            models.Index(fields=['group', 'to_user']),
+        ]
+        verbose_name = "Взаимодействие"
+        verbose_name_plural = "Взаимодействия"
+        ordering = ['-reply_count']
+
+    def __str__(self):
+        return f"{self.from_user} → {self.to_user} в {self.group}: {self.reply_count}"
+
+
+class PointsLedger(models.Model):
+    """Журнал начислений: одна строка на каждое засчитанное сообщение, только добавляется"""
+    id = models.AutoField(primary_key=True)
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='ledger_entry', verbose_name="Сообщение")
+    group = models.ForeignKey(TelegramGroup, on_delete=models.CASCADE, verbose_name="Группа")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь")
+    base_points = models.IntegerField(verbose_name="Базовые очки")
+    coefficient = models.FloatField(verbose_name="Коэффициент непрерывности")
+    awarded = models.IntegerField(verbose_name="Начислено")
+    # Дата сообщения: по ней считаются очки за период
+    date = models.DateTimeField(verbose_name="Дата")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'date']),
+            models.Index(fields=['group', 'user', 'date']),
+        ]
+        verbose_name = "Начисление очков"
+        verbose_name_plural = "Журнал начислений"
+        ordering = ['-date']
+
+    def __str__(self):
+        return f"{self.user} в {self.group}: +{self.awarded} ({self.base_points} × {self.coefficient})"
+
+
+class ScoreHistogram(models.Model):
+    """Сколько сообщений каждого типа пользователь написал при каждой длине серии.
+
+    По этим счетчикам рейтинг при других баллах за типы пересчитывается без чтения сообщений.
+    """
+    id = models.AutoField(primary_key=True)
+    group = models.ForeignKey(TelegramGroup, on_delete=models.CASCADE, verbose_name="Группа")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь")
+    message_type = models.CharField(max_length=20, choices=Message.MESSAGE_TYPES, verbose_name="Тип сообщения")
+    streak = models.IntegerField(verbose_name="Серия при начислении")
+    count = models.IntegerField(default=0, verbose_name="Количество сообщений")
+
+    class Meta:
+        unique_together = ['group', 'user', 'message_type', 'streak']
+        verbose_name = "Счетчик сообщений для симуляции"
+        verbose_name_plural = "Счетчики сообщений для симуляции"
+
+    def __str__(self):
+        return f"{self.user} в {self.group}: {self.message_type} при серии {self.streak} - {self.count}"
+
+
+class RankNotification(models.Model):
+    """Очередь уведомлений о смене звания: отправляются командой send_rank_notifications"""
+    id = models.AutoField(primary_key=True)
+    group = models.ForeignKey(TelegramGroup, on_delete=models.CASCADE, verbose_name="Группа")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь")
+    old_rank = models.ForeignKey(Rank, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', verbose_name="Прежнее звание")
+    new_rank = models.ForeignKey(Rank, on_delete=models.CASCADE, related_name='+', verbose_name="Новое звание")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата отправки")
+    attempts = models.IntegerField(default=0, verbose_name="Попыток отправки")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sent_at', 'id']),
+        ]
+        verbose_name = "Уведомление о звании"
+        verbose_name_plural = "Уведомления о званиях"
+        ordering = ['id']
+
+    def __str__(self):
+        return f"{self.user} в {self.group}: {self.old_rank} → {self.new_rank}"
+
+
+class ChatSummary(models.Model):
+    """Сохраненное резюме чата за период"""
+    id = models.AutoField(primary_key=True)
+    group = models.ForeignKey(TelegramGroup, on_delete=models.CASCADE, verbose_name="Группа")
+    start_datetime = models.DateTimeField(verbose_name="Начало периода")
+    end_datetime = models.DateTimeField(verbose_name="Конец периода")
+    prompt_hash = models.CharField(max_length=64, verbose_name="Хеш промпта")
+    model_name = models.CharField(max_length=100, verbose_name="Модель")
+    fingerprint = models.CharField(max_length=64, verbose_name="Отпечаток набора сообщений")
+    summary = models.TextField(verbose_name="Текст резюме")
+    custom_prompt = models.TextField(blank=True, verbose_name="Кастомный промпт")
+    message_count = models.IntegerField(default=0, verbose_name="Количество сообщений")
+    input_tokens = models.IntegerField(default=0, verbose_name="Токенов сообщений до сжатия")
+    prompt_tokens = models.IntegerField(default=0, verbose_name="Токенов сообщений после сжатия")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        unique_together = ['group', 'start_datetime', 'end_datetime', 'prompt_hash', 'model_name', 'fingerprint']
+        verbose_name = "Резюме чата"
+        verbose_name_plural = "Резюме чатов"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Резюме {self.group} за {self.start_datetime:%d.%m.%Y %H:%M} - {self.end_datetime:%d.%m.%Y %H:%M}"
+
+
+class DailySummary(models.Model):
+    """Резюме группы за сутки (по московскому времени), считается заранее ночью"""
+    id = models.AutoField(primary_key=True)
+    group = models.ForeignKey(TelegramGroup, on_delete=models.CASCADE, verbose_name="Группа")
+    day = models.DateField(verbose_name="День")
+    summary = models.TextField(verbose_name="Текст резюме")
+    message_count = models.IntegerField(default=0, verbose_name="Количество сообщений")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        unique_together = ['group', 'day']
+        verbose_name = "Резюме за день"
+        verbose_name_plural = "Резюме за дни"
+        ordering = ['-day']
+
+    def __str__(self):
+        return f"Резюме {self.group} за {self.day:%d.%m.%Y}"
+
+
+class SummaryJob(models.Model):
+    """Фоновая задача генерации резюме"""
+    STATUSES = [
+        ('queued', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('done', 'Готово'),
+        ('failed', 'Ошибка'),
+    ]
+
+    id = models.AutoField(primary_key=True)
+    group = models.ForeignKey(TelegramGroup, on_delete=models.CASCADE, verbose_name="Группа")
+    start_datetime = models.DateTimeField(verbose_name="Начало периода")
+    end_datetime = models.DateTimeField(verbose_name="Конец периода")
+    custom_prompt = models.TextField(blank=True, verbose_name="Кастомный промпт")
+    force_regenerate = models.BooleanField(default=False, verbose_name="Сгенерировать заново")
+    status = models.CharField(max_length=20, choices=STATUSES, default='queued', db_index=True, verbose_name="Статус")
+    stage = models.CharField(max_length=20, blank=True, verbose_name="Этап")
+    partial_output = models.TextField(blank=True, verbose_name="Промежуточный результат")
+    timings = models.JSONField(default=dict, blank=True, verbose_name="Время этапов")
+    summary = models.ForeignKey(ChatSummary, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Резюме")
+    error = models.TextField(blank=True, verbose_name="Ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Начало выполнения")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Окончание выполнения")
+
+    class Meta:
+        verbose_name = "Задача резюме"
+        verbose_name_plural = "Задачи резюме"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Задача #{self.id} для {self.group}: {self.get_status_display()}"
+
+
+class DigestPost(models.Model):
+    """Отметка об отправленном в группу дайджесте: один период публикуется один раз"""
+    id = models.AutoField(primary_key=True)
+    group = models.ForeignKey(TelegramGroup, on_delete=models.CASCADE, verbose_name="Группа")
+    period = models.CharField(max_length=20, verbose_name="Период")
+    start_day = models.DateField(verbose_name="Первый день периода")
+    summary = models.ForeignKey(ChatSummary, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Резюме")
+    posted_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата отправки")
+
+    class Meta:
+        unique_together = ['group', 'period', 'start_day']
+        verbose_name = "Отправленный дайджест"
+        verbose_name_plural = "Отправленные дайджесты"
+        ordering = ['-start_day']
+
+    def __str__(self):
+        return f"Дайджест {self.group} ({self.period}) с {self.start_day:%d.%m.%Y}"
+
+
+class ScheduledTaskRun(models.Model):
+    """Последний запуск ежедневной задачи планировщика: переживает перезапуск контейнера"""
+    name = models.CharField(max_length=50, primary_key=True, verbose_name="Задача")
+    last_run = models.DateField(verbose_name="Последний запуск")
+
+    class Meta:
+        verbose_name = "Запуск задачи планировщика"
+        verbose_name_plural = "Запуски задач планировщика"
+
+    def __str__(self):
+        return f"{self.name}: {self.last_run:%d.%m.%Y}"
@@ -0,0 +1,118 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Max, Min, Value, When
+from .models import Rank, RankNotification, UserInGroup
+from .scoring import rank_for_rating
+
+
+def iter_id_ranges(queryset, chunk_size):
+    """Делит queryset на диапазоны id [start, end) примерно по chunk_size строк"""
+    bounds = queryset.aggregate(first_id=Min('id'), last_id=Max('id'))
+    if bounds['first_id'] is None:
+        return
+    for start in range(bounds['first_id'], bounds['last_id'] + 1, chunk_size):
+        yield start, start + chunk_size
+
+
+def rank_bands(ranks=None):
+    """Диапазоны рейтинга для званий: список (звание, от включительно, до не включительно или None)"""
+    if ranks is None:
+        ranks = list(Rank.objects.order_by('required_rating', 'id'))
+    bands = []
+    for index, rank in enumerate(ranks):
+        upper = ranks[index + 1].required_rating if index + 1 < len(ranks) else None
+        bands.append((rank, rank.required_rating, upper))
+    return bands
+
+
+def rerank_memberships(queryset=None, chunk_size=50000, dry_run=False, progress=None):
+    """Проставляет звания по рейтингу пачками UPDATE: по одному на звание в каждом диапазоне id.
+
+    Меняются только строки с неверным званием; пользователи ниже самого младшего звания
+    не трогаются (как и в UserInGroup.update_rank). При dry_run только считает изменения.
+    progress(обработано_пачек, всего_пачек, изменено) вызывается после каждой пачки.
+    Возвращает словарь {звание: количество измененных строк}.
+    """
+    if queryset is None:
+        queryset = UserInGroup.objects.all()
+    bands = rank_bands()
+    changed = {rank: 0 for rank, _, _ in bands}
+    if not bands:
+        return changed
+
+    id_ranges = list(iter_id_ranges(queryset, chunk_size))
+    for done, (start, end) in enumerate(id_ranges, 1):
+        chunk = queryset.filter(id__gte=start, id__lt=end)
+        for rank, lower, upper in bands:
+            wrong = chunk.filter(rating__gte=lower).exclude(rank=rank)
+            if upper is not None:
+                wrong = wrong.filter(rating__lt=upper)
+            changed[rank] += wrong.count() if dry_run else wrong.update(rank=rank)
+        if progress:
+            progress(done, len(id_ranges), sum(changed.values()))
+    return changed
+
+
+def rank_ladder():
+    """Текущая лестница званий: список (required_rating, id) в порядке rank_bands"""
+    return list(Rank.objects.order_by('required_rating', 'id').values_list('required_rating', 'id'))
+
+
+def changed_rating_range(old_ladder, new_ladder):
+    """Диапазон рейтинга (от включительно, до не включительно или None), где звание по двум лестницам различается.
+
+    Звание постоянно между соседними порогами обеих лестниц, поэтому достаточно сравнить
+    его на каждом пороге. Возвращает None, если лестницы дают одинаковые звания.
+    """
+    thresholds = sorted({required for required, _ in old_ladder} | {required for required, _ in new_ladder})
+    changed = [
+        index for index, required in enumerate(thresholds)
+        if rank_for_rating(old_ladder, required) != rank_for_rating(new_ladder, required)
+    ]
+    if not changed:
+        return None
+    upper = thresholds[changed[-1] + 1] if changed[-1] + 1 < len(thresholds) else None
+    return thresholds[changed[0]], upper
+
+
+def rerank_after_ladder_change(old_ladder):
+    """Пересчитывает звания после изменения званий одним UPDATE только в затронутом диапазоне рейтинга.
+
+    Участники ниже самого младшего звания не трогаются (как в UserInGroup.update_rank).
+    Смены званий активных участников ставятся в очередь RankNotification.
+    Возвращает None, если звания не изменились, иначе словарь lower, upper, changed, queued.
+    """
+    new_ladder = rank_ladder()
+    rating_range = changed_rating_range(old_ladder, new_ladder)
+    if rating_range is None:
+        return None
+    lower, upper = rating_range
+
+    affected = UserInGroup.objects.filter(rating__gte=lower)
+    if upper is not None:
+        affected = affected.filter(rating__lt=upper)
+
+    # Пороги внутри диапазона по убыванию: первый подходящий When дает старшее звание
+    whens = [
+        When(rating__gte=required, then=Value(rank_id))
+        for required, rank_id in reversed(new_ladder)
+        if upper is None or required < upper
+    ]
+
+    with transaction.atomic():
+        memberships = list(affected.select_for_update().values_list('group_id', 'user_id', 'rank_id', 'rating', 'is_active'))
+        affected.update(rank=Case(*whens, default=F('rank'), output_field=IntegerField()))
+
+        notifications = []
+        changed = 0
+        for group_id, user_id, old_rank_id, rating, is_active in memberships:
+            new_rank_id = rank_for_rating(new_ladder, rating)
+            if new_rank_id is None or new_rank_id == old_rank_id:
+                continue
+            changed += 1
+            if is_active:
+                notifications.append(RankNotification(
+                    group_id=group_id, user_id=user_id, old_rank_id=old_rank_id, new_rank_id=new_rank_id
+                ))
+        RankNotification.objects.bulk_create(notifications, batch_size=1000)
+
+    return {'lower': lower, 'upper': upper, 'changed': changed, 'queued': len(notifications)}
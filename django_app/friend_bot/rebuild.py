@@ -0,0 +1,299 @@
+from datetime import datetime, time as dt_time
+from itertools import islice
+import numpy as np
+from django.db import transaction
+from django.db.models.functions import TruncDate
+from .models import DailyCheckin, Message, MessageTypePoints, PointsLedger, Rank, ScoreHistogram, UserInGroup
+from .scoring import DEFAULT_POINTS, MOSCOW_TZ, day_to_date, expired_before, moscow_day
+from .simulator import coefficients_for_streaks
+
+
+# Сколько строк забирать из курсора за раз
+FETCH_CHUNK_SIZE = 20000
+
+# Источники очков при пересчете: журнал начислений или заново по текущим баллам за типы
+SOURCE_LEDGER = 'ledger'
+SOURCE_HISTORY = 'history'
+
+
+def day_start(day):
+    """Начало московского дня по его номеру"""
+    return MOSCOW_TZ.localize(datetime.combine(day_to_date(day), dt_time.min))
+
+
+def load_group_history(group_id, message_ids=None, type_index=None):
+    """Читает сообщения группы в порядке поступления серверным курсором.
+
+    Возвращает массивы по одному элементу на сообщение: id сообщения, user_id, московский номер
+    дня, индекс типа и очки из журнала начислений (NaN - записи нет), плюс список названий
+    типов для индексов. message_ids ограничивает выборку, type_index - общий словарь индексов
+    типов, если история дочитывается частями.
+    """
+    messages = Message.objects.filter(chat_id=group_id)
+    if message_ids is not None:
+        messages = messages.filter(id__in=message_ids)
+    rows = messages.order_by('date', 'id').values_list(
+        'id', 'user_id', 'message_type', TruncDate('date', tzinfo=MOSCOW_TZ), 'ledger_entry__awarded'
+    ).iterator(chunk_size=FETCH_CHUNK_SIZE)
+
+    if type_index is None:
+        type_index = {}
+    ids, users, days, types, awarded = [], [], [], [], []
+    while True:
+        chunk = list(islice(rows, FETCH_CHUNK_SIZE))
+        if not chunk:
+            break
+        ids.append(np.fromiter((row[0] for row in chunk), dtype=np.int64, count=len(chunk)))
+        users.append(np.fromiter((row[1] for row in chunk), dtype=np.int64, count=len(chunk)))
+        types.append(np.fromiter(
+            (type_index.setdefault(row[2], len(type_index)) for row in chunk), dtype=np.int16, count=len(chunk)
+        ))
+        days.append(np.fromiter((row[3].toordinal() for row in chunk), dtype=np.int64, count=len(chunk)))
+        awarded.append(np.fromiter(
+            (np.nan if row[4] is None else row[4] for row in chunk), dtype=np.float64, count=len(chunk)
+        ))
+
+    if not users:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, np.empty(0, dtype=np.int16), np.empty(0, dtype=np.float64), list(type_index)
+    return (
+        np.concatenate(ids), np.concatenate(users), np.concatenate(days), np.concatenate(types),
+        np.concatenate(awarded), list(type_index)
+    )
+
+
+def load_new_messages(group_id, history):
+    """Дочитывает к истории сообщения, записанные после ее чтения.
+
+    Вызывается под блокировкой участников группы, когда новых сообщений уже не появится.
+    Сравниваются множества id, а не только id больше последнего: транзакция с меньшим id
+    может зафиксироваться позже. Новые сообщения встают в конец своего дня.
+    """
+    ids, users, days, types, awarded, type_names = history
+    all_ids = np.fromiter(
+        Message.objects.filter(chat_id=group_id).values_list('id', flat=True).iterator(chunk_size=FETCH_CHUNK_SIZE),
+        dtype=np.int64
+    )
+    new_ids = all_ids[~np.isin(all_ids, ids)]
+    if not len(new_ids):
+        return history, 0
+
+    type_index = {name: index for index, name in enumerate(type_names)}
+    new = load_group_history(group_id, message_ids=new_ids.tolist(), type_index=type_index)
+    merged = [np.concatenate([old, added]) for old, added in zip(history[:5], new[:5])]
+    order = np.argsort(merged[2], kind='stable')
+    return tuple(column[order] for column in merged) + (new[5],), len(new_ids)
+
+
+def replay_scores(users, days, types, points_table, awarded=None):
+    """Повторяет начисление очков по истории так же, как IngestMessageView, но сразу для всех участников.
+
+    users, days, types - массивы по сообщениям в порядке поступления, points_table - базовые
+    очки по индексу типа, awarded - уже начисленные очки по сообщениям (NaN - пересчитать).
+    Возвращает словарь массивов по участникам: user_id, rating, message_count, streak
+    (серия после последнего сообщения), last_day; счетчики histogram (user_id, тип, серия
+    при начислении, количество) для симулятора и по сообщениям в порядке order: users,
+    base_points, coefficients, points.
+    """
+    # Стабильная сортировка по пользователю сохраняет порядок сообщений внутри пользователя
+    order = np.argsort(users, kind='stable')
+    users = users[order]
+    days = days[order]
+    types = types[order]
+    base_points = points_table[types]
+    count = len(users)
+
+    new_user = np.ones(count, dtype=bool)
+    new_user[1:] = users[1:] != users[:-1]
+    new_day = new_user.copy()
+    new_day[1:] |= days[1:] != days[:-1]
+
+    # Серия после каждого отдельного дня активности: сколько дней подряд до него без пропуска
+    day_positions = np.flatnonzero(new_day)
+    active_days = days[day_positions]
+    first_day_of_user = new_user[day_positions]
+    gaps = np.zeros(len(active_days), dtype=np.int64)
+    gaps[1:] = active_days[1:] - active_days[:-1]
+    breaks = first_day_of_user | (gaps > 1)
+    day_numbers = np.arange(len(active_days))
+    run_starts = np.maximum.accumulate(np.where(breaks, day_numbers, 0))
+    day_streaks = day_numbers - run_starts
+
+    # Первое сообщение дня считается с серией предыдущего дня (если вчера была активность),
+    # остальные сообщения дня - с уже обновленной серией
+    previous_streaks = np.zeros(len(active_days), dtype=np.int64)
+    previous_streaks[1:] = day_streaks[:-1]
+    opening_streaks = np.where(breaks, 0, previous_streaks)
+
+    day_index = np.cumsum(new_day) - 1
+    message_streaks = np.where(new_day, opening_streaks[day_index], day_streaks[day_index])
+    coefficients = coefficients_for_streaks(message_streaks)
+    points = np.trunc(base_points * coefficients).astype(np.int64)
+    if awarded is not None:
+        awarded = awarded[order]
+        points = np.where(np.isnan(awarded), points, awarded).astype(np.int64)
+
+    user_starts = np.flatnonzero(new_user)
+    user_ends = np.r_[user_starts[1:], count] - 1
+    buckets, bucket_counts = np.unique(np.stack([users, types, message_streaks], axis=1), axis=0, return_counts=True)
+    return {
+        'histogram': (buckets[:, 0], buckets[:, 1], buckets[:, 2], bucket_counts),
+        'user_id': users[user_starts],
+        'rating': np.add.reduceat(points, user_starts) if count else points,
+        'message_count': user_ends - user_starts + 1,
+        'streak': day_streaks[day_index[user_ends]],
+        'last_day': days[user_ends],
+        'order': order,
+        'users': users,
+        'base_points': base_points,
+        'coefficients': coefficients,
+        'points': points,
+    }
+
+
+def assign_ranks(ratings, ranks):
+    """Звание для каждого рейтинга: самое старшее с required_rating не выше рейтинга или None"""
+    if not ranks:
+        return [None] * len(ratings)
+    thresholds = np.array([rank.required_rating for rank in ranks], dtype=np.int64)
+    positions = np.searchsorted(thresholds, ratings, side='right') - 1
+    return [ranks[position] if position >= 0 else None for position in positions]
+
+
+def plan_group(group_id, history, memberships, checkins, today, source):
+    """Считает новые значения участников группы по истории; ничего не пишет в БД"""
+    ids, users, days, types, ledger_points, type_names = history
+    stats = {
+        'group_id': group_id, 'messages': len(users), 'members': 0, 'changed': 0, 'missing_members': 0, 'ledger_added': 0,
+    }
+    points_by_type = dict(MessageTypePoints.objects.values_list('message_type', 'points'))
+    points_table = np.array([points_by_type.get(name, DEFAULT_POINTS) for name in type_names], dtype=np.float64)
+    result = replay_scores(users, days, types, points_table, awarded=ledger_points if source == SOURCE_LEDGER else None)
+
+    # Ночной сброс: у тех, кто пропустил вчерашний день, серия уже прервана
+    expired = result['last_day'] < expired_before(today)
+    streaks = np.where(expired, 0, result['streak'])
+    coefficients = coefficients_for_streaks(streaks)
+    ranks = assign_ranks(result['rating'], list(Rank.objects.order_by('required_rating', 'id')))
+
+    changed_memberships = []
+    changed_checkins = []
+    new_checkins = []
+    for index, user_id in enumerate(result['user_id'].tolist()):
+        membership = memberships.get(user_id)
+        if membership is None:
+            stats['missing_members'] += 1
+            continue
+        stats['members'] += 1
+
+        values = {
+            'rating': int(result['rating'][index]),
+            'message_count': int(result['message_count'][index]),
+            'coefficient': float(coefficients[index]),
+            'rank_id': ranks[index].id if ranks[index] else None,
+        }
+        if any(getattr(membership, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(membership, field, value)
+            changed_memberships.append(membership)
+
+        last_day = int(result['last_day'][index])
+        streak = int(streaks[index])
+        checkin = checkins.get(user_id)
+        if checkin is None:
+            new_checkins.append(DailyCheckin(
+                user_id=user_id,
+                group_id=group_id,
+                consecutive_days=streak,
+                last_checkin=day_start(last_day),
+                last_checkin_day=last_day,
+            ))
+        elif checkin.consecutive_days != streak or checkin.last_checkin_day != last_day:
+            checkin.consecutive_days = streak
+            if checkin.get_last_day() != last_day:
+                checkin.last_checkin = day_start(last_day)
+            checkin.last_checkin_day = last_day
+            changed_checkins.append(checkin)
+
+    # Сообщения без записи в журнале (история до его появления) дописываются пересчитанными очками
+    missing = np.isnan(ledger_points)[result['order']]
+    stats['changed'] = len(changed_memberships)
+    stats['changed_checkins'] = len(changed_checkins) + len(new_checkins)
+    stats['ledger_added'] = int(missing.sum())
+    return stats, {
+        'result': result,
+        'missing': missing,
+        'ids': ids,
+        'type_names': type_names,
+        'changed_memberships': changed_memberships,
+        'changed_checkins': changed_checkins,
+        'new_checkins': new_checkins,
+    }
+
+
+def rebuild_group(group_id, dry_run=False, today=None, source=SOURCE_LEDGER):
+    """Пересчитывает рейтинг, серии, коэффициенты и звания участников группы по истории сообщений.
+
+    source=SOURCE_LEDGER берет очки из журнала начислений и пересчитывает только сообщения
+    без записи в нем, SOURCE_HISTORY пересчитывает все по текущим баллам за типы.
+    Участники без сообщений не трогаются. Результат, включая счетчики ScoreHistogram
+    для симулятора и недостающие записи журнала, записывается одной транзакцией.
+
+    Историю долго читаем без блокировок, а перед записью блокируем строки участников группы
+    (прием сообщения блокирует свою строку до вставки сообщения) и дочитываем сообщения,
+    пришедшие за это время: их очки не теряются. Значения пишутся на месте через bulk_update.
+    Возвращает словарь со статистикой: сообщений, участников и измененных строк.
+    """
+    if today is None:
+        today = moscow_day()
+
+    history = load_group_history(group_id)
+    if dry_run or not len(history[0]):
+        memberships = {membership.user_id: membership for membership in UserInGroup.objects.filter(group_id=group_id)}
+        checkins = {checkin.user_id: checkin for checkin in DailyCheckin.objects.filter(group_id=group_id)}
+        stats, _ = plan_group(group_id, history, memberships, checkins, today, source)
+        return stats
+
+    with transaction.atomic():
+        memberships = {
+            membership.user_id: membership
+            for membership in UserInGroup.objects.select_for_update().filter(group_id=group_id)
+        }
+        history, late_messages = load_new_messages(group_id, history)
+        checkins = {checkin.user_id: checkin for checkin in DailyCheckin.objects.filter(group_id=group_id)}
+        stats, plan = plan_group(group_id, history, memberships, checkins, today, source)
+        stats['late_messages'] = late_messages
+        result = plan['result']
+        missing = plan['missing']
+        type_names = plan['type_names']
+
+        ledger_entries = []
+        if stats['ledger_added']:
+            missing_ids = plan['ids'][result['order']][missing]
+            dates = dict(Message.objects.filter(chat_id=group_id, ledger_entry__isnull=True).values_list('id', 'date').iterator(
+                chunk_size=FETCH_CHUNK_SIZE
+            ))
+            for message_id, user_id, base_points, coefficient, points in zip(
+                missing_ids.tolist(), result['users'][missing].tolist(), result['base_points'][missing].tolist(),
+                result['coefficients'][missing].tolist(), result['points'][missing].tolist()
+            ):
+                ledger_entries.append(PointsLedger(
+                    message_id=message_id, group_id=group_id, user_id=user_id, base_points=int(base_points),
+                    coefficient=coefficient, awarded=points, date=dates[message_id],
+                ))
+
+        UserInGroup.objects.bulk_update(
+            plan['changed_memberships'], ['rating', 'message_count', 'coefficient', 'rank'], batch_size=1000
+        )
+        DailyCheckin.objects.bulk_update(
+            plan['changed_checkins'], ['consecutive_days', 'last_checkin', 'last_checkin_day'], batch_size=1000
+        )
+        DailyCheckin.objects.bulk_create(plan['new_checkins'], batch_size=1000)
+        # Счетчики для симулятора полностью заменяем пересчитанными
+        ScoreHistogram.objects.filter(group_id=group_id).delete()
+        ScoreHistogram.objects.bulk_create([
+            ScoreHistogram(group_id=group_id, user_id=user_id, message_type=type_names[type_id], streak=streak, count=count)
+            for user_id, type_id, streak, count in zip(*(column.tolist() for column in result['histogram']))
+        ], batch_size=5000)
+        PointsLedger.objects.bulk_create(ledger_entries, batch_size=5000, ignore_conflicts=True)
+    return stats
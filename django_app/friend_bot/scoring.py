@@ -0,0 +1,80 @@
+"""Правила серий (непрерывных дней), коэффициента, очков и званий.
+
+Модуль не зависит от Django: его же использует бот, который во встроенном режиме
+начисляет очки сам, без Django.
+"""
+from bisect import bisect_right
+from datetime import date, datetime
+import pytz
+
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+# Коэффициент при нулевой серии и прибавка за каждый день серии после первого
+BASE_COEFFICIENT = 0.5
+STREAK_STEP = 0.1
+
+# Базовые очки за тип сообщения, которого нет в MessageTypePoints
+DEFAULT_POINTS = 5
+
+
+def moscow_day(moment=None):
+    """Номер московского дня (date.toordinal) для момента времени; naive время считается UTC"""
+    if moment is None:
+        moment = datetime.now(pytz.utc)
+    elif moment.tzinfo is None:
+        moment = pytz.utc.localize(moment)
+    return moment.astimezone(MOSCOW_TZ).date().toordinal()
+
+
+def day_to_date(day):
+    """Переводит номер дня обратно в дату"""
+    return date.fromordinal(day)
+
+
+def advance_streak(consecutive_days, last_day, today):
+    """Новое значение серии после активности в день today.
+
+    Первый чекин серию не начинает, следующий день продлевает ее, пропуск дня сбрасывает.
+    """
+    if last_day is None:
+        return 0
+    diff = today - last_day
+    if diff == 1:
+        return consecutive_days + 1
+    if diff > 1:
+        return 0
+    # Тот же день (или часы сбились назад) - серия не меняется
+    return consecutive_days
+
+
+def effective_streak(consecutive_days, last_day, today):
+    """Серия на сегодня: если вчера активности не было, она уже прервана, даже если еще не сброшена"""
+    if last_day is None or today - last_day > 1:
+        return 0
+    return consecutive_days
+
+
+def coefficient_for_streak(consecutive_days):
+    """Коэффициент рейтинга: 0 дней = 0.5, 1 день = 1.0, 2 дня = 1.1, 3 дня = 1.2 и т.д."""
+    if consecutive_days <= 0:
+        return BASE_COEFFICIENT
+    if consecutive_days == 1:
+        return 1.0
+    return 1.0 + (consecutive_days - 1) * STREAK_STEP
+
+
+def expired_before(today):
+    """Серии с последним чекином раньше этого дня считаются прерванными"""
+    return today - 1
+
+
+def message_points(base_points, coefficient):
+    """Очки за сообщение: базовые очки с коэффициентом, округленные вниз"""
+    return int(base_points * coefficient)
+
+
+def rank_for_rating(ladder, rating):
+    """id звания для рейтинга по лестнице (required_rating, id) или None, если рейтинг ниже всех порогов"""
+    position = bisect_right([required for required, _ in ladder], rating) - 1
+    return ladder[position][1] if position >= 0 else None
@@ -103,6 +103,37 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # OpenAI API
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+# Резюме чата
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'gpt-4o-mini')
+# Бюджет токенов на сообщения в одном запросе к модели (размер окна)
+SUMMARY_PROMPT_TOKEN_BUDGET = int(os.getenv('SUMMARY_PROMPT_TOKEN_BUDGET', '1500'))
+# Максимум окон на период: из длинных периодов отбираются самые интересные сообщения
+SUMMARY_MAX_WINDOWS = int(os.getenv('SUMMARY_MAX_WINDOWS', '8'))
+# Сколько токенов сообщений длинного периода отбирается по вовлеченности (ответы, длина, всплески)
+SUMMARY_SELECTION_TOKEN_BUDGET = int(os.getenv('SUMMARY_SELECTION_TOKEN_BUDGET', '12000'))
+# Количество окон, которые конспектируются параллельно
+SUMMARY_MAX_WORKERS = int(os.getenv('SUMMARY_MAX_WORKERS', '4'))
+SUMMARY_MAP_MAX_TOKENS = int(os.getenv('SUMMARY_MAP_MAX_TOKENS', '500'))
+# Общий лимит одновременных запросов к модели в одном процессе
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+
+# Фоновые задачи резюме: 'thread' - пул потоков в веб-процессе, 'worker' - команда run_summary_worker
+SUMMARY_JOB_BACKEND = os.getenv('SUMMARY_JOB_BACKEND', 'thread')
+SUMMARY_JOB_WORKERS = int(os.getenv('SUMMARY_JOB_WORKERS', '2'))
+SUMMARY_JOB_TIMEOUT_MINUTES = int(os.getenv('SUMMARY_JOB_TIMEOUT_MINUTES', '30'))
+# Через сколько минут задачу из очереди веб-процесса подхватывает планировщик (для backend 'thread')
+SUMMARY_JOB_QUEUE_TIMEOUT_MINUTES = int(os.getenv('SUMMARY_JOB_QUEUE_TIMEOUT_MINUTES', '5'))
+
+# Планировщик (run_scheduler): час по Москве для ночных резюме дней
+DAILY_SUMMARY_HOUR = int(os.getenv('DAILY_SUMMARY_HOUR', '4'))
+# День недели (0 - понедельник) для автоматической отправки недельного дайджеста в группы; пусто - не отправлять
+WEEKLY_DIGEST_WEEKDAY = int(os.getenv('WEEKLY_DIGEST_WEEKDAY')) if os.getenv('WEEKLY_DIGEST_WEEKDAY') else None
+
+# Каталог Parquet-снимка для офлайн-аналитики (snapshot_analytics, запросы - analytics.py)
+ANALYTICS_SNAPSHOT_DIR = os.getenv('ANALYTICS_SNAPSHOT_DIR', str(BASE_DIR / 'analytics'))
+# Час по Москве для ежедневного снимка в планировщике; пусто - не снимать
+ANALYTICS_SNAPSHOT_HOUR = int(os.getenv('ANALYTICS_SNAPSHOT_HOUR')) if os.getenv('ANALYTICS_SNAPSHOT_HOUR') else None
+
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [],
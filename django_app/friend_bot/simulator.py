@@ -0,0 +1,137 @@
+import numpy as np
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import MessageTypePoints, Rank, ScoreHistogram, UserInGroup
+from .scoring import BASE_COEFFICIENT, DEFAULT_POINTS, STREAK_STEP
+
+
+def coefficients_for_streaks(streaks):
+    """Векторная версия scoring.coefficient_for_streak"""
+    return np.where(
+        streaks <= 0,
+        BASE_COEFFICIENT,
+        np.where(streaks == 1, 1.0, 1.0 + (streaks - 1) * STREAK_STEP)
+    )
+
+
+def record_score(group, user, message_type, streak):
+    """Учитывает начисленное сообщение в счетчиках симулятора.
+
+    Обычно это один UPDATE; строка создается только для новой комбинации, а если ее
+    успел создать параллельный запрос - снова инкремент.
+    """
+    bucket = ScoreHistogram.objects.filter(group=group, user=user, message_type=message_type, streak=streak)
+    if bucket.update(count=F('count') + 1):
+        return
+    try:
+        with transaction.atomic():
+            ScoreHistogram.objects.create(group=group, user=user, message_type=message_type, streak=streak, count=1)
+    except IntegrityError:
+        bucket.update(count=F('count') + 1)
+
+
+def current_points_table():
+    """Текущие баллы за типы сообщений"""
+    return dict(MessageTypePoints.objects.values_list('message_type', 'points'))
+
+
+def current_rank_ladder():
+    """Текущая лестница званий: список (required_rating, name) по возрастанию"""
+    return list(Rank.objects.order_by('required_rating', 'id').values_list('required_rating', 'name'))
+
+
+def parse_proposal(points=None, ranks=None):
+    """Проверяет предложенные баллы и звания; не переданное берется из текущих настроек.
+
+    points - {тип: баллы}, ranks - [{'name': ..., 'required_rating': ...}].
+    Возвращает (points_table, rank_ladder), при ошибке бросает ValueError.
+    """
+    points_table = current_points_table()
+    if points:
+        if not isinstance(points, dict):
+            raise ValueError('points должен быть объектом {тип: баллы}')
+        for message_type, value in points.items():
+            try:
+                points_table[message_type] = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'Неверные баллы для типа {message_type}: {value!r}')
+
+    if not ranks:
+        return points_table, current_rank_ladder()
+    if not isinstance(ranks, list):
+        raise ValueError('ranks должен быть списком званий')
+    rank_ladder = []
+    for rank in ranks:
+        try:
+            rank_ladder.append((int(rank['required_rating']), str(rank['name'])))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'Неверное звание: {rank!r}')
+    return points_table, rank_ladder
+
+
+def load_histogram(group):
+    """Счетчики группы в виде массивов: user_id, индекс типа, серия, количество и список типов"""
+    rows = list(ScoreHistogram.objects.filter(group=group).values_list('user_id', 'message_type', 'streak', 'count'))
+    type_names = sorted({row[1] for row in rows})
+    type_index = {name: index for index, name in enumerate(type_names)}
+    users = np.array([row[0] for row in rows], dtype=np.int64)
+    types = np.array([type_index[row[1]] for row in rows], dtype=np.int64)
+    streaks = np.array([row[2] for row in rows], dtype=np.int64)
+    counts = np.array([row[3] for row in rows], dtype=np.int64)
+    return users, types, streaks, counts, type_names
+
+
+def simulate_group(group, points_table, rank_ladder, limit=20):
+    """Считает рейтинги и звания группы при предложенных баллах и званиях, ничего не записывая.
+
+    points_table - {тип: баллы} (нет типа - DEFAULT_POINTS), rank_ladder - [(required_rating, name)].
+    Возвращает таблицу лидеров (до limit строк) с текущими и новыми значениями
+    и распределение участников по новым званиям.
+    """
+    users, types, streaks, counts, type_names = load_histogram(group)
+    base_points = np.array([points_table.get(name, DEFAULT_POINTS) for name in type_names], dtype=np.float64)
+
+    # Очки за одно сообщение в каждом счетчике считаются так же, как при начислении: с отбрасыванием дробной части
+    bucket_points = np.trunc(base_points[types] * coefficients_for_streaks(streaks)).astype(np.int64) * counts
+    user_ids, user_index = np.unique(users, return_inverse=True)
+    ratings = np.bincount(user_index, weights=bucket_points, minlength=len(user_ids)).astype(np.int64)
+
+    ladder = sorted(rank_ladder, key=lambda rank: rank[0])
+    thresholds = np.array([required for required, _ in ladder], dtype=np.int64)
+    positions = np.searchsorted(thresholds, ratings, side='right') - 1 if ladder else np.full(len(ratings), -1)
+    simulated = {
+        user_id: (rating, ladder[position][1] if position >= 0 else None)
+        for user_id, rating, position in zip(user_ids.tolist(), ratings.tolist(), positions.tolist())
+    }
+
+    memberships = UserInGroup.objects.filter(group=group, is_active=True).select_related('user', 'rank')
+    rows = []
+    distribution = {name: 0 for _, name in ladder}
+    without_rank = 0
+    for membership in memberships:
+        rating, rank_name = simulated.get(membership.user_id, (0, None))
+        if rank_name is None:
+            without_rank += 1
+        else:
+            distribution[rank_name] += 1
+        rows.append({
+            'user': membership.user,
+            'current_rating': membership.rating,
+            'current_rank': membership.rank.name if membership.rank else None,
+            'rating': rating,
+            'rank': rank_name,
+        })
+
+    rows.sort(key=lambda row: row['rating'], reverse=True)
+    current_order = {row['user'].id: index for index, row in enumerate(sorted(rows, key=lambda row: row['current_rating'], reverse=True), 1)}
+    for position, row in enumerate(rows, 1):
+        row['position'] = position
+        row['current_position'] = current_order[row['user'].id]
+
+    return {
+        'leaderboard': rows[:limit],
+        'rank_distribution': [(name, distribution[name]) for _, name in ladder],
+        'without_rank': without_rank,
+        'member_count': len(rows),
+        'indexed_users': len(user_ids),
+    }
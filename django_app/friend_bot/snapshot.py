@@ -0,0 +1,179 @@
+import json
+import os
+import shutil
+import time
+from django.db.models import Max
+from django.utils import timezone
+from .models import Message, PointsLedger, UserInGroup
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_dataset
+except ImportError:
+    pa = None
+
+
+# Сколько строк читать из базы и писать в один набор файлов за раз
+SNAPSHOT_CHUNK_SIZE = 100000
+
+WATERMARKS_FILE = '_watermarks.json'
+
+# Пауза между фиксацией верхней границы id и выгрузкой, секунд: транзакции, получившие
+# меньшие id, но еще не зафиксированные (прием сообщений, импорт), успевают завершиться
+SNAPSHOT_SAFETY_LAG = 60
+
+# Таблицы, которые дописываются по возрастанию id: (queryset, колонки values_list, имена колонок в Parquet)
+APPEND_TABLES = {
+    'messages': (
+        lambda: Message.objects.all(),
+        ['id', 'telegram_id', 'chat__telegram_id', 'user__telegram_id', 'date', 'message_type', 'related_message'],
+        ['id', 'telegram_id', 'group_id', 'user_id', 'date', 'message_type', 'related_message'],
+    ),
+    'ledger': (
+        lambda: PointsLedger.objects.all(),
+        ['id', 'message_id', 'group__telegram_id', 'user__telegram_id', 'date', 'base_points', 'coefficient', 'awarded'],
+        ['id', 'message_id', 'group_id', 'user_id', 'date', 'base_points', 'coefficient', 'awarded'],
+    ),
+}
+
+MEMBERSHIP_FIELDS = [
+    'group__telegram_id', 'user__telegram_id', 'user__username', 'user__first_name', 'rating', 'message_count',
+    'coefficient', 'rank__name', 'joined_at', 'last_activity', 'is_active',
+]
+MEMBERSHIP_COLUMNS = [
+    'group_id', 'user_id', 'username', 'first_name', 'rating', 'message_count',
+    'coefficient', 'rank', 'joined_at', 'last_activity', 'is_active',
+]
+
+
+def require_pyarrow():
+    """Parquet пишется через pyarrow - необязательную зависимость, нужную только для снимков"""
+    if pa is None:
+        raise RuntimeError('Для снимков аналитики нужен pyarrow: pip install pyarrow')
+
+
+def read_watermarks(snapshot_dir):
+    """Последние выгруженные id по таблицам"""
+    path = os.path.join(snapshot_dir, WATERMARKS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_watermarks(snapshot_dir, watermarks):
+    """Записывает отметки атомарно: прерванный снимок не оставит битый файл"""
+    path = os.path.join(snapshot_dir, WATERMARKS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def check_text_mode(watermarks, with_text):
+    """Колонка text должна быть во всех файлах messages или ни в одном: режим нельзя менять между снимками"""
+    if watermarks.get('messages') and watermarks.get('messages_with_text', False) != with_text:
+        current = 'с текстом' if watermarks.get('messages_with_text') else 'без текста'
+        raise RuntimeError(
+            f'Сообщения в этом снимке уже выгружаются {current}; для другого режима нужен отдельный каталог снимка'
+        )
+    watermarks['messages_with_text'] = with_text
+
+
+def column_type(name):
+    """Тип колонки в Parquet: явные типы, чтобы пачки из одних NULL не меняли схему между файлами"""
+    if name in ('date', 'joined_at', 'last_activity'):
+        return pa.timestamp('us', tz='UTC')
+    if name == 'coefficient':
+        return pa.float64()
+    if name == 'is_active':
+        return pa.bool_()
+    if name in ('message_type', 'text', 'username', 'first_name', 'rank', 'month'):
+        return pa.string()
+    return pa.int64()
+
+
+def rows_to_table(columns, rows):
+    """Таблица pyarrow из строк values_list"""
+    schema = pa.schema([(name, column_type(name)) for name in columns])
+    return pa.table({name: [row[index] for row in rows] for index, name in enumerate(columns)}, schema=schema)
+
+
+def write_partitioned(table, base_dir, partitioning, basename):
+    """Пишет таблицу в Parquet с hive-разбиением (group_id=.../month=...)"""
+    pa_dataset.write_dataset(
+        table, base_dir, format='parquet',
+        partitioning=partitioning, partitioning_flavor='hive',
+        basename_template=basename + '-{i}.parquet',
+        # Повтор прерванного снимка перезаписывает файлы с теми же именами
+        existing_data_behavior='overwrite_or_ignore',
+    )
+
+
+def snapshot_append_table(snapshot_dir, name, watermarks, upper_id, with_text=False, chunk_size=SNAPSHOT_CHUNK_SIZE,
+                          progress=None):
+    """Дописывает в снимок строки таблицы с id больше отметки и не больше upper_id, по chunk_size строк.
+
+    Файлы разбиты по группе и месяцу (по московскому времени). Отметка сохраняется
+    после каждой пачки. Возвращает число выгруженных строк.
+    """
+    queryset, fields, columns = APPEND_TABLES[name]
+    if name == 'messages' and with_text:
+        fields, columns = fields + ['text'], columns + ['text']
+
+    base_dir = os.path.join(snapshot_dir, name)
+    last_id = watermarks.get(name, 0)
+    written = 0
+    while True:
+        rows = list(queryset().filter(id__gt=last_id, id__lte=upper_id).order_by('id').values_list(*fields)[:chunk_size])
+        if not rows:
+            return written
+        date_index = columns.index('date')
+        table = rows_to_table(columns, rows).append_column(
+            'month', pa.array([f'{timezone.localtime(row[date_index]):%Y-%m}' for row in rows])
+        )
+        write_partitioned(table, base_dir, ['group_id', 'month'], f'part-{last_id + 1:012d}')
+
+        last_id = rows[-1][0]
+        written += len(rows)
+        watermarks[name] = last_id
+        write_watermarks(snapshot_dir, watermarks)
+        if progress:
+            progress(name, written)
+
+
+def snapshot_memberships(snapshot_dir):
+    """Участники меняются на месте (рейтинг, звание), поэтому их снимок каждый раз пишется целиком"""
+    rows = list(UserInGroup.objects.order_by('group_id', 'id').values_list(*MEMBERSHIP_FIELDS))
+    base_dir = os.path.join(snapshot_dir, 'memberships')
+    tmp_dir = base_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if rows:
+        write_partitioned(rows_to_table(MEMBERSHIP_COLUMNS, rows), tmp_dir, ['group_id'], 'part')
+    else:
+        os.makedirs(tmp_dir)
+    shutil.rmtree(base_dir, ignore_errors=True)
+    os.rename(tmp_dir, base_dir)
+    return len(rows)
+
+
+def take_snapshot(snapshot_dir, with_text=False, chunk_size=SNAPSHOT_CHUNK_SIZE, progress=None,
+                  safety_lag=SNAPSHOT_SAFETY_LAG):
+    """Инкрементальный снимок: новые сообщения и начисления дописываются, участники перезаписываются.
+
+    Отметка - последний выгруженный id, а id выдаются до фиксации транзакции: строка с меньшим id
+    может появиться позже строки с большим. Поэтому верхняя граница id фиксируется в начале,
+    а строки до нее выгружаются не раньше чем через safety_lag секунд.
+    Возвращает {таблица: выгружено строк}.
+    """
+    require_pyarrow()
+    os.makedirs(snapshot_dir, exist_ok=True)
+    watermarks = read_watermarks(snapshot_dir)
+    check_text_mode(watermarks, with_text)
+    bounds = {name: queryset().aggregate(last_id=Max('id'))['last_id'] or 0 for name, (queryset, _, _) in APPEND_TABLES.items()}
+    started = time.monotonic()
+
+    result = {'memberships': snapshot_memberships(snapshot_dir)}
+    time.sleep(max(0.0, safety_lag - (time.monotonic() - started)))
+    for name in APPEND_TABLES:
+        result[name] = snapshot_append_table(snapshot_dir, name, watermarks, bounds[name], with_text, chunk_size, progress)
+    return result
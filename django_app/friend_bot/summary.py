@@ -0,0 +1,611 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, time as dt_time, timedelta
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.db.models import Count, Min, Max, Sum, Value
+from django.db.models.functions import Coalesce, Concat, Length, MD5
+from django.utils import timezone
+from .models import Message, ChatSummary, DailySummary
+from .compaction import compact_messages, format_media_counts
+from .threads import group_into_conversations
+
+
+# Грубая оценка: в среднем ~3 символа на токен для смеси русского и английского текста
+CHARS_PER_TOKEN = 3
+# Максимальная длина текста одного сообщения в промпте
+MESSAGE_TEXT_LIMIT = 100
+
+# Веса оценки вовлеченности сообщения при отборе в промпт длинного периода
+REPLY_WEIGHT = 3
+REPLIER_WEIGHT = 2
+LENGTH_WEIGHT = 1
+BURST_WEIGHT = 1
+# Всплеск активности: сколько сообщений написано рядом по времени (насыщается на BURST_CAP)
+BURST_WINDOW = timedelta(minutes=5)
+BURST_CAP = 10
+
+MAP_SYSTEM_PROMPT = "Ты помогаешь готовить резюме длинной переписки. Тебе дают отрезок чата, а ты делаешь по нему сжатый фактический конспект без приветствий и оценок, сохраняя ссылки на сообщения."
+
+SYSTEM_PROMPT = "Ты - друг, который следил за чатом и теперь рассказывает другому другу, что тот пропустил. Твой стиль - живая дружеская беседа за пивом, эмоциональная, с шутками и личными комментариями. Используй ТОЛЬКО простые HTML-теги: <b>, <i>, <u>. НЕ используй <pre>, <ul>, <li>, <code>. НЕ НАЧИНАЙ с приветствия, обращайся к участникам во множественном числе (ребятки, братишки, сестренки, друзья). Пиши компактно без лишних отступов. Добавляй <tg-spoiler></tg-spoiler> для интересных фактов. Обязательно используй ссылки на сообщения когда рассказываешь о темах или цитатах в формате специальном телеграммном, ссылки оформляй тегом <a href='https://t.me/c/{chat_id_clean}/{msg.telegram_id}'>ссылка</a>."
+
+
+def estimate_tokens(text):
+    """Оценивает количество токенов в тексте без обращения к токенизатору"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def get_summary_stats(group, start_datetime, end_datetime):
+    """Считает статистику сообщений за период одним агрегирующим запросом"""
+    stats = Message.objects.filter(
+        chat=group,
+        date__gte=start_datetime,
+        date__lte=end_datetime
+    ).aggregate(
+        message_count=Count('id'),
+        participant_count=Count('user', distinct=True),
+        first_date=Min('date'),
+        last_date=Max('date'),
+        last_id=Max('id'),
+        text_chars=Sum(Length('text')),
+        # Хеш типов и текстов по порядку id: правка без изменения длины тоже меняет отпечаток
+        content_hash=MD5(StringAgg(
+            Concat('message_type', Value(':'), Coalesce('text', Value(''))), delimiter='\x1e', ordering='id'
+        )),
+    )
+    stats['text_chars'] = stats['text_chars'] or 0
+    return stats
+
+
+def iter_summary_messages(group, start_datetime, end_datetime, chunk_size=2000, ids=None):
+    """Потоково отдает сообщения за период, загружая только нужные для промпта поля"""
+    queryset = Message.objects.filter(
+        chat=group,
+        date__gte=start_datetime,
+        date__lte=end_datetime
+    )
+    if ids is not None:
+        queryset = queryset.filter(id__in=ids)
+    return queryset.select_related('user').only(
+        'telegram_id', 'date', 'message_type', 'text', 'related_message',
+        'user__username', 'user__first_name',
+    ).order_by('date').iterator(chunk_size=chunk_size)
+
+
+def format_message_link(group, telegram_id):
+    """Возвращает ссылку на сообщение в группе"""
+    # Убираем -100 из chat_id для ссылки
+    chat_id_clean = str(group.telegram_id).replace('-100', '')
+    return f"https://t.me/c/{chat_id_clean}/{telegram_id}"
+
+
+def format_user_label(user):
+    """Имя автора для строки промпта"""
+    return f"@{user.username}" if user.username else f"{user.first_name}"
+
+
+def truncate_text(text):
+    """Обрезает текст сообщения до MESSAGE_TEXT_LIMIT символов"""
+    return text[:MESSAGE_TEXT_LIMIT] + "..." if len(text) > MESSAGE_TEXT_LIMIT else text
+
+
+def format_message_line(group, msg):
+    """Форматирует сообщение в строку промпта со ссылкой на него в Telegram"""
+    message_link = format_message_link(group, msg.telegram_id)
+    return f"[{format_user_label(msg.user)}: {truncate_text(msg.text)}]({message_link})"
+
+
+def format_compacted_line(group, run):
+    """Форматирует сжатую серию сообщений одного автора в строку промпта"""
+    parts = []
+    if run['texts']:
+        parts.append(" / ".join(text if count == 1 else f"{text} (×{count})" for text, count in run['texts']))
+    if run['media']:
+        media = format_media_counts(run['media'])
+        parts.append(f"({media})" if run['texts'] else media)
+    return f"[{', '.join(run['user_labels'])}: {' '.join(parts)}]({format_message_link(group, run['telegram_id'])})"
+
+
+def message_line_overhead(group):
+    """Оценка длины строки промпта без текста сообщения: ссылка и имя автора"""
+    return len(format_message_link(group, 0)) + 20
+
+
+def estimate_period_tokens(group, stats):
+    """Оценивает размер всех сообщений периода в токенах по агрегированной статистике"""
+    # На каждую строку приходится ссылка и имя автора, текст обрезается до MESSAGE_TEXT_LIMIT
+    line_overhead = message_line_overhead(group)
+    text_chars = min(stats['text_chars'], stats['message_count'] * (MESSAGE_TEXT_LIMIT + 3))
+    return (text_chars + stats['message_count'] * line_overhead) // CHARS_PER_TOKEN + 1
+
+
+def score_messages(group, start_datetime, end_datetime):
+    """Оценивает вовлеченность каждого сообщения периода.
+
+    Учитываются ответы на сообщение и число разных ответивших, длина текста и всплеск
+    активности вокруг него. Возвращает список (id, оценка, токены) в хронологическом порядке.
+    """
+    period = Message.objects.filter(chat=group, date__gte=start_datetime, date__lte=end_datetime)
+    replies = {
+        row['related_message']: (row['reply_count'], row['replier_count'])
+        for row in period.filter(related_message__isnull=False).values('related_message').annotate(
+            reply_count=Count('id'),
+            replier_count=Count('user', distinct=True),
+        )
+    }
+
+    rows = list(period.order_by('date').annotate(text_length=Length('text')).values_list(
+        'id', 'telegram_id', 'date', 'text_length'
+    ).iterator(chunk_size=5000))
+
+    line_overhead = message_line_overhead(group)
+    scored = []
+    window_start = window_end = 0
+    for message_id, telegram_id, date, text_length in rows:
+        # Всплеск: сколько сообщений написано в пределах BURST_WINDOW вокруг этого
+        while rows[window_start][2] < date - BURST_WINDOW:
+            window_start += 1
+        while window_end < len(rows) and rows[window_end][2] <= date + BURST_WINDOW:
+            window_end += 1
+        burst = window_end - window_start - 1
+
+        reply_count, replier_count = replies.get(telegram_id, (0, 0))
+        text_length = text_length or 0
+        score = (
+            REPLY_WEIGHT * reply_count
+            + REPLIER_WEIGHT * replier_count
+            + LENGTH_WEIGHT * min(text_length, MESSAGE_TEXT_LIMIT) / MESSAGE_TEXT_LIMIT
+            + BURST_WEIGHT * min(burst, BURST_CAP) / BURST_CAP
+        )
+        if not text_length:
+            # Стикеры, голосовые и прочее без текста модели почти ничего не дают
+            score *= 0.5
+        tokens = (min(text_length, MESSAGE_TEXT_LIMIT + 3) + line_overhead) // CHARS_PER_TOKEN + 1
+        scored.append((message_id, score, tokens))
+
+    return scored
+
+
+def select_messages(group, start_datetime, end_datetime, token_budget):
+    """Отбирает самые интересные сообщения периода, которые вместе укладываются в бюджет токенов.
+
+    Возвращает множество id; хронологический порядок восстанавливается при загрузке.
+    """
+    selected = set()
+    used_tokens = 0
+    for message_id, score, tokens in sorted(score_messages(group, start_datetime, end_datetime), key=lambda item: -item[1]):
+        if used_tokens + tokens > token_budget:
+            continue
+        selected.add(message_id)
+        used_tokens += tokens
+    return selected
+
+
+def build_prompt_windows(group, start_datetime, end_datetime, stats, window_budget=None, max_windows=None):
+    """Разбивает период на окна строк, каждое из которых укладывается в бюджет токенов.
+
+    Перед разбиением сообщения сжимаются (compact_messages): склеиваются серии одного
+    автора, медиа превращаются в счетчики, повторы и одиночные "ок" отбрасываются.
+    Сообщения группируются в беседы по веткам ответов, и окна режутся между беседами,
+    чтобы модель видела обсуждение целиком. Если весь период не помещается в бюджет,
+    в промпт попадают самые вовлекающие сообщения (select_messages), так что размер
+    промпта не зависит от длины истории.
+
+    Возвращает пару (окна, {'input_tokens': ..., 'output_tokens': ...}) - размер
+    сообщений до и после сжатия.
+    """
+    if window_budget is None:
+        window_budget = settings.SUMMARY_PROMPT_TOKEN_BUDGET
+    if max_windows is None:
+        max_windows = settings.SUMMARY_MAX_WINDOWS
+
+    total_budget = min(window_budget * max_windows, settings.SUMMARY_SELECTION_TOKEN_BUDGET)
+    ids = None
+    if estimate_period_tokens(group, stats) > total_budget:
+        ids = select_messages(group, start_datetime, end_datetime, total_budget)
+
+    messages = []
+    input_tokens = 0
+    for msg in iter_summary_messages(group, start_datetime, end_datetime, ids=ids):
+        line_tokens = estimate_tokens(format_message_line(group, msg))
+        if ids is None and input_tokens + line_tokens > total_budget and messages:
+            # Оценка по статистике оказалась заниженной - остальные сообщения не загружаем
+            break
+        input_tokens += line_tokens
+        messages.append({
+            'telegram_id': msg.telegram_id,
+            'related_message': msg.related_message,
+            'user_key': msg.user_id,
+            'user_label': format_user_label(msg.user),
+            'date': msg.date,
+            'message_type': msg.message_type,
+            'text': truncate_text(msg.text),
+        })
+
+    records = []
+    for run in compact_messages(messages):
+        line = format_compacted_line(group, run)
+        records.append((run['telegram_id'], run['related_message'], line, estimate_tokens(line)))
+    output_tokens = sum(record[3] for record in records)
+
+    windows = [[]]
+    used_tokens = 0
+    for conversation in group_into_conversations(group, records):
+        conversation_ids = {record[0] for record in conversation}
+        conversation_tokens = sum(record[3] for record in conversation)
+        # Беседу, которая помещается в окно целиком, не разрываем между окнами
+        if used_tokens + conversation_tokens > window_budget and windows[-1] and conversation_tokens <= window_budget:
+            windows.append([])
+            used_tokens = 0
+        for telegram_id, related_message, line, line_tokens in conversation:
+            if used_tokens + line_tokens > window_budget and windows[-1]:
+                windows.append([])
+                used_tokens = 0
+            if related_message in conversation_ids:
+                line = f"  ↳ {line}"
+            windows[-1].append(line)
+            used_tokens += line_tokens
+
+    return [window for window in windows if window], {'input_tokens': input_tokens, 'output_tokens': output_tokens}
+
+
+def format_period(start_datetime, end_datetime):
+    """Возвращает человекочитаемую длительность периода"""
+    period_duration = end_datetime - start_datetime
+    days = period_duration.days
+    hours = period_duration.seconds // 3600
+
+    if days > 0:
+        return f"{days} {'день' if days == 1 else 'дня' if days < 5 else 'дней'}"
+    elif hours > 0:
+        return f"{hours} {'час' if hours == 1 else 'часа' if hours < 5 else 'часов'}"
+    return "несколько минут"
+
+
+def get_openai_client():
+    """Создает клиент OpenAI с возможностью кастомного base_url"""
+    from openai import OpenAI
+
+    # Настройки для обхода блокировки
+    api_key = os.getenv('OPENAI_API_KEY')
+    base_url = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url
+    )
+
+
+# Общий лимит одновременных запросов к модели в процессе (веб-запросы, фоновые задачи, map-окна)
+_llm_slots = threading.BoundedSemaphore(settings.LLM_MAX_CONCURRENCY)
+
+
+def complete(client, system_prompt, user_prompt, max_tokens, temperature, on_delta=None):
+    """Выполняет один запрос к модели и возвращает текст ответа.
+
+    Если передан on_delta, ответ читается потоково и on_delta вызывается
+    с уже полученным текстом.
+    """
+    with _llm_slots:
+        response = client.chat.completions.create(
+            model=settings.SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=on_delta is not None
+        )
+        if on_delta is None:
+            return response.choices[0].message.content
+
+        parts = []
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                on_delta("".join(parts))
+        return "".join(parts)
+
+
+def build_summary_context(group, start_datetime, end_datetime, stats, custom_prompt=None):
+    """Возвращает основной промпт резюме: кастомный или стандартный"""
+    if custom_prompt:
+        return custom_prompt
+
+    period_text = format_period(start_datetime, end_datetime)
+    return f"""
+    Ты - друг, который следил за чатом в группе "{group.title}" и теперь рассказывает другому другу, что он пропустил за {period_text} (с {start_datetime.strftime('%d.%m %H:%M')} по {end_datetime.strftime('%d.%m %H:%M')}).
+
+    Твой стиль - это дружеская беседа за пивом, живая, эмоциональная, с шутками и личными комментариями.
+
+    Статистика для справки:
+    - Сообщений за период: {stats['message_count']}
+    - Активных участников: {stats['participant_count']}
+
+    Создай живое резюме в HTML-разметке, которое включает:
+    1. Основные темы обсуждений (2-3 главные темы с эмоциями)
+    2. Самые активные участники (с личными комментариями)
+    3. Интересные моменты или цитаты (если есть)
+    4. Эмоциональное завершение
+
+    Правила стиля:
+    - НЕ НАЧИНАЙ с приветствия - сразу переходи к делу
+    - Обращайся к участникам во множественном числе: "ребятки", "братишки", "сестренки", "ребятушки", "друзья", "товарищи"
+    - Пиши как друг рассказывает другу: "блин, здарова", "так, ребятки", "ну это никуда не годится"
+    - Используй разговорную речь, междометия, эмоции
+    - Комментируй активность: "обсусситесь", "запасайтесь попкорном", "плачущий ребенок и никаких сплетен??"
+    - Используй только базовые HTML-теги: <b>, <i>, <u>
+    - НЕ используй сложные теги: <pre>, <ul>, <li>, <code>
+    - Простая разметка для лучшей совместимости с Telegram
+    - При поздравлениях обращайся через ники (@username)
+    - При повествовании используй имена (Иван, Мария)
+    - Цифры упоминай только если они выдающиеся/интересные
+    - БЕЗ лишних отступов и пустых строк - пиши компактно
+    - Добавляй <tg-spoiler></tg-spoiler> для интересных фактов
+    - Обязательно используй ссылки на сообщения когда рассказываешь о темах или цитатах в формате специальном телеграммном, ссылки оформляй тегом <a href="https://t.me/c/ЧАТ_АЙДИ/СООБЩЕНИЕ_АЙДИ">ссылка</a>
+
+    ОГРАНИЧЕНИЯ:
+    - Максимальная длина сообщения: 3500 символов (для Telegram)
+    - Избегай длинных абзацев - разбивай на короткие
+    - Без лишних HTML-тегов - только необходимые
+    - Компактный формат без пустых строк
+    """
+
+
+def summarize_window(client, group, lines, index, total):
+    """Map-шаг: делает краткий конспект одного окна переписки"""
+    prompt = (
+        f"Отрезок {index + 1} из {total} переписки в группе \"{group.title}\".\n"
+        f"Кратко (не больше 10 пунктов) перечисли темы обсуждений, кто что говорил и яркие цитаты. "
+        f"К каждой теме и цитате приложи ссылку на сообщение тегом <a href=\"ССЫЛКА\">ссылка</a>, "
+        f"ссылки бери из сообщений.\n\nСообщения:\n" + "\n".join(lines)
+    )
+    return complete(client, MAP_SYSTEM_PROMPT, prompt, settings.SUMMARY_MAP_MAX_TOKENS, 0.3)
+
+
+def day_bounds(day):
+    """Границы суток по московскому времени"""
+    return (
+        timezone.make_aware(datetime.combine(day, dt_time.min)),
+        timezone.make_aware(datetime.combine(day, dt_time.max)),
+    )
+
+
+def split_by_daily_summaries(group, start_datetime, end_datetime):
+    """Делит период на готовые резюме полных суток и непокрытые ими отрезки.
+
+    Возвращает (список DailySummary по порядку, список отрезков (начало, конец)),
+    отрезки нужно резюмировать по сырым сообщениям.
+    """
+    local_start = timezone.localtime(start_datetime)
+    local_end = timezone.localtime(end_datetime)
+    first_day = local_start.date() if local_start.time() == dt_time.min else local_start.date() + timedelta(days=1)
+    # Форма задает время с точностью до минуты, поэтому 23:59 считаем концом суток
+    last_day = local_end.date() if local_end.time() >= dt_time(23, 59) else local_end.date() - timedelta(days=1)
+    if first_day > last_day:
+        return [], [(start_datetime, end_datetime)]
+
+    daily = list(DailySummary.objects.filter(group=group, day__gte=first_day, day__lte=last_day).order_by('day'))
+
+    segments = []
+    segment_start = start_datetime
+    for daily_summary in daily:
+        day_start, day_end = day_bounds(daily_summary.day)
+        if segment_start < day_start:
+            segments.append((segment_start, day_start - timedelta(microseconds=1)))
+        segment_start = day_end + timedelta(microseconds=1)
+    if segment_start <= end_datetime:
+        segments.append((segment_start, end_datetime))
+
+    return daily, segments
+
+
+def create_chat_summary(group, start_datetime, end_datetime, custom_prompt=None, stats=None, on_progress=None, use_daily=True):
+    """Создает резюме чата с помощью OpenAI API.
+
+    Короткий период резюмируется одним запросом. Длинный период делится на окна,
+    ограниченные бюджетом токенов: окна конспектируются параллельно (map),
+    затем конспекты сводятся в итоговый HTML (reduce). Полные сутки, для которых
+    уже есть DailySummary, не перечитываются - их резюме сразу идет в reduce.
+
+    on_progress(stage, text) вызывается по мере готовности конспектов окон
+    и потокового текста итогового резюме.
+    """
+    timings = {}
+    window_count = 0
+    daily_count = 0
+    compaction = {'input_tokens': 0, 'output_tokens': 0}
+    error = False
+    started = time.monotonic()
+    try:
+        if stats is None:
+            stats = get_summary_stats(group, start_datetime, end_datetime)
+
+        context = build_summary_context(group, start_datetime, end_datetime, stats, custom_prompt)
+
+        if use_daily:
+            daily, segments = split_by_daily_summaries(group, start_datetime, end_datetime)
+        else:
+            daily, segments = [], [(start_datetime, end_datetime)]
+        daily_count = len(daily)
+
+        # Окна сырых сообщений вне готовых суток; бюджет окон делим между отрезками
+        windows = []
+        max_windows = max(1, settings.SUMMARY_MAX_WINDOWS // len(segments)) if daily else None
+        for segment_start, segment_end in segments:
+            if daily:
+                segment_stats = get_summary_stats(group, segment_start, segment_end)
+            else:
+                segment_stats = stats
+            if not segment_stats['message_count']:
+                continue
+            segment_windows, segment_tokens = build_prompt_windows(group, segment_start, segment_end, segment_stats, max_windows=max_windows)
+            windows.extend((segment_start, lines) for lines in segment_windows)
+            compaction['input_tokens'] += segment_tokens['input_tokens']
+            compaction['output_tokens'] += segment_tokens['output_tokens']
+        window_count = len(windows)
+        timings['load'] = time.monotonic() - started
+
+        client = get_openai_client()
+
+        stage_started = time.monotonic()
+        if window_count > 1 or daily:
+            # Частичные резюме: (ключ сортировки, подпись, текст)
+            partials = [
+                ((day_bounds(item.day)[0], 0), f"{item.day:%d.%m} (резюме дня)", item.summary)
+                for item in daily
+            ]
+            workers = min(settings.SUMMARY_MAX_WORKERS, max(window_count, 1))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(summarize_window, client, group, lines, index, window_count): (segment_start, index)
+                    for index, (segment_start, lines) in enumerate(windows)
+                }
+                for done_count, future in enumerate(as_completed(futures), 1):
+                    segment_start, index = futures[future]
+                    partials.append(((segment_start, index + 1), f"Отрезок {index + 1}", future.result()))
+                    if on_progress:
+                        on_progress('map', f"Готово окон: {done_count} из {window_count}\n\n" + "\n\n".join(
+                            text for _, _, text in sorted(partials, key=lambda item: item[0])
+                        ))
+            partials.sort(key=lambda item: item[0])
+            context += "\n\nКонспекты переписки по отрезкам периода (по порядку):\n" + "\n\n".join(
+                f"{label}:\n{text}" for _, label, text in partials
+            )
+        elif windows:
+            # Добавляем сообщения с ссылками в контекст
+            context += f"\n\nСообщения для анализа:\n" + "\n".join(windows[0][1])
+        timings['map'] = time.monotonic() - stage_started
+
+        stage_started = time.monotonic()
+        on_delta = (lambda text: on_progress('reduce', text)) if on_progress else None
+        summary = complete(client, SYSTEM_PROMPT, context, 1200, 0.9, on_delta=on_delta)
+        timings['reduce'] = time.monotonic() - stage_started
+
+    except Exception as e:
+        summary = f"<b>Ошибка при создании резюме:</b> {str(e)}"
+        error = True
+
+    timings['total'] = time.monotonic() - started
+    compaction['ratio'] = compaction['output_tokens'] / compaction['input_tokens'] if compaction['input_tokens'] else 1.0
+    print(
+        f"⏱ Резюме группы {group.title}: окон {window_count}, готовых суток {daily_count}, "
+        f"токенов сообщений {compaction['input_tokens']} → {compaction['output_tokens']} "
+        f"({compaction['ratio']:.0%}), "
+        + ", ".join(f"{stage}={seconds:.2f}с" for stage, seconds in timings.items())
+    )
+
+    return {
+        'summary': summary,
+        'timings': timings,
+        'window_count': window_count,
+        'daily_count': daily_count,
+        'compaction': compaction,
+        'error': error,
+    }
+
+
+def summarize_day(group, day, force=False):
+    """Резюмирует сутки группы и сохраняет результат в DailySummary.
+
+    Возвращает DailySummary или None, если сообщений не было или модель вернула ошибку.
+    """
+    existing = DailySummary.objects.filter(group=group, day=day).first()
+    if existing and not force:
+        return existing
+
+    start_datetime, end_datetime = day_bounds(day)
+    stats = get_summary_stats(group, start_datetime, end_datetime)
+    if not stats['message_count']:
+        return None
+
+    result = create_chat_summary(group, start_datetime, end_datetime, stats=stats, use_daily=False)
+    if result['error']:
+        return None
+
+    daily_summary, _ = DailySummary.objects.update_or_create(
+        group=group,
+        day=day,
+        defaults={
+            'summary': result['summary'],
+            'message_count': stats['message_count'],
+            'created_at': timezone.now(),
+        }
+    )
+    return daily_summary
+
+
+def summary_fingerprint(stats, daily=()):
+    """Отпечаток набора сообщений: меняется при новых, удаленных или отредактированных сообщениях
+    и при пересчете резюме дней (daily), из которых собирается итог"""
+    raw = f"{stats['message_count']}:{stats['last_id']}:{stats['last_date']}:{stats['text_chars']}:{stats.get('content_hash')}"
+    for daily_summary in daily:
+        # created_at обновляется при каждом пересчете резюме дня
+        raw += f":{daily_summary.id}@{daily_summary.created_at.isoformat()}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def summary_prompt_hash(custom_prompt=None):
+    """Хеш всех промптов, от которых зависит текст резюме"""
+    raw = "\n".join([custom_prompt or '', SYSTEM_PROMPT, MAP_SYSTEM_PROMPT])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def find_cached_summary(group, start_datetime, end_datetime, custom_prompt=None, stats=None):
+    """Возвращает сохраненное резюме за период, если сообщения с тех пор не менялись"""
+    if stats is None:
+        stats = get_summary_stats(group, start_datetime, end_datetime)
+    return ChatSummary.objects.filter(
+        **summary_cache_key(group, start_datetime, end_datetime, custom_prompt, stats)
+    ).first()
+
+
+def summary_cache_key(group, start_datetime, end_datetime, custom_prompt, stats):
+    """Поля, по которым резюме считается тем же самым"""
+    return {
+        'group': group,
+        'start_datetime': start_datetime,
+        'end_datetime': end_datetime,
+        'prompt_hash': summary_prompt_hash(custom_prompt),
+        'model_name': settings.SUMMARY_MODEL,
+        'fingerprint': summary_fingerprint(stats, split_by_daily_summaries(group, start_datetime, end_datetime)[0]),
+    }
+
+
+def get_or_create_summary(group, start_datetime, end_datetime, custom_prompt=None, stats=None, force=False, on_progress=None):
+    """Возвращает сохраненное резюме, если сообщения за период не менялись, иначе создает новое.
+
+    Возвращает пару (ChatSummary или None, результат create_chat_summary или None).
+    При ошибке модели резюме не сохраняется.
+    """
+    if stats is None:
+        stats = get_summary_stats(group, start_datetime, end_datetime)
+
+    key = summary_cache_key(group, start_datetime, end_datetime, custom_prompt, stats)
+
+    if not force:
+        cached = ChatSummary.objects.filter(**key).first()
+        if cached:
+            print(f"♻️ Используем сохраненное резюме #{cached.id} для группы {group.title}")
+            return cached, None
+
+    result = create_chat_summary(group, start_datetime, end_datetime, custom_prompt, stats=stats, on_progress=on_progress)
+    if result['error']:
+        return None, result
+
+    saved, _ = ChatSummary.objects.update_or_create(
+        **key,
+        defaults={
+            'summary': result['summary'],
+            'custom_prompt': custom_prompt or '',
+            'message_count': stats['message_count'],
+            'input_tokens': result['compaction']['input_tokens'],
+            'prompt_tokens': result['compaction']['output_tokens'],
+            'created_at': timezone.now(),
+        }
+    )
+    return saved, result
@@ -0,0 +1,170 @@
+import json
+from datetime import datetime, timezone as dt_timezone
+from django.utils import timezone
+
+
+# Сколько символов читать из файла за раз
+READ_SIZE = 1 << 20
+
+# media_type экспорта -> тип сообщения (как его определяет бот по полям aiogram)
+MEDIA_TYPES = {
+    'voice_message': 'voice',
+    'video_file': 'video',
+    'sticker': 'sticker',
+    'audio_file': 'audio',
+    'video_message': 'video_note',
+    # GIF в Bot API приходит и как документ, бот считает его документом
+    'animation': 'document',
+}
+
+
+class ExportReader:
+    """Потоковое чтение result.json из Telegram Desktop без загрузки файла целиком.
+
+    Поля чата до "messages" читаются обычным json, сами сообщения - по одному через raw_decode.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Дочитывает файл в буфер, отбрасывая уже разобранное; False - файл закончился"""
+        chunk = self.stream.read(READ_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Следующий значимый символ (пустая строка в конце файла)"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f'Ожидался символ {char!r}, найден {found!r}')
+        self.pos += 1
+
+    def _value(self):
+        """Читает одно JSON-значение, при необходимости дочитывая файл"""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # Число на границе буфера могло прочитаться не целиком
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def read_header(self):
+        """Читает поля чата (name, type, id) до списка сообщений и останавливается на нем"""
+        header = {}
+        self._expect('{')
+        while True:
+            if self._peek() == '}':
+                raise ValueError('В файле нет списка messages')
+            key = self._value()
+            self._expect(':')
+            if key == 'messages':
+                self._expect('[')
+                return header
+            if key == 'chats':
+                raise ValueError('Это экспорт всего аккаунта: экспортируйте историю одного чата')
+            header[key] = self._value()
+            if self._peek() == ',':
+                self.pos += 1
+
+    def messages(self):
+        """Сообщения по одному; вызывать после read_header"""
+        while True:
+            char = self._peek()
+            if char == ']':
+                self.pos += 1
+                return
+            if char == ',':
+                self.pos += 1
+                continue
+            if not char:
+                raise ValueError('Файл оборвался внутри списка messages')
+            yield self._value()
+
+
+def export_chat_id(header):
+    """telegram_id группы для Bot API по заголовку экспорта"""
+    chat_type = header.get('type', '')
+    chat_id = int(header['id'])
+    if chat_type.endswith('supergroup') or chat_type.endswith('channel'):
+        return int(f'-100{chat_id}')
+    if chat_type == 'private_group':
+        return -chat_id
+    raise ValueError(f'Тип чата {chat_type!r} не поддерживается, нужен экспорт группы')
+
+
+def flatten_text(text):
+    """Текст сообщения экспорта: строка или список строк и сущностей {'type', 'text'}"""
+    if isinstance(text, str):
+        return text
+    return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text or [])
+
+
+def message_type_for(message, text):
+    """Тип сообщения экспорта в терминах Message.MESSAGE_TYPES"""
+    if 'photo' in message:
+        return 'photo'
+    if message.get('media_type') in MEDIA_TYPES:
+        return MEDIA_TYPES[message['media_type']]
+    if 'file' in message:
+        return 'document'
+    if text:
+        return 'text'
+    if 'forwarded_from' in message:
+        return 'forward'
+    return 'other'
+
+
+def parse_export_date(message):
+    """Дата сообщения: date_unixtime (UTC), в старых экспортах - локальное время в date"""
+    if message.get('date_unixtime'):
+        return datetime.fromtimestamp(int(message['date_unixtime']), tz=dt_timezone.utc)
+    return timezone.make_aware(datetime.fromisoformat(message['date']))
+
+
+def parse_export_message(message):
+    """Поля для Message и автор из сообщения экспорта.
+
+    Возвращает None для служебных сообщений и постов не от пользователей (каналы),
+    иначе словарь: telegram_id, date, message_type, text, related_message, user_telegram_id, user_name.
+    """
+    if message.get('type') != 'message':
+        return None
+    from_id = message.get('from_id') or ''
+    if not from_id.startswith('user'):
+        return None
+
+    text = flatten_text(message.get('text'))
+    message_type = message_type_for(message, text)
+    return {
+        'telegram_id': int(message['id']),
+        'date': parse_export_date(message),
+        'message_type': message_type,
+        # Бот сохраняет текст только у текстовых сообщений, подписи к медиа не хранятся
+        'text': text if message_type == 'text' else '',
+        'related_message': message.get('reply_to_message_id'),
+        'user_telegram_id': int(from_id[len('user'):]),
+        'user_name': message.get('from') or '',
+    }
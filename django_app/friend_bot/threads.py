@@ -0,0 +1,122 @@
+from django.db import connection
+from .models import Message
+
+
+# Защита от циклов и слишком глубоких веток
+MAX_THREAD_DEPTH = 200
+
+THREAD_SQL = """
+WITH RECURSIVE ancestors AS (
+    SELECT m.telegram_id, m.related_message, 0 AS depth
+    FROM {table} m
+    WHERE m.chat_id = %s AND m.telegram_id = %s
+    UNION ALL
+    SELECT p.telegram_id, p.related_message, a.depth + 1
+    FROM {table} p
+    JOIN ancestors a ON p.telegram_id = a.related_message
+    WHERE p.chat_id = %s AND a.depth < %s
+),
+root AS (
+    SELECT telegram_id FROM ancestors ORDER BY depth DESC LIMIT 1
+),
+thread AS (
+    SELECT m.id, m.telegram_id, 0 AS depth
+    FROM {table} m
+    JOIN root r ON m.telegram_id = r.telegram_id
+    WHERE m.chat_id = %s
+    UNION ALL
+    SELECT c.id, c.telegram_id, t.depth + 1
+    FROM {table} c
+    JOIN thread t ON c.related_message = t.telegram_id
+    WHERE c.chat_id = %s AND t.depth < %s
+)
+SELECT m.telegram_id, m.related_message, m.date, m.message_type, m.text, t.depth,
+       u.telegram_id AS user_telegram_id, u.username, u.first_name
+FROM thread t
+JOIN {table} m ON m.id = t.id
+JOIN {user_table} u ON u.id = m.user_id
+ORDER BY m.date, m.telegram_id
+"""
+
+ROOTS_SQL = """
+WITH RECURSIVE chain AS (
+    SELECT m.telegram_id AS start_id, m.telegram_id, m.related_message, 0 AS depth
+    FROM {table} m
+    WHERE m.chat_id = %s AND m.telegram_id IN ({placeholders})
+    UNION ALL
+    SELECT c.start_id, p.telegram_id, p.related_message, c.depth + 1
+    FROM {table} p
+    JOIN chain c ON p.telegram_id = c.related_message
+    WHERE p.chat_id = %s AND c.depth < %s
+)
+SELECT start_id, telegram_id, depth FROM chain
+"""
+
+
+def fetch_thread(group, telegram_id):
+    """Возвращает всю ветку ответов, в которую входит сообщение, одним рекурсивным запросом.
+
+    Сначала поднимаемся от сообщения к корню ветки, затем спускаемся по всем ответам.
+    Результат - список словарей в хронологическом порядке, depth - глубина от корня.
+    """
+    sql = THREAD_SQL.format(table=Message._meta.db_table, user_table=Message.user.field.related_model._meta.db_table)
+    params = [
+        group.id, telegram_id, group.id, MAX_THREAD_DEPTH,
+        group.id, group.id, MAX_THREAD_DEPTH,
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def resolve_roots(group, telegram_ids):
+    """Находит корень ветки для каждого сообщения одним рекурсивным запросом.
+
+    Возвращает словарь {telegram_id: telegram_id корня}; сообщения, которых нет в БД,
+    в словарь не попадают.
+    """
+    telegram_ids = list(set(telegram_ids))
+    if not telegram_ids:
+        return {}
+
+    sql = ROOTS_SQL.format(table=Message._meta.db_table, placeholders=', '.join(['%s'] * len(telegram_ids)))
+    params = [group.id, *telegram_ids, group.id, MAX_THREAD_DEPTH]
+    roots = {}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for start_id, root_id, depth in cursor.fetchall():
+            if start_id not in roots or depth > roots[start_id][1]:
+                roots[start_id] = (root_id, depth)
+    return {start_id: root_id for start_id, (root_id, _) in roots.items()}
+
+
+def group_into_conversations(group, records):
+    """Собирает сообщения периода в беседы по веткам ответов.
+
+    records - список кортежей (telegram_id, related_message, ...) в хронологическом порядке.
+    Возвращает список бесед (списков records), упорядоченных по первому сообщению;
+    внутри беседы порядок хронологический.
+    """
+    known = {record[0] for record in records}
+    parent_of = {record[0]: record[1] for record in records}
+
+    # Ответы на сообщения до начала периода разрешаем через БД, чтобы не рвать такие ветки
+    outside = {record[1] for record in records if record[1] is not None and record[1] not in known}
+    outside_roots = resolve_roots(group, outside) if outside else {}
+
+    def root_of(telegram_id):
+        seen = set()
+        while parent_of.get(telegram_id) is not None and telegram_id not in seen:
+            seen.add(telegram_id)
+            parent = parent_of[telegram_id]
+            if parent not in known:
+                return outside_roots.get(parent, parent)
+            telegram_id = parent
+        return telegram_id
+
+    conversations = {}
+    for record in records:
+        conversations.setdefault(root_of(record[0]), []).append(record)
+    # dict сохраняет порядок вставки - беседы идут по времени первого сообщения
+    return list(conversations.values())
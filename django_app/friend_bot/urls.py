@@ -3,16 +3,27 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from friend_bot import views
-from friend_bot.api_views import IngestMessageView, SendMessageView, StatisticsView
+from friend_bot.api_views import IngestMessageView, SendMessageView, StatisticsView, ThreadView, FriendsView, SimulateView, LeaderboardView, MembersView, ExportView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.dashboard_view, name='dashboard'),
     path('group/<int:group_id>/summary/', views.group_summary_view, name='group_summary'),
+    path('group/<int:group_id>/summary/<int:summary_id>/', views.summary_detail_view, name='summary_detail'),
+    path('group/<int:group_id>/summary/job/<int:job_id>/', views.summary_job_view, name='summary_job'),
+    path('group/<int:group_id>/summary/job/<int:job_id>/status/', views.summary_job_status_view, name='summary_job_status'),
     path('group/<int:group_id>/statistics/', views.group_statistics_view, name='group_statistics'),
+    path('simulator/', views.simulator_view, name='simulator'),
+    path('group/<int:group_id>/export/', views.group_export_view, name='group_export'),
     path('api/ingest/message/', IngestMessageView.as_view(), name='ingest_message'),
     path('api/send/message/', SendMessageView.as_view(), name='send_message'),
     path('api/statistics/', StatisticsView.as_view(), name='statistics'),
+    path('api/friends/', FriendsView.as_view(), name='friends'),
+    path('api/simulate/', SimulateView.as_view(), name='simulate'),
+    path('api/leaderboard/', LeaderboardView.as_view(), name='leaderboard'),
+    path('api/members/', MembersView.as_view(), name='members'),
+    path('api/groups/<int:group_id>/export/<str:dataset>/', ExportView.as_view(), name='export'),
+    path('api/groups/<int:group_id>/threads/<int:telegram_id>/', ThreadView.as_view(), name='thread'),
 ]
 
 if settings.DEBUG:
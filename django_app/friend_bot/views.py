@@ -10,7 +10,12 @@ from django.conf import settings
 from datetime import datetime, timedelta
 import os
 import json
-from .models import TelegramGroup, Message, User, UserInGroup, DailyCheckin
+from django.urls import reverse
+from .models import TelegramGroup, Message, User, UserInGroup, DailyCheckin, ChatSummary, SummaryJob
+from .summary import find_cached_summary, get_summary_stats
+from .jobs import enqueue_summary_job
+from .simulator import current_points_table, current_rank_ladder, parse_proposal, simulate_group
+from .exports import DATASETS, FORMATS, export_filename, export_response, parse_period
 from django.db import models
 
 
@@ -23,41 +28,27 @@ def group_summary_view(request, group_id):
         start_datetime_str = request.POST.get('start_datetime')
         end_datetime_str = request.POST.get('end_datetime')
         custom_prompt = request.POST.get('custom_prompt')
+        force_regenerate = bool(request.POST.get('force_regenerate'))
         
         if start_datetime_str and end_datetime_str:
             try:
-                start_datetime = datetime.strptime(start_datetime_str, '%Y-%m-%dT%H:%M')
-                end_datetime = datetime.strptime(end_datetime_str, '%Y-%m-%dT%H:%M')
+                start_datetime = timezone.make_aware(datetime.strptime(start_datetime_str, '%Y-%m-%dT%H:%M'))
+                end_datetime = timezone.make_aware(datetime.strptime(end_datetime_str, '%Y-%m-%dT%H:%M'))
                 
-                # Получаем сообщения за указанный период
-                messages = Message.objects.filter(
-                    chat=group,
-                    date__gte=start_datetime,
-                    date__lte=end_datetime
-                ).order_by('date')
+                # Статистика за период одним агрегирующим запросом
+                stats = get_summary_stats(group, start_datetime, end_datetime)
                 
-                if messages.exists():
-                    # Создаем резюме с помощью OpenAI
-                    summary = create_chat_summary(messages, group, start_datetime, end_datetime, custom_prompt)
+                if stats['message_count']:
+                    # Сохраненное резюме отдаем сразу, иначе генерируем в фоне
+                    cached = None if force_regenerate else find_cached_summary(
+                        group, start_datetime, end_datetime, custom_prompt, stats=stats
+                    )
+                    if cached:
+                        print(f"♻️ Используем сохраненное резюме #{cached.id} для группы {group.title}")
+                        return render_summary_result(request, group, cached, from_cache=True)
                     
-                    # Отладочная информация
-                    try:
-                        secret_key = settings.SECRET_KEY
-                        print(f"🔍 SECRET_KEY получен: {secret_key[:20] if secret_key else 'None'}...")
-                    except Exception as e:
-                        print(f"❌ Ошибка получения SECRET_KEY: {e}")
-                        secret_key = "default_secret_key"
-                    
-                    print(f"🔍 Передаем auth_token в шаблон: {secret_key[:20] if secret_key else 'None'}...")
-                    
-                    return render(request, 'friend_bot/summary_result.html', {
-                        'group': group,
-                        'summary': summary,
-                        'start_datetime': start_datetime_str,
-                        'end_datetime': end_datetime_str,
-                        'message_count': messages.count(),
-                        'auth_token': secret_key
-                    })
+                    job = enqueue_summary_job(group, start_datetime, end_datetime, custom_prompt, force=force_regenerate)
+                    return redirect('summary_job', group_id=group.id, job_id=job.id)
                 else:
                     messages.error(request, 'За указанный период сообщений не найдено')
             except ValueError:
@@ -65,112 +56,70 @@ def group_summary_view(request, group_id):
     
     return render(request, 'friend_bot/group_summary.html', {
         'group': group,
+        'past_summaries': ChatSummary.objects.filter(group=group)[:10],
         'auth_token': settings.SECRET_KEY
     })
 
 
-def create_chat_summary(messages, group, start_datetime, end_datetime, custom_prompt=None):
-    """Создает резюме чата с помощью OpenAI API"""
+def render_summary_result(request, group, saved_summary, from_cache=False, job=None):
+    """Показывает сохраненное резюме со статистикой и кнопками отправки"""
+    # Отладочная информация
     try:
-        from openai import OpenAI
-        import requests
-        
-        # Настройки для обхода блокировки
-        api_key = os.getenv('OPENAI_API_KEY')
-        base_url = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
-        
-        # Создаем клиент с возможностью кастомного base_url
-        client = OpenAI(
-            api_key=api_key,
-            base_url=base_url
-        )
-        
-        # Формируем контекст для анализа
-        period_duration = end_datetime - start_datetime
-        days = period_duration.days
-        hours = period_duration.seconds // 3600
-        
-        if days > 0:
-            period_text = f"{days} {'день' if days == 1 else 'дня' if days < 5 else 'дней'}"
-        elif hours > 0:
-            period_text = f"{hours} {'час' if hours == 1 else 'часа' if hours < 5 else 'часов'}"
-        else:
-            period_text = "несколько минут"
-        
-        # Формируем сообщения с ссылками
-        messages_with_links = []
-        for msg in messages:
-            # Убираем -100 из chat_id для ссылки
-            chat_id_clean = str(group.telegram_id).replace('-100', '')
-            message_link = f"https://t.me/c/{chat_id_clean}/{msg.telegram_id}"
-            
-            user_info = f"@{msg.user.username}" if msg.user.username else f"{msg.user.first_name}"
-            message_text = msg.text[:100] + "..." if len(msg.text) > 100 else msg.text
-            
-            messages_with_links.append(f"[{user_info}: {message_text}]({message_link})")
-        
-        messages_text = "\n".join(messages_with_links)
-        
-        # Используем кастомный промпт или стандартный
-        if custom_prompt:
-            context = custom_prompt
-        else:
-            context = f"""
-            Ты - друг, который следил за чатом в группе "{group.title}" и теперь рассказывает другому другу, что он пропустил за {period_text} (с {start_datetime.strftime('%d.%m %H:%M')} по {end_datetime.strftime('%d.%m %H:%M')}).
-            
-            Твой стиль - это дружеская беседа за пивом, живая, эмоциональная, с шутками и личными комментариями.
-            
-            Статистика для справки:
-            - Сообщений за период: {messages.count()}
-            - Активных участников: {UserInGroup.objects.filter(group=group, is_active=True).count()}
-            
-            Создай живое резюме в HTML-разметке, которое включает:
-            1. Основные темы обсуждений (2-3 главные темы с эмоциями)
-            2. Самые активные участники (с личными комментариями)
-            3. Интересные моменты или цитаты (если есть)
-            4. Эмоциональное завершение
-            
-            Правила стиля:
-            - НЕ НАЧИНАЙ с приветствия - сразу переходи к делу
-            - Обращайся к участникам во множественном числе: "ребятки", "братишки", "сестренки", "ребятушки", "друзья", "товарищи"
-            - Пиши как друг рассказывает другу: "блин, здарова", "так, ребятки", "ну это никуда не годится"
-            - Используй разговорную речь, междометия, эмоции
-            - Комментируй активность: "обсусситесь", "запасайтесь попкорном", "плачущий ребенок и никаких сплетен??"
-            - Используй только базовые HTML-теги: <b>, <i>, <u>
-            - НЕ используй сложные теги: <pre>, <ul>, <li>, <code>
-            - Простая разметка для лучшей совместимости с Telegram
-            - При поздравлениях обращайся через ники (@username)
-            - При повествовании используй имена (Иван, Мария)
-            - Цифры упоминай только если они выдающиеся/интересные
-            - БЕЗ лишних отступов и пустых строк - пиши компактно
-            - Добавляй <tg-spoiler></tg-spoiler> для интересных фактов
-            - Обязательно используй ссылки на сообщения когда рассказываешь о темах или цитатах в формате специальном телеграммном, ссылки оформляй тегом <a href="https://t.me/c/ЧАТ_АЙДИ/СООБЩЕНИЕ_АЙДИ">ссылка</a>
-            
-            ОГРАНИЧЕНИЯ:
-            - Максимальная длина сообщения: 3500 символов (для Telegram)
-            - Избегай длинных абзацев - разбивай на короткие
-            - Без лишних HTML-тегов - только необходимые
-            - Компактный формат без пустых строк
-            """
-        
-        # Добавляем сообщения с ссылками в контекст
-        if messages_with_links:
-            context += f"\n\nСообщения для анализа:\n" + "\n".join(messages_with_links[:30])
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Ты - друг, который следил за чатом и теперь рассказывает другому другу, что тот пропустил. Твой стиль - живая дружеская беседа за пивом, эмоциональная, с шутками и личными комментариями. Используй ТОЛЬКО простые HTML-теги: <b>, <i>, <u>. НЕ используй <pre>, <ul>, <li>, <code>. НЕ НАЧИНАЙ с приветствия, обращайся к участникам во множественном числе (ребятки, братишки, сестренки, друзья). Пиши компактно без лишних отступов. Добавляй <tg-spoiler></tg-spoiler> для интересных фактов. Обязательно используй ссылки на сообщения когда рассказываешь о темах или цитатах в формате специальном телеграммном, ссылки оформляй тегом <a href='https://t.me/c/{chat_id_clean}/{msg.telegram_id}'>ссылка</a>."},
-                {"role": "user", "content": context}
-            ],
-            max_tokens=1200,
-            temperature=0.9
-        )
-        
-        return response.choices[0].message.content
-        
+        secret_key = settings.SECRET_KEY
+        print(f"🔍 SECRET_KEY получен: {secret_key[:20] if secret_key else 'None'}...")
     except Exception as e:
-        return f"<b>Ошибка при создании резюме:</b> {str(e)}"
+        print(f"❌ Ошибка получения SECRET_KEY: {e}")
+        secret_key = "default_secret_key"
+    
+    print(f"🔍 Передаем auth_token в шаблон: {secret_key[:20] if secret_key else 'None'}...")
+    
+    return render(request, 'friend_bot/summary_result.html', {
+        'group': group,
+        'summary': saved_summary.summary,
+        'saved_summary': saved_summary,
+        'from_cache': from_cache,
+        'timings': job.timings if job else {},
+        'start_datetime': timezone.localtime(saved_summary.start_datetime).strftime('%Y-%m-%dT%H:%M'),
+        'end_datetime': timezone.localtime(saved_summary.end_datetime).strftime('%Y-%m-%dT%H:%M'),
+        'custom_prompt': saved_summary.custom_prompt,
+        'message_count': saved_summary.message_count,
+        'auth_token': secret_key
+    })
+
+
+@staff_member_required
+def summary_detail_view(request, group_id, summary_id):
+    """Страница сохраненного резюме"""
+    group = get_object_or_404(TelegramGroup, id=group_id)
+    saved_summary = get_object_or_404(ChatSummary, id=summary_id, group=group)
+    job = SummaryJob.objects.filter(summary=saved_summary, status='done').order_by('-finished_at').first()
+    return render_summary_result(request, group, saved_summary, job=job)
+
+
+@staff_member_required
+def summary_job_view(request, group_id, job_id):
+    """Страница фоновой задачи резюме с опросом статуса"""
+    group = get_object_or_404(TelegramGroup, id=group_id)
+    job = get_object_or_404(SummaryJob, id=job_id, group=group)
+    return render(request, 'friend_bot/summary_job.html', {
+        'group': group,
+        'job': job,
+    })
+
+
+@staff_member_required
+def summary_job_status_view(request, group_id, job_id):
+    """Статус фоновой задачи резюме для опроса со страницы задачи"""
+    job = get_object_or_404(SummaryJob, id=job_id, group_id=group_id)
+    return JsonResponse({
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'stage': job.stage,
+        'partial_output': job.partial_output,
+        'timings': job.timings,
+        'error': job.error,
+        'result_url': reverse('summary_detail', args=[group_id, job.summary_id]) if job.summary_id else None,
+    })
 
 
 @staff_member_required
@@ -212,6 +161,68 @@ def group_statistics_view(request, group_id):
     return render(request, 'friend_bot/group_statistics.html', context)
 
 
+@staff_member_required
+def group_export_view(request, group_id):
+    """Страница выгрузки данных группы за период: файл отдается потоком"""
+    group = get_object_or_404(TelegramGroup, id=group_id)
+
+    if request.method == 'POST':
+        dataset = request.POST.get('dataset')
+        output = request.POST.get('output', 'csv')
+        try:
+            if dataset not in DATASETS or output not in FORMATS:
+                raise ValueError('неизвестный набор данных или формат')
+            start, end = parse_period(request.POST.get('start'), request.POST.get('end'))
+        except ValueError as e:
+            messages.error(request, f'Ошибка: {e}')
+        else:
+            return export_response(
+                dataset, [group.id], start, end, output=output, compress=bool(request.POST.get('gzip')),
+                filename=export_filename(dataset, group, start, end),
+            )
+
+    return render(request, 'friend_bot/group_export.html', {'group': group})
+
+
+@staff_member_required
+def simulator_view(request):
+    """Симулятор: как изменятся рейтинги и звания при других баллах за типы и порогах званий"""
+    groups = TelegramGroup.objects.filter(is_active=True)
+    points_table = current_points_table()
+    rank_ladder = current_rank_ladder()
+    ranks_text = '\n'.join(f'{required};{name}' for required, name in rank_ladder)
+    selected_group = None
+    results = []
+
+    if request.method == 'POST':
+        points = {message_type: request.POST.get(f'points_{message_type}', value) for message_type, value in points_table.items()}
+        ranks_text = request.POST.get('ranks', '')
+        try:
+            ranks = []
+            for line in ranks_text.splitlines():
+                if not line.strip():
+                    continue
+                required, _, name = line.partition(';')
+                ranks.append({'required_rating': required.strip(), 'name': name.strip()})
+            points_table, rank_ladder = parse_proposal(points, ranks)
+        except ValueError as e:
+            messages.error(request, f'Ошибка: {e}')
+        else:
+            group_id = request.POST.get('group')
+            if group_id:
+                selected_group = get_object_or_404(TelegramGroup, id=group_id)
+            for group in ([selected_group] if selected_group else groups):
+                results.append({'group': group, **simulate_group(group, points_table, rank_ladder)})
+
+    return render(request, 'friend_bot/simulator.html', {
+        'groups': groups,
+        'selected_group': selected_group,
+        'points_table': sorted(points_table.items()),
+        'ranks_text': ranks_text,
+        'results': results,
+    })
+
+
 @staff_member_required
 def dashboard_view(request):
     """Главная страница админки"""
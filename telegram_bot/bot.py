@@ -1,8 +1,10 @@
 import asyncio
 import logging
 import os
+import sys
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.types import Message, ChatType
 import asyncpg
@@ -10,6 +12,20 @@ import aiohttp
 from dotenv import load_dotenv
 import pytz
 
+# Правила серий, очков и званий общие с Django: в образе бота scoring.py лежит рядом с bot.py,
+# при запуске из репозитория берем его из django_app
+try:
+    from scoring import effective_streak, moscow_day, MOSCOW_TZ
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'django_app', 'friend_bot'))
+    from scoring import effective_streak, moscow_day, MOSCOW_TZ
+
+from lanes import LaneDispatcher
+from spool import Spool, SENT, RETRY, FAILED
+from cache import ChatCache
+from replica import LeaderboardReplica
+from embedded import EmbeddedIngest, PAYLOAD_ERRORS, RETRYABLE_ERRORS
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -22,6 +38,40 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 DATABASE_URL = os.getenv('DATABASE_URL')
 DJANGO_API_URL = os.getenv('DJANGO_API_URL', 'http://django_app:8000/api/ingest/message/')
 INGEST_TOKEN = os.getenv('INGEST_TOKEN')
+# Свой Bot API сервер (локальный telegram-bot-api или тестовый), по умолчанию api.telegram.org
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER')
+
+# Режим получения обновлений: polling (getUpdates) или webhook (aiohttp-сервер, можно несколько воркеров)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Внешний адрес для setWebhook; пусто - вебхук не регистрируется этим воркером
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+# Журнал сообщений, не отправленных в Django (переживает перезапуски бота и Django)
+SPOOL_PATH = os.getenv('SPOOL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool', 'ingest.sqlite3'))
+SPOOL_MAX_MESSAGES = int(os.getenv('SPOOL_MAX_MESSAGES', '500000'))
+# Параллельная обработка: обновления раскладываются по полосам по chat.id, порядок внутри чата сохраняется
+BOT_LANES = int(os.getenv('BOT_LANES', '16'))
+BOT_LANE_QUEUE_SIZE = int(os.getenv('BOT_LANE_QUEUE_SIZE', '100'))
+# Сколько обновлений может быть в работе одновременно; сверх этого прием обновлений приостанавливается
+BOT_MAX_IN_FLIGHT = int(os.getenv('BOT_MAX_IN_FLIGHT', '200'))
+# Команды обрабатываются отдельно от потока сообщений: свои обработчики и свои соединения с Django
+BOT_COMMAND_WORKERS = int(os.getenv('BOT_COMMAND_WORKERS', '8'))
+INGEST_CONNECTIONS = int(os.getenv('INGEST_CONNECTIONS', '20'))
+COMMAND_CONNECTIONS = int(os.getenv('COMMAND_CONNECTIONS', '10'))
+# Сколько секунд отвечать на /stat из кэша, если в чате нет новых сообщений
+STAT_CACHE_TTL = int(os.getenv('STAT_CACHE_TTL', '30'))
+# Сколько секунд копия таблицы лидеров чата живет без перезагрузки из Django
+REPLICA_MAX_AGE = int(os.getenv('REPLICA_MAX_AGE', '600'))
+# Как часто писать в лог процентили задержки команд и сообщений, секунд (0 - не писать)
+LATENCY_REPORT_INTERVAL = int(os.getenv('LATENCY_REPORT_INTERVAL', '60'))
+# Прием сообщений: api (через Django REST API) или embedded (очки считает сам бот прямо в БД)
+INGEST_MODE = os.getenv('INGEST_MODE', 'api')
+EMBEDDED_POOL_MIN = int(os.getenv('EMBEDDED_POOL_MIN', '2'))
+EMBEDDED_POOL_MAX = int(os.getenv('EMBEDDED_POOL_MAX', '10'))
 
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("Не найден TELEGRAM_BOT_TOKEN")
@@ -30,102 +80,46 @@ if not DATABASE_URL:
     logger.warning("DATABASE_URL не задан — бот работает в REST-режиме (без прямого доступа к БД)")
 if not INGEST_TOKEN:
     raise ValueError("Не найден INGEST_TOKEN для доступа к Django API")
+if INGEST_MODE not in ('api', 'embedded'):
+    raise ValueError(f"Неизвестный INGEST_MODE: {INGEST_MODE}, нужен api или embedded")
+if INGEST_MODE == 'embedded' and not DATABASE_URL:
+    raise ValueError("Для INGEST_MODE=embedded нужен DATABASE_URL")
+if BOT_MODE not in ('polling', 'webhook'):
+    raise ValueError(f"Неизвестный BOT_MODE: {BOT_MODE}, нужен polling или webhook")
+if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+    raise ValueError("Для режима webhook нужен WEBHOOK_SECRET")
 
 # Инициализация бота
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+bot = Bot(
+    token=TELEGRAM_BOT_TOKEN,
+    server=TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION
+)
 storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
-
-
-async def get_db_connection():
-    """Получает соединение с базой данных"""
-    return await asyncpg.connect(DATABASE_URL)
+dp = LaneDispatcher(
+    bot, storage=storage, lanes=BOT_LANES, lane_queue_size=BOT_LANE_QUEUE_SIZE, max_in_flight=BOT_MAX_IN_FLIGHT,
+    command_workers=BOT_COMMAND_WORKERS, latency_report_interval=LATENCY_REPORT_INTERVAL
+)
 
+# Сессии aiohttp к Django по видам запросов
+django_sessions = {}
 
-async def get_or_create_user(message: Message):
-    """Получает или создает пользователя в базе данных"""
-    conn = await get_db_connection()
-    try:
-        # Проверяем существование пользователя
-        user_row = await conn.fetchrow(
-            "SELECT id FROM friend_bot_user WHERE telegram_id = $1",
-            message.from_user.id
-        )
-        
-        if user_row:
-            user_id = user_row['id']
-        else:
-            # Создаем нового пользователя
-            user_id = await conn.fetchval(
-                """
-                INSERT INTO friend_bot_user (telegram_id, first_name, last_name, username, is_active, created_at)
-                VALUES ($1, $2, $3, $4, $5, $6)
-                RETURNING id
-                """,
-                message.from_user.id,
-                message.from_user.first_name,
-                message.from_user.last_name or '',
-                message.from_user.username or '',
-                True,
-                datetime.now()
-            )
-        
-        return user_id
-    finally:
-        await conn.close()
 
+def django_session(kind):
+    """Общая сессия для запросов к Django: 'ingest' (поток сообщений) или 'command' (ответы на команды).
 
-async def get_or_create_group(message: Message):
-    """Получает или создает группу в базе данных"""
-    conn = await get_db_connection()
-    try:
-        # Проверяем существование группы
-        group_row = await conn.fetchrow(
-            "SELECT id FROM friend_bot_telegramgroup WHERE telegram_id = $1",
-            message.chat.id
-        )
-        
-        if group_row:
-            group_id = group_row['id']
-        else:
-            # Создаем новую группу
-            group_id = await conn.fetchval(
-                """
-                INSERT INTO friend_bot_telegramgroup (telegram_id, title, is_active)
-                VALUES ($1, $2, $3)
-                RETURNING id
-                """,
-                message.chat.id,
-                message.chat.title or f"Группа {message.chat.id}",
-                True
-            )
-        
-        return group_id
-    finally:
-        await conn.close()
+    У каждой свой пул соединений, поэтому поток сообщений не занимает соединения, нужные командам.
+    """
+    session = django_sessions.get(kind)
+    if session is None or session.closed:
+        limit = INGEST_CONNECTIONS if kind == 'ingest' else COMMAND_CONNECTIONS
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit))
+        django_sessions[kind] = session
+    return session
 
 
-async def ensure_user_in_group(user_id: int, group_id: int):
-    """Убеждается, что пользователь находится в группе"""
-    conn = await get_db_connection()
-    try:
-        # Проверяем существование связи
-        existing = await conn.fetchrow(
-            "SELECT id FROM friend_bot_useringroup WHERE user_id = $1 AND group_id = $2",
-            user_id, group_id
-        )
-        
-        if not existing:
-            # Создаем связь
-            await conn.execute(
-                """
-                INSERT INTO friend_bot_useringroup (user_id, group_id, joined_at, is_active)
-                VALUES ($1, $2, $3, $4)
-                """,
-                user_id, group_id, datetime.now(), True
-            )
-    finally:
-        await conn.close()
+async def get_db_connection():
+    """Получает соединение с базой данных"""
+    return await asyncpg.connect(DATABASE_URL)
 
 
 async def save_message(message: Message, user_id: int, group_id: int):
@@ -168,320 +162,438 @@ async def save_message(message: Message, user_id: int, group_id: int):
         'message_type': message_type,
         'text': text_content,
         'related_telegram_message_id': message.reply_to_message.message_id if getattr(message, 'reply_to_message', None) else None,
-        'auth_token': INGEST_TOKEN,
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(DJANGO_API_URL, json=payload, timeout=15) as resp:
-            if resp.status != 200:
-                body = await resp.text()
-                logger.error(f"Ingest error {resp.status}: {body}")
-            else:
-                logger.info("Сообщение отправлено в Django API")
+    # Пока в журнале есть отложенные сообщения, новые встают за ними, чтобы не нарушить порядок
+    if not spool.active:
+        result = await post_ingest(payload)
+        if result == SENT:
+            logger.info("Сообщение отправлено в Django API")
+            return
+        if result == FAILED:
+            # Ошибка на самом сообщении: повтор не поможет, а в журнале оно задержало бы все следующие
+            await spool.dead_letter(payload)
+            return
+    await spool.append(payload)
 
 
-async def update_user_rating(user_id: int, group_id: int, message_type: str):
-    """Обновляет рейтинг пользователя"""
-    conn = await get_db_connection()
+async def post_ingest(payload):
+    """Принимает сообщение: SENT - принято, RETRY - Django или БД недоступны, FAILED - ошибка на этом сообщении"""
+    if embedded:
+        return await post_ingest_embedded(payload)
+    return await post_ingest_api(payload)
+
+
+async def post_ingest_api(payload):
+    """Отправляет сообщение в Django REST API"""
     try:
-        # Получаем или создаем рейтинг
-        rating_row = await conn.fetchrow(
-            "SELECT id, rating, coefficient FROM friend_bot_rating WHERE user_id = $1 AND group_id = $2",
-            user_id, group_id
+        session = django_session('ingest')
+        async with session.post(DJANGO_API_URL, json={**payload, 'auth_token': INGEST_TOKEN}, timeout=15) as resp:
+            if resp.status == 200:
+                # Рейтинги чата изменились - сохраненный ответ /stat больше не актуален
+                stat_cache.invalidate(payload['chat_telegram_id'])
+                try:
+                    result = await resp.json()
+                except (aiohttp.ContentTypeError, ValueError):
+                    result = {}
+                replica.apply(payload['chat_telegram_id'], result.get('member'), result.get('old_rating'))
+                return SENT
+            body = await resp.text()
+            logger.error(f"Ingest error {resp.status}: {body[:500]}")
+            # 5xx - Django или БД перезапускаются, 408/429 - перегрузка, 401 - токен еще не совпал после деплоя;
+            # FAILED только для ответов, отвергающих само сообщение (400 от сериализатора и т.п.)
+            if resp.status >= 500 or resp.status in (401, 408, 429):
+                return RETRY
+            return FAILED
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Django API недоступен: {e!r}")
+        return RETRY
+
+
+async def post_ingest_embedded(payload):
+    """Записывает сообщение прямо в БД; уведомление о новом звании бот отправляет сам"""
+    try:
+        result = await embedded.ingest(payload)
+    except PAYLOAD_ERRORS as e:
+        logger.error(f"Ошибка при записи сообщения в БД: {e!r}")
+        return FAILED
+    except RETRYABLE_ERRORS as e:
+        logger.error(f"БД недоступна: {e!r}")
+        return RETRY
+    except asyncpg.exceptions.PostgresError as e:
+        # Прочие ошибки БД не связаны с содержимым сообщения - оно дождется исправления в журнале
+        logger.error(f"Ошибка БД при записи сообщения, повторим позже: {e!r}")
+        return RETRY
+    stat_cache.invalidate(payload['chat_telegram_id'])
+    replica.apply(payload['chat_telegram_id'], result['member'], result.get('old_rating'))
+    if result.get('rank_change'):
+        await notify_rank_change(payload['chat_telegram_id'], result['member'], result['rank_change'])
+    return SENT
+
+
+async def notify_rank_change(chat_id, member, rank_change):
+    """Поздравление со сменой звания, те же тексты, что у Django; неотправленное уходит в очередь send_rank_notifications"""
+    name = member['username'] or member['first_name']
+    new_name = rank_change['new'][0]
+    if rank_change['old'] is None:
+        text = f"🎉 <b>Поздравляем!</b>\n\n@{name} получил первое звание: <b>{new_name}</b>"
+    elif rank_change['new'][1] < rank_change['old'][1]:
+        # Понижение бывает только после изменения порогов званий в админке
+        text = f"📉 <b>Звание изменилось</b>\n\n@{name} теперь <b>{new_name}</b> (было <b>{rank_change['old'][0]}</b>)"
+    else:
+        text = f"🏆 <b>Новое звание!</b>\n\n@{name} повысился с <b>{rank_change['old'][0]}</b> до <b>{new_name}</b>"
+    try:
+        await bot.send_message(chat_id, text, parse_mode='HTML', disable_web_page_preview=True)
+        logger.info(f"✅ Уведомление о звании отправлено в чат {chat_id}")
+    except Exception as e:
+        logger.error(f"❌ Уведомление о звании не отправлено, ставим в очередь: {e!r}")
+        try:
+            await embedded.queue_rank_notification(rank_change)
+        except Exception as e:
+            logger.error(f"❌ Не удалось поставить уведомление о звании в очередь: {e!r}")
+
+
+embedded = EmbeddedIngest(DATABASE_URL, EMBEDDED_POOL_MIN, EMBEDDED_POOL_MAX) if INGEST_MODE == 'embedded' else None
+spool = Spool(SPOOL_PATH, post_ingest, max_messages=SPOOL_MAX_MESSAGES)
+stat_cache = ChatCache(STAT_CACHE_TTL)
+replica = LeaderboardReplica(REPLICA_MAX_AGE)
+# Загрузки таблиц чатов из Django: одновременные обращения к холодному чату ждут одну загрузку
+replica_loads = ChatCache(0)
+
+
+@dp.message_handler(commands=['start'])
+async def start_command(message: Message):
+    """Обработчик команды /start"""
+    await message.reply("Привет! Я бот для отслеживания активности в группах. Просто отправляй сообщения, и я буду их записывать!")
+
+
+async def load_members(chat_id=None):
+    """Состояние участников из Django: {chat_id: [участники]} для чата или всех активных групп"""
+    api_url = DJANGO_API_URL.replace('/api/ingest/message/', '/api/members/')
+    data = {'auth_token': INGEST_TOKEN}
+    if chat_id:
+        data['chat_id'] = chat_id
+    session = django_session('command')
+    async with session.post(api_url, json=data, timeout=30) as response:
+        if response.status != 200:
+            raise RuntimeError(f"API вернул статус {response.status}")
+        result = await response.json()
+    return {int(group_id): members for group_id, members in result['groups'].items()}
+
+
+async def chat_board(chat_id):
+    """Таблица лидеров чата из копии в памяти; холодный или устаревший чат загружается из Django.
+
+    None - загрузить не удалось.
+    """
+    board = replica.board(chat_id)
+    if board is not None:
+        return board
+
+    async def load():
+        try:
+            groups = await load_members(chat_id)
+        except Exception as e:
+            logger.error(f"Не удалось загрузить таблицу лидеров чата {chat_id}: {e}")
+            return None, False
+        return replica.load(chat_id, groups.get(chat_id, [])), False
+
+    return await replica_loads.get(chat_id, load)
+
+
+async def warm_replica():
+    """Загружает таблицы всех активных групп при запуске, чтобы первые /stat отвечались сразу"""
+    try:
+        groups = await load_members()
+    except Exception as e:
+        logger.error(f"Не удалось загрузить таблицы лидеров при запуске: {e}")
+        return
+    for chat_id, members in groups.items():
+        # Чат, загруженный по запросу, пока шла общая загрузка, не перезаписываем
+        if chat_id not in replica.boards:
+            replica.load(chat_id, members)
+    logger.info(f"Таблицы лидеров загружены: групп {len(groups)}, участников {sum(map(len, groups.values()))}")
+
+
+def display_member(member):
+    return f"@{member.username}" if member.username else member.first_name
+
+
+def format_last_activity(member):
+    if not member.last_activity:
+        return "нет данных"
+    return member.last_activity.astimezone(MOSCOW_TZ).strftime('%d.%m.%Y %H:%M')
+
+
+def format_board(board):
+    """Текст /stat по таблице лидеров - в том же виде, что отдает Django"""
+    if not len(board):
+        return "В этой группе пока нет статистики."
+    today = moscow_day()
+    lines = ["📊 <b>Статистика пользователей в группе:</b>\n\n"]
+    for i, member in enumerate(board, 1):
+        lines.append(
+            f"{i}. <b>{display_member(member)}</b>\n"
+            f"   🏆 {member.rank or 'Нет звания'}\n"
+            f"   📈 Рейтинг: {member.rating}\n"
+            f"   💬 Сообщений: {member.message_count}\n"
+            f"   🔥 Непрерывных дней: {effective_streak(member.streak, member.streak_day, today)}\n"
+            f"   ⏰ Был активен: {format_last_activity(member)}\n\n"
         )
+    return ''.join(lines)
+
+
+@dp.message_handler(commands=['stat'])
+async def stat_command(message: Message):
+    """Обработчик команды /stat - показывает статистику пользователей в группе"""
+    try:
+        logger.info(f"Получена команда stat от {message.from_user.first_name} в чате {message.chat.title} (тип: {message.chat.type})")
+        
+        # Проверяем, что команда вызвана в группе
+        if message.chat.type not in [ChatType.GROUP, ChatType.SUPERGROUP]:
+            logger.info(f"Команда stat вызвана не в группе: {message.chat.type}")
+            await message.reply("Эта команда работает только в группах!")
+            return
         
-        if rating_row:
-            rating_id = rating_row['id']
-            current_rating = rating_row['rating']
-            coefficient = rating_row['coefficient']
+        board = await chat_board(message.chat.id)
+        if board is not None:
+            stat_text = format_board(board)
         else:
-            # Создаем новый рейтинг
-            rating_id = await conn.fetchval(
-                """
-                INSERT INTO friend_bot_rating (user_id, group_id, rating, coefficient, last_updated)
-                VALUES ($1, $2, $3, $4, $5)
-                RETURNING id
-                """,
-                user_id, group_id, 0, 1, datetime.now()
-            )
-            current_rating = 0
-            coefficient = 1
+            # Одновременные /stat одного чата ждут один запрос, ответ кэшируется до новых сообщений чата
+            stat_text = await stat_cache.get(message.chat.id, lambda: load_statistics(message.chat.id))
+        await message.reply(stat_text, parse_mode='HTML')
+        logger.info(f"Статистика успешно отправлена")
+            
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики: {e}")
+        import traceback
+        traceback.print_exc()
+        await message.reply("❌ Произошла ошибка при получении статистики.")
+
+
+async def load_statistics(chat_id):
+    """Текст статистики группы из Django API, при его недоступности - из БД; возвращает (текст, можно ли кэшировать)"""
+    try:
+        # URL для получения статистики (нужно создать соответствующий endpoint в Django)
+        api_url = DJANGO_API_URL.replace('/api/ingest/message/', '/api/statistics/')
         
-        # Вычисляем очки за сообщение (берем из БД таблицы friend_bot_messagetypepoints)
-        base_points = await get_points_for_type(message_type)
-        points = base_points * coefficient
-        new_rating = current_rating + points
+        logger.info(f"Запрос к Django API: {api_url}")
         
-        # Обновляем рейтинг
-        await conn.execute(
-            "UPDATE friend_bot_rating SET rating = $1, last_updated = $2 WHERE id = $3",
-            new_rating, datetime.now(), rating_id
-        )
+        # Данные для запроса
+        data = {
+            'chat_id': chat_id,
+            'auth_token': INGEST_TOKEN
+        }
         
-    finally:
-        await conn.close()
+        session = django_session('command')
+        async with session.post(api_url, json=data) as response:
+            if response.status != 200:
+                logger.error(f"API вернул статус {response.status}")
+                return "❌ Не удалось получить статистику", False
+            result = await response.json()
+        
+        if not result.get('success'):
+            logger.error(f"API вернул ошибку: {result}")
+            return "❌ Ошибка при получении статистики", False
+        return result.get('statistics', 'Статистика недоступна'), True
+                    
+    except Exception as e:
+        logger.error(f"Ошибка при запросе к Django API: {e}")
+    
+    # Fallback: пытаемся получить статистику напрямую из БД
+    logger.info("Пробуем получить статистику напрямую из БД...")
+    try:
+        return await load_statistics_from_db(chat_id), True
+    except Exception as db_error:
+        logger.error(f"Ошибка при получении статистики из БД: {db_error}")
+        return "❌ Произошла ошибка при получении статистики.", False
 
 
-async def update_daily_checkin(user_id: int, group_id: int):
-    """Обновляет ежедневный чекин пользователя"""
+async def load_statistics_from_db(chat_id):
+    """Текст статистики группы прямо из БД"""
     conn = await get_db_connection()
     try:
-        # Получаем или создаем чекин
-        checkin_row = await conn.fetchrow(
-            "SELECT id, consecutive_days, last_checkin FROM friend_bot_dailycheckin WHERE user_id = $1 AND group_id = $2",
-            user_id, group_id
-        )
+        logger.info(f"Подключение к БД установлено, ищем группу с telegram_id: {chat_id}")
+        
+        # Получаем всех пользователей по рейтингу; время активности берем из участника, а не из всех сообщений
+        rows = await conn.fetch("""
+            SELECT 
+                u.first_name,
+                u.username,
+                uig.rating,
+                uig.message_count,
+                uig.coefficient,
+                uig.last_activity,
+                r.name as rank_name,
+                COALESCE(dc.consecutive_days, 0) as consecutive_days
+            FROM friend_bot_useringroup uig
+            JOIN friend_bot_user u ON uig.user_id = u.id
+            LEFT JOIN friend_bot_rank r ON uig.rank_id = r.id
+            LEFT JOIN friend_bot_dailycheckin dc ON dc.user_id = u.id AND dc.group_id = uig.group_id
+            WHERE uig.group_id = (
+                SELECT id FROM friend_bot_telegramgroup WHERE telegram_id = $1
+            )
+            AND uig.is_active = true
+            ORDER BY uig.rating DESC
+        """, chat_id)
+        
+        logger.info(f"Найдено пользователей в группе: {len(rows)}")
+        
+        if not rows:
+            return "В этой группе пока нет статистики."
+        
+        # Формируем сообщение со статистикой
+        stat_text = "📊 <b>Статистика пользователей в группе:</b>\n\n"
         
-        # Используем московское время для соответствия Django
         moscow_tz = pytz.timezone('Europe/Moscow')
-        now = datetime.now(moscow_tz)
-        today = now.date()
         
-        if checkin_row:
-            checkin_id = checkin_row['id']
-            consecutive_days = checkin_row['consecutive_days']
-            last_checkin = checkin_row['last_checkin']
-            
-            if last_checkin:
-                last_date = last_checkin.date()
-                days_diff = (today - last_date).days
-                
-                if days_diff == 1:
-                    # Следующий день - увеличиваем счетчик
-                    consecutive_days += 1
-                elif days_diff > 1:
-                    # Прошло больше дня - сбрасываем счетчик
-                    consecutive_days = 0
+        for i, row in enumerate(rows, 1):
+            username = f"@{row['username']}" if row['username'] else row['first_name']
+            rank_name = row['rank_name'] if row['rank_name'] else "Нет звания"
+            coefficient = f"{row['coefficient']:.1f}x"
+            consecutive_days = row['consecutive_days'] or 0
+            last_activity = row['last_activity']
+
+            # Форматируем дату последней активности (московское время)
+            if last_activity:
+                try:
+                    # asyncpg возвращает datetime объекты, которые могут быть naive или aware
+                    if isinstance(last_activity, datetime):
+                        logger.debug(f"DEBUG: Исходная дата для {username}: {last_activity}, tzinfo: {last_activity.tzinfo}")
+                        
+                        # Если дата без timezone, предполагаем что это UTC (стандарт для PostgreSQL)
+                        if last_activity.tzinfo is None:
+                            utc_tz = pytz.UTC
+                            last_activity = utc_tz.localize(last_activity)
+                            logger.debug(f"DEBUG: Локализовали в UTC: {last_activity}")
+                        else:
+                            # Если timezone уже есть, убеждаемся что это UTC (конвертируем если нужно)
+                            if last_activity.tzinfo != pytz.UTC:
+                                # Конвертируем в UTC сначала, если это другой timezone
+                                last_activity = last_activity.astimezone(pytz.UTC)
+                                logger.debug(f"DEBUG: Конвертировали в UTC: {last_activity}")
+                        
+                        # Костыльное решение: добавляем 3 часа для московского времени (UTC+3)
+                        last_activity_moscow = last_activity + timedelta(hours=3)
+                        logger.debug(f"DEBUG: После добавления 3 часов: {last_activity_moscow}")
+                        last_activity_str = last_activity_moscow.strftime('%d.%m.%Y %H:%M')
+                        logger.debug(f"DEBUG: Итоговая строка для {username}: {last_activity_str}")
+                    else:
+                        # Если это не datetime объект, просто преобразуем в строку
+                        last_activity_str = str(last_activity)
+                except Exception as e:
+                    logger.error(f"Ошибка форматирования даты для пользователя {username}: {e}, raw: {last_activity}, type: {type(last_activity)}")
+                    last_activity_str = str(last_activity) if last_activity else "нет данных"
+            else:
+                last_activity_str = "нет данных"
             
-            # Обновляем чекин
-            await conn.execute(
-                "UPDATE friend_bot_dailycheckin SET consecutive_days = $1, last_checkin = $2 WHERE id = $3",
-                consecutive_days, now, checkin_id
+            stat_text += (
+                f"{i}. <b>{username}</b>\n"
+                f"   🏆 {rank_name}\n"
+                f"   📈 Рейтинг: {row['rating']}\n"
+                f"   💬 Сообщений: {row['message_count']}\n"
+                f"   ⚡ Коэффициент: {coefficient}\n"
+                f"   🔥 Непрерывных дней: {consecutive_days}\n"
+                f"   ⏰ Был активен: {last_activity_str}\n\n"
             )
-        else:
-            # Создаем новый чекин
-            await conn.execute(
-                """
-                INSERT INTO friend_bot_dailycheckin (user_id, group_id, consecutive_days, last_checkin)
-                VALUES ($1, $2, $3, $4)
-                """,
-                user_id, group_id, 1, now
+        
+        # Добавляем общую статистику группы
+        group_stats = await conn.fetchrow("""
+            SELECT 
+                COUNT(DISTINCT uig.user_id) as total_users,
+                SUM(uig.message_count) as total_messages,
+                AVG(uig.rating) as avg_rating
+            FROM friend_bot_useringroup uig
+            WHERE uig.group_id = (
+                SELECT id FROM friend_bot_telegramgroup WHERE telegram_id = $1
             )
+        """, chat_id)
         
-        # Обновляем коэффициент в рейтинге
-        await conn.execute(
-            """
-            UPDATE friend_bot_rating 
-            SET coefficient = GREATEST(1, (SELECT consecutive_days FROM friend_bot_dailycheckin WHERE user_id = $1 AND group_id = $2) / 7 + 1)
-            WHERE user_id = $1 AND group_id = $2
-            """,
-            user_id, group_id
-        )
+        if group_stats:
+            stat_text += (
+                f"📈 <b>Общая статистика группы:</b>\n"
+                f"👥 Пользователей: {group_stats['total_users']}\n"
+                f"💬 Всего сообщений: {group_stats['total_messages']}\n"
+                f"📊 Средний рейтинг: {int(group_stats['avg_rating'] or 0)}"
+            )
+        
+        logger.info(f"Статистика сформирована, длина {len(stat_text)} символов")
         
+        return stat_text
     finally:
         await conn.close()
 
 
-async def get_points_for_type(message_type: str) -> int:
-    """Возвращает базовые очки за тип сообщения из таблицы friend_bot_messagetypepoints (по умолчанию 5)."""
-    conn = await get_db_connection()
+@dp.message_handler(commands=['me'])
+async def me_command(message: Message):
+    """Обработчик команды /me - место, рейтинг и серия участника в группе"""
     try:
-        row = await conn.fetchrow(
-            "SELECT points FROM friend_bot_messagetypepoints WHERE message_type = $1",
-            message_type
-        )
-        if row and row.get('points') is not None:
-            return int(row['points'])
-        return 5
-    finally:
-        await conn.close()
+        if message.chat.type not in [ChatType.GROUP, ChatType.SUPERGROUP]:
+            await message.reply("Эта команда работает только в группах!")
+            return
 
+        board = await chat_board(message.chat.id)
+        if board is None:
+            await message.reply("❌ Не удалось получить статистику")
+            return
+        member = board.members.get(message.from_user.id)
+        if member is None:
+            await message.reply("Вас пока нет в статистике этой группы — напишите что-нибудь!")
+            return
 
-@dp.message_handler(commands=['start'])
-async def start_command(message: Message):
-    """Обработчик команды /start"""
-    await message.reply("Привет! Я бот для отслеживания активности в группах. Просто отправляй сообщения, и я буду их записывать!")
+        text = (
+            f"👤 <b>{display_member(member)}</b>\n"
+            f"🏆 {member.rank or 'Нет звания'}\n"
+            f"📈 Рейтинг: {member.rating} — {board.position(member.user_id)} место из {len(board)}\n"
+            f"💬 Сообщений: {member.message_count}\n"
+            f"🔥 Непрерывных дней: {effective_streak(member.streak, member.streak_day, moscow_day())}\n"
+        )
+        above = board.neighbour_above(member.user_id)
+        if above:
+            text += f"⬆️ До {display_member(above)}: {above.rating - member.rating + 1} очков\n"
+        await message.reply(text, parse_mode='HTML')
 
+    except Exception as e:
+        logger.error(f"Ошибка при обработке /me: {e}")
+        await message.reply("❌ Произошла ошибка при получении статистики.")
 
-@dp.message_handler(commands=['stat'])
-async def stat_command(message: Message):
-    """Обработчик команды /stat - показывает статистику пользователей в группе"""
+
+@dp.message_handler(commands=['friends'])
+async def friends_command(message: Message):
+    """Обработчик команды /friends - лучшие друзья пользователя и граф общения группы"""
     try:
-        logger.info(f"Получена команда stat от {message.from_user.first_name} в чате {message.chat.title} (тип: {message.chat.type})")
-        
-        # Проверяем, что команда вызвана в группе
         if message.chat.type not in [ChatType.GROUP, ChatType.SUPERGROUP]:
-            logger.info(f"Команда stat вызвана не в группе: {message.chat.type}")
             await message.reply("Эта команда работает только в группах!")
             return
-        
-        logger.info(f"Команда stat вызвана в группе, продолжаем обработку")
-        
-        # Получаем статистику через Django API
-        try:
-            import aiohttp
-            
-            # URL для получения статистики (нужно создать соответствующий endpoint в Django)
-            api_url = DJANGO_API_URL.replace('/api/ingest/message/', '/api/statistics/')
-            
-            logger.info(f"Запрос к Django API: {api_url}")
-            
-            # Данные для запроса
-            data = {
-                'chat_id': message.chat.id,
-                'auth_token': INGEST_TOKEN
-            }
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.post(api_url, json=data) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        
-                        if result.get('success'):
-                            stat_text = result.get('statistics', 'Статистика недоступна')
-                            await message.reply(stat_text, parse_mode='HTML')
-                            logger.info(f"Статистика успешно отправлена")
-                        else:
-                            await message.reply("❌ Ошибка при получении статистики")
-                            logger.error(f"API вернул ошибку: {result}")
-                    else:
-                        await message.reply("❌ Не удалось получить статистику")
-                        logger.error(f"API вернул статус {response.status}")
-                        
-        except Exception as e:
-            logger.error(f"Ошибка при запросе к Django API: {e}")
-            import traceback
-            traceback.print_exc()
-            
-            # Fallback: пытаемся получить статистику напрямую из БД
-            logger.info("Пробуем получить статистику напрямую из БД...")
-            try:
-                conn = await get_db_connection()
-                try:
-                    logger.info(f"Подключение к БД установлено, ищем группу с telegram_id: {message.chat.id}")
-                    
-                    # Получаем всех пользователей по рейтингу
-                    rows = await conn.fetch("""
-                        SELECT 
-                            u.first_name,
-                            u.username,
-                            uig.rating,
-                            uig.message_count,
-                            uig.coefficient,
-                            MAX(m.date) as last_activity,
-                            r.name as rank_name,
-                            COALESCE(dc.consecutive_days, 0) as consecutive_days
-                        FROM friend_bot_useringroup uig
-                        JOIN friend_bot_user u ON uig.user_id = u.id
-                        LEFT JOIN friend_bot_rank r ON uig.rank_id = r.id
-                        LEFT JOIN friend_bot_dailycheckin dc ON dc.user_id = u.id AND dc.group_id = uig.group_id
-                        LEFT JOIN friend_bot_message m ON m.user_id = u.id AND m.chat_id = uig.group_id
-                        WHERE uig.group_id = (
-                            SELECT id FROM friend_bot_telegramgroup WHERE telegram_id = $1
-                        )
-                        AND uig.is_active = true
-                        GROUP BY u.id, u.first_name, u.username, uig.rating, uig.message_count, uig.coefficient, r.name, dc.consecutive_days
-                        ORDER BY uig.rating DESC
-                    """, message.chat.id)
-                    
-                    logger.info(f"Найдено пользователей в группе: {len(rows)}")
-                    
-                    if not rows:
-                        await message.reply("В этой группе пока нет статистики.")
-                        return
-                    
-                    # Формируем сообщение со статистикой
-                    stat_text = "📊 <b>Статистика пользователей в группе:</b>\n\n"
-                    
-                    moscow_tz = pytz.timezone('Europe/Moscow')
-                    
-                    for i, row in enumerate(rows, 1):
-                        username = f"@{row['username']}" if row['username'] else row['first_name']
-                        rank_name = row['rank_name'] if row['rank_name'] else "Нет звания"
-                        coefficient = f"{row['coefficient']:.1f}x"
-                        consecutive_days = row['consecutive_days'] or 0
-                        last_activity = row['last_activity']
-
-                        # Форматируем дату последней активности (московское время)
-                        if last_activity:
-                            try:
-                                # asyncpg возвращает datetime объекты, которые могут быть naive или aware
-                                if isinstance(last_activity, datetime):
-                                    logger.debug(f"DEBUG: Исходная дата для {username}: {last_activity}, tzinfo: {last_activity.tzinfo}")
-                                    
-                                    # Если дата без timezone, предполагаем что это UTC (стандарт для PostgreSQL)
-                                    if last_activity.tzinfo is None:
-                                        utc_tz = pytz.UTC
-                                        last_activity = utc_tz.localize(last_activity)
-                                        logger.debug(f"DEBUG: Локализовали в UTC: {last_activity}")
-                                    else:
-                                        # Если timezone уже есть, убеждаемся что это UTC (конвертируем если нужно)
-                                        if last_activity.tzinfo != pytz.UTC:
-                                            # Конвертируем в UTC сначала, если это другой timezone
-                                            last_activity = last_activity.astimezone(pytz.UTC)
-                                            logger.debug(f"DEBUG: Конвертировали в UTC: {last_activity}")
-                                    
-                                    # Костыльное решение: добавляем 3 часа для московского времени (UTC+3)
-                                    last_activity_moscow = last_activity + timedelta(hours=3)
-                                    logger.debug(f"DEBUG: После добавления 3 часов: {last_activity_moscow}")
-                                    last_activity_str = last_activity_moscow.strftime('%d.%m.%Y %H:%M')
-                                    logger.debug(f"DEBUG: Итоговая строка для {username}: {last_activity_str}")
-                                else:
-                                    # Если это не datetime объект, просто преобразуем в строку
-                                    last_activity_str = str(last_activity)
-                            except Exception as e:
-                                logger.error(f"Ошибка форматирования даты для пользователя {username}: {e}, raw: {last_activity}, type: {type(last_activity)}")
-                                last_activity_str = str(last_activity) if last_activity else "нет данных"
-                        else:
-                            last_activity_str = "нет данных"
-                        
-                        stat_text += (
-                            f"{i}. <b>{username}</b>\n"
-                            f"   🏆 {rank_name}\n"
-                            f"   📈 Рейтинг: {row['rating']}\n"
-                            f"   💬 Сообщений: {row['message_count']}\n"
-                            f"   ⚡ Коэффициент: {coefficient}\n"
-                            f"   🔥 Непрерывных дней: {consecutive_days}\n"
-                            f"   ⏰ Был активен: {last_activity_str}\n\n"
-                        )
-                    
-                    # Добавляем общую статистику группы
-                    group_stats = await conn.fetchrow("""
-                        SELECT 
-                            COUNT(DISTINCT uig.user_id) as total_users,
-                            SUM(uig.message_count) as total_messages,
-                            AVG(uig.rating) as avg_rating
-                        FROM friend_bot_useringroup uig
-                        WHERE uig.group_id = (
-                            SELECT id FROM friend_bot_telegramgroup WHERE telegram_id = $1
-                        )
-                    """, message.chat.id)
-                    
-                    if group_stats:
-                        stat_text += (
-                            f"📈 <b>Общая статистика группы:</b>\n"
-                            f"👥 Пользователей: {group_stats['total_users']}\n"
-                            f"💬 Всего сообщений: {group_stats['total_messages']}\n"
-                            f"📊 Средний рейтинг: {int(group_stats['avg_rating'] or 0)}"
-                        )
-                    
-                    logger.info(f"Статистика сформирована, отправляем сообщение длиной {len(stat_text)} символов")
-                    
-                    # Отправляем статистику
-                    await message.reply(stat_text, parse_mode='HTML')
-                    logger.info(f"Статистика успешно отправлена")
-                    
-                finally:
-                    await conn.close()
-                    
-            except Exception as db_error:
-                logger.error(f"Ошибка при получении статистики из БД: {db_error}")
-                await message.reply("❌ Произошла ошибка при получении статистики.")
-            
+
+        # Ответом на сообщение можно посмотреть друзей другого участника
+        target = message.reply_to_message.from_user if message.reply_to_message else message.from_user
+
+        import aiohttp
+
+        api_url = DJANGO_API_URL.replace('/api/ingest/message/', '/api/friends/')
+        data = {
+            'chat_id': message.chat.id,
+            'user_id': target.id,
+            'auth_token': INGEST_TOKEN
+        }
+
+        session = django_session('command')
+        async with session.post(api_url, json=data) as response:
+            if response.status != 200:
+                await message.reply("❌ Не удалось получить граф общения")
+                logger.error(f"API вернул статус {response.status}")
+                return
+            result = await response.json()
+
+        if result.get('success'):
+            await message.reply(result.get('text', 'Данных пока нет'), parse_mode='HTML')
+        else:
+            await message.reply("❌ Ошибка при получении графа общения")
+            logger.error(f"API вернул ошибку: {result}")
+
     except Exception as e:
-        logger.error(f"Ошибка при получении статистики: {e}")
-        import traceback
-        traceback.print_exc()
-        await message.reply("❌ Произошла ошибка при получении статистики.")
+        logger.error(f"Ошибка при получении графа общения: {e}")
+        await message.reply("❌ Произошла ошибка при получении графа общения.")
 
 
 # Общий обработчик сообщений - должен быть в конце, чтобы не перехватывать команды
@@ -502,18 +614,52 @@ async def handle_all_messages(message: Message):
         logger.error(f"Ошибка при обработке сообщения: {e}")
 
 
+async def on_startup():
+    """Подготовка перед приемом обновлений"""
+    if embedded:
+        # Если БД еще не поднялась, пул откроется при первом сообщении, а пока сообщения копятся в журнале
+        try:
+            await embedded.open()
+        except RETRYABLE_ERRORS as e:
+            logger.error(f"БД недоступна при запуске: {e!r}")
+    await spool.open()
+    # Таблицы лидеров грузятся в фоне: бот начинает принимать обновления сразу
+    asyncio.create_task(warm_replica())
+
+
+async def on_shutdown():
+    """Завершение после обработки принятых обновлений"""
+    await spool.close()
+    if embedded:
+        await embedded.close()
+    for session in django_sessions.values():
+        await session.close()
+
+
 async def main():
     """Главная функция"""
     logger.info("Запуск Telegram бота...")
     
     try:
+        await on_startup()
         # Запускаем бота
         await dp.start_polling()
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
     finally:
+        await dp.drain()
+        await on_shutdown()
         await bot.session.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if BOT_MODE == 'webhook':
+        from webhook import run_webhook
+        logger.info("Запуск Telegram бота в режиме вебхука...")
+        run_webhook(
+            dp, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT,
+            public_url=WEBHOOK_HOST, max_connections=WEBHOOK_MAX_CONNECTIONS,
+            on_startup=on_startup, on_shutdown=on_shutdown
+        )
+    else:
+        asyncio.run(main())
@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+
+class ChatCache:
+    """Кэш ответов по чатам с объединением одновременных запросов (single-flight).
+
+    Пока ответ для чата загружается, остальные запросы этого чата ждут ту же загрузку.
+    Готовый ответ живет ttl секунд или до invalidate - например, когда в чат пришли
+    новые сообщения и статистика устарела.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._values = {}
+        self._loading = {}
+        # Номер версии данных чата: ответ, начатый до invalidate, в кэш не попадет
+        self._versions = {}
+
+    def invalidate(self, chat_id):
+        self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+        self._values.pop(chat_id, None)
+
+    async def get(self, chat_id, load):
+        """Ответ для чата: из кэша, из уже идущей загрузки или из новой загрузки load().
+
+        load - корутина без аргументов, возвращающая (значение, можно ли кэшировать).
+        """
+        cached = self._values.get(chat_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        loading = self._loading.get(chat_id)
+        if loading:
+            return await asyncio.shield(loading)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[chat_id] = future
+        version = self._versions.get(chat_id, 0)
+        try:
+            value, cacheable = await load()
+        except BaseException as e:
+            future.set_exception(e)
+            # Ошибку получат ждущие запросы; без них asyncio не должен ругаться на необработанное исключение
+            future.exception()
+            raise
+        finally:
+            del self._loading[chat_id]
+        future.set_result(value)
+        if cacheable and self.ttl and version == self._versions.get(chat_id, 0):
+            self._values[chat_id] = (time.monotonic() + self.ttl, value)
+        return value
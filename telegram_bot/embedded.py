@@ -0,0 +1,294 @@
+import asyncio
+from datetime import datetime
+import asyncpg
+import pytz
+from scoring import (
+    DEFAULT_POINTS, MOSCOW_TZ, advance_streak, coefficient_for_streak, effective_streak, message_points, moscow_day,
+    rank_for_rating,
+)
+
+
+# Ошибки, после которых сообщение стоит повторить позже: БД недоступна, перегружена или откатила транзакцию
+RETRYABLE_ERRORS = (
+    OSError, asyncio.TimeoutError, asyncpg.exceptions.InterfaceError, asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.CannotConnectNowError, asyncpg.exceptions.TooManyConnectionsError,
+    asyncpg.exceptions.TransactionRollbackError,
+    # Схема еще не готова: бот стартует раньше makemigrations/migrate и во время миграции после деплоя
+    asyncpg.exceptions.UndefinedTableError, asyncpg.exceptions.UndefinedColumnError,
+    asyncpg.exceptions.OperatorInterventionError, asyncpg.exceptions.InsufficientResourcesError,
+)
+
+# Ошибки в самом сообщении: повтор не поможет
+PAYLOAD_ERRORS = (
+    asyncpg.exceptions.DataError, asyncpg.exceptions.IntegrityConstraintViolationError, ValueError, KeyError,
+)
+
+# Поля, которых нет в запросе (None), не трогаются - как в IngestMessageView
+UPSERT_USER = """
+    INSERT INTO friend_bot_user (telegram_id, first_name, last_name, username, is_active, created_at)
+    VALUES ($1, COALESCE($2, ''), COALESCE($3, ''), COALESCE($4, ''), true, $5)
+    ON CONFLICT (telegram_id) DO UPDATE
+    SET first_name = COALESCE($2, friend_bot_user.first_name),
+        last_name = COALESCE($3, friend_bot_user.last_name),
+        username = COALESCE($4, friend_bot_user.username)
+    WHERE (friend_bot_user.first_name, friend_bot_user.last_name, friend_bot_user.username)
+        IS DISTINCT FROM (COALESCE($2, friend_bot_user.first_name), COALESCE($3, friend_bot_user.last_name),
+                          COALESCE($4, friend_bot_user.username))
+    RETURNING id, first_name, username
+"""
+
+# Название группы обновляется, только если бот его знает ($3)
+UPSERT_GROUP = """
+    INSERT INTO friend_bot_telegramgroup (telegram_id, title, is_active)
+    VALUES ($1, $2, true)
+    ON CONFLICT (telegram_id) DO UPDATE SET title = EXCLUDED.title
+    WHERE $3 AND friend_bot_telegramgroup.title IS DISTINCT FROM EXCLUDED.title
+    RETURNING id
+"""
+
+INSERT_MEMBER = """
+    INSERT INTO friend_bot_useringroup (user_id, group_id, rating, message_count, coefficient, joined_at, last_activity, is_active)
+    VALUES ($1, $2, 0, 0, 0.5, $3, $3, true)
+    ON CONFLICT (user_id, group_id) DO NOTHING
+"""
+
+# Строка участника блокируется до конца транзакции: параллельные сообщения не теряют очки
+SELECT_MEMBER = """
+    SELECT id, rating, message_count, rank_id, coefficient, last_activity, is_active
+    FROM friend_bot_useringroup WHERE user_id = $1 AND group_id = $2
+    FOR UPDATE
+"""
+
+INSERT_MESSAGE = """
+    INSERT INTO friend_bot_message (telegram_id, chat_id, user_id, date, message_type, text, related_message)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (chat_id, telegram_id) DO NOTHING
+    RETURNING id
+"""
+
+UPDATE_DUPLICATE = """
+    UPDATE friend_bot_message SET message_type = $3, text = COALESCE($4, text)
+    WHERE chat_id = $1 AND telegram_id = $2 AND (message_type, text) IS DISTINCT FROM ($3, COALESCE($4, text))
+"""
+
+UPSERT_INTERACTION = """
+    INSERT INTO friend_bot_interaction (group_id, from_user_id, to_user_id, reply_count, last_at)
+    VALUES ($1, $2, $3, 1, $4)
+    ON CONFLICT (group_id, from_user_id, to_user_id) DO UPDATE
+    SET reply_count = friend_bot_interaction.reply_count + 1,
+        last_at = GREATEST(friend_bot_interaction.last_at, EXCLUDED.last_at)
+"""
+
+SELECT_CHECKIN = """
+    SELECT id, consecutive_days, last_checkin, last_checkin_day
+    FROM friend_bot_dailycheckin WHERE user_id = $1 AND group_id = $2
+    FOR UPDATE
+"""
+
+UPSERT_HISTOGRAM = """
+    INSERT INTO friend_bot_scorehistogram (group_id, user_id, message_type, streak, count)
+    VALUES ($1, $2, $3, $4, 1)
+    ON CONFLICT (group_id, user_id, message_type, streak) DO UPDATE
+    SET count = friend_bot_scorehistogram.count + 1
+"""
+
+
+def parse_message_date(value):
+    """Дата сообщения из date_iso; время без пояса считается московским, как в DRF при TIME_ZONE проекта"""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = MOSCOW_TZ.localize(moment)
+    return moment
+
+
+def checkin_last_day(checkin):
+    """Московский номер дня последнего чекина (как DailyCheckin.get_last_day)"""
+    if checkin['last_checkin_day'] is not None:
+        return checkin['last_checkin_day']
+    return moscow_day(checkin['last_checkin']) if checkin['last_checkin'] else None
+
+
+def member_snapshot(user, member, rank_name, consecutive_days, last_day):
+    """То же состояние участника, что отдает IngestMessageView (friend_bot.members.member_snapshot)"""
+    return {
+        'user_telegram_id': user['telegram_id'],
+        'username': user['username'],
+        'first_name': user['first_name'],
+        'rating': member['rating'],
+        'rank': rank_name,
+        'message_count': member['message_count'],
+        'streak': consecutive_days,
+        'streak_day': last_day,
+        'last_activity': member['last_activity'].isoformat() if member['last_activity'] else None,
+        'is_active': member['is_active'],
+    }
+
+
+class EmbeddedIngest:
+    """Прием сообщений прямо в БД через asyncpg - та же транзакция, что в IngestMessageView, без HTTP и Django.
+
+    Очки, серии и звания считаются общими правилами из scoring.py. Схема базы - миграции Django,
+    поэтому Django все равно нужен для миграций, админки и команд, но не для каждого сообщения.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+
+    async def open(self):
+        if self.pool is None:
+            self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+        return self.pool
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def ingest(self, payload):
+        """Записывает сообщение и начисляет очки.
+
+        Возвращает ответ в формате IngestMessageView ('member', 'old_rating' или 'duplicate')
+        и 'rank_change' - {'old': (название, порог) или None, 'new': (название, порог)}, если звание сменилось.
+        """
+        pool = await self.open()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                return await self._ingest(conn, payload)
+
+    async def _ingest(self, conn, payload):
+        now = datetime.now(pytz.utc)
+        today = moscow_day(now)
+        date = parse_message_date(payload['date_iso'])
+        chat_title = payload.get('chat_title') or ''
+
+        user = await conn.fetchrow(
+            UPSERT_USER, payload['user_telegram_id'], payload.get('user_first_name'),
+            payload.get('user_last_name'), payload.get('user_username'), now
+        )
+        if user is None:
+            user = await conn.fetchrow(
+                "SELECT id, first_name, username FROM friend_bot_user WHERE telegram_id = $1", payload['user_telegram_id']
+            )
+        user = dict(user, telegram_id=payload['user_telegram_id'])
+        user_id = user['id']
+
+        group_id = await conn.fetchval(
+            UPSERT_GROUP, payload['chat_telegram_id'], chat_title or f"Group {payload['chat_telegram_id']}", bool(chat_title)
+        )
+        if group_id is None:
+            group_id = await conn.fetchval("SELECT id FROM friend_bot_telegramgroup WHERE telegram_id = $1", payload['chat_telegram_id'])
+
+        await conn.execute(INSERT_MEMBER, user_id, group_id, now)
+        member = dict(await conn.fetchrow(SELECT_MEMBER, user_id, group_id))
+        ranks = await conn.fetch("SELECT id, name, required_rating FROM friend_bot_rank ORDER BY required_rating, id")
+        ranks_by_id = {rank['id']: rank for rank in ranks}
+        checkin = await conn.fetchrow(SELECT_CHECKIN, user_id, group_id)
+
+        message_type = payload['message_type']
+        text = payload.get('text')
+        message_id = await conn.fetchval(
+            INSERT_MESSAGE, payload['telegram_message_id'], group_id, user_id, date, message_type, text or '',
+            payload.get('related_telegram_message_id')
+        )
+        if message_id is None:
+            # Повторная доставка: очки не начисляются, обновляются только тип и текст
+            await conn.execute(UPDATE_DUPLICATE, group_id, payload['telegram_message_id'], message_type, text)
+            rank_name = ranks_by_id[member['rank_id']]['name'] if member['rank_id'] in ranks_by_id else None
+            consecutive_days = checkin['consecutive_days'] if checkin else 0
+            last_day = checkin_last_day(checkin) if checkin else None
+            return {
+                'status': 'ok',
+                'duplicate': True,
+                'member': member_snapshot(user, member, rank_name, consecutive_days, last_day),
+            }
+
+        # Ответ на известное сообщение другого участника - ребро в графе общения
+        related = payload.get('related_telegram_message_id')
+        if related is not None:
+            to_user_id = await conn.fetchval(
+                "SELECT user_id FROM friend_bot_message WHERE chat_id = $1 AND telegram_id = $2 LIMIT 1", group_id, related
+            )
+            if to_user_id is not None and to_user_id != user_id:
+                await conn.execute(UPSERT_INTERACTION, group_id, user_id, to_user_id, date)
+
+        # Очки по серии до сегодняшнего чекина (UserInGroup.add_message_points)
+        last_day = checkin_last_day(checkin) if checkin else None
+        streak = effective_streak(checkin['consecutive_days'], last_day, today) if checkin else 0
+        coefficient = coefficient_for_streak(streak)
+        base_points = await conn.fetchval("SELECT points FROM friend_bot_messagetypepoints WHERE message_type = $1", message_type)
+        base_points = int(base_points) if base_points is not None else DEFAULT_POINTS
+        points = message_points(base_points, coefficient)
+
+        old_rating = member['rating']
+        old_rank_id = member['rank_id']
+        member['rating'] += points
+        member['message_count'] += 1
+        member['last_activity'] = now
+        new_rank_id = rank_for_rating([(rank['required_rating'], rank['id']) for rank in ranks], member['rating'])
+        if new_rank_id:
+            member['rank_id'] = new_rank_id
+
+        await conn.execute(
+            "INSERT INTO friend_bot_pointsledger (message_id, group_id, user_id, base_points, coefficient, awarded, date) "
+            "VALUES ($1, $2, $3, $4, $5, $6, $7)",
+            message_id, group_id, user_id, base_points, coefficient, points, date
+        )
+        await conn.execute(UPSERT_HISTOGRAM, group_id, user_id, message_type, streak)
+
+        # Чекин дня (DailyCheckin.update_checkin): первый чекин серию не начинает
+        if checkin is None:
+            consecutive_days = 0
+            await conn.execute(
+                "INSERT INTO friend_bot_dailycheckin (user_id, group_id, consecutive_days, last_checkin, last_checkin_day) "
+                "VALUES ($1, $2, 0, $3, $4)",
+                user_id, group_id, now, today
+            )
+        elif last_day != today:
+            consecutive_days = advance_streak(checkin['consecutive_days'], last_day, today)
+            await conn.execute(
+                "UPDATE friend_bot_dailycheckin SET consecutive_days = $2, last_checkin = $3, last_checkin_day = $4 WHERE id = $1",
+                checkin['id'], consecutive_days, now, today
+            )
+        else:
+            consecutive_days = checkin['consecutive_days']
+        member['coefficient'] = coefficient_for_streak(consecutive_days)
+
+        await conn.execute(
+            "UPDATE friend_bot_useringroup SET rating = $2, message_count = $3, last_activity = $4, rank_id = $5, coefficient = $6 "
+            "WHERE id = $1",
+            member['id'], member['rating'], member['message_count'], now, member['rank_id'], member['coefficient']
+        )
+
+        result = {
+            'status': 'ok',
+            'member': member_snapshot(
+                user, member, ranks_by_id[member['rank_id']]['name'] if member['rank_id'] else None, consecutive_days, today
+            ),
+            'old_rating': old_rating,
+        }
+        if member['rank_id'] != old_rank_id:
+            old_rank = ranks_by_id.get(old_rank_id)
+            new_rank = ranks_by_id[member['rank_id']]
+            result['rank_change'] = {
+                'user_id': user_id,
+                'group_id': group_id,
+                'old_rank_id': old_rank_id if old_rank else None,
+                'new_rank_id': new_rank['id'],
+                'old': (old_rank['name'], old_rank['required_rating']) if old_rank else None,
+                'new': (new_rank['name'], new_rank['required_rating']),
+            }
+        return result
+
+    async def queue_rank_notification(self, rank_change):
+        """Ставит неотправленное уведомление о звании в очередь команды send_rank_notifications"""
+        pool = await self.open()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO friend_bot_ranknotification (group_id, user_id, old_rank_id, new_rank_id, created_at, attempts) "
+                "VALUES ($1, $2, $3, $4, $5, 0)",
+                rank_change['group_id'], rank_change['user_id'], rank_change['old_rank_id'], rank_change['new_rank_id'],
+                datetime.now(pytz.utc)
+            )
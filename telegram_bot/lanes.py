@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import time
+from collections import deque
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.filters import Command
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update: types.Update):
+    """Чат, к которому относится обновление; для обновлений без чата - пользователь или само обновление"""
+    message = (
+        update.message or update.edited_message or update.channel_post or update.edited_channel_post
+        or (update.callback_query and update.callback_query.message)
+    )
+    if message:
+        return message.chat.id
+    for chat_update in (update.my_chat_member, update.chat_member, update.chat_join_request):
+        if chat_update:
+            return chat_update.chat.id
+    for event in (update.callback_query, update.inline_query, update.chosen_inline_result, update.poll_answer):
+        user = event and (getattr(event, 'from_user', None) or getattr(event, 'user', None))
+        if user:
+            return user.id
+    return update.update_id
+
+
+def is_priority(update: types.Update, commands=(), username=None):
+    """Нажатия кнопок и команды, у которых есть обработчик, - их ответа ждет человек.
+
+    Чужие и неизвестные команды (/foo, /stat@otherbot) попадают в общий обработчик сообщений
+    и начисляют очки, поэтому идут в полосу чата вместе с остальными сообщениями.
+    """
+    if update.callback_query:
+        return True
+    if not (update.message and update.message.is_command()):
+        return False
+    command, _, mention = update.message.get_full_command()[0][1:].partition('@')
+    if mention and (not username or mention.lower() != username.lower()):
+        return False
+    return command.lower() in commands
+
+
+class LatencyStats:
+    """Время от приема обновления до конца обработки: скользящее окно для процентилей"""
+
+    def __init__(self, window=2000):
+        self.samples = deque(maxlen=window)
+        # Обработано с последнего отчета
+        self.count = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentiles(self, points=(50, 95, 99)):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {}
+        return {point: ordered[min(len(ordered) - 1, len(ordered) * point // 100)] for point in points}
+
+    def report(self):
+        """Строка для лога и сброс счетчика; None, если с прошлого отчета ничего не обработано"""
+        if not self.count:
+            return None
+        values = ' '.join(f'p{point}={value * 1000:.0f}мс' for point, value in self.percentiles().items())
+        line = f'n={self.count} {values}'
+        self.count = 0
+        return line
+
+
+class LaneDispatcher(Dispatcher):
+    """Dispatcher, который раскладывает обновления по полосам (lanes) по chat.id.
+
+    Каждая полоса - очередь с одним обработчиком, поэтому сообщения одного чата
+    обрабатываются строго по порядку (на этом держатся серии и повышения званий),
+    а разные чаты - параллельно. Заполненная очередь полосы задерживает только свои чаты.
+    Общее число обновлений в работе ограничено семафором: когда лимит исчерпан, getUpdates
+    (или ответ на запрос вебхука) задерживается - Telegram придерживает обновления у себя.
+
+    Команды, для которых зарегистрирован обработчик (фильтр commands=[...]), идут мимо полос
+    в отдельную очередь со своими обработчиками и не считаются в общем лимите, поэтому поток
+    сообщений не задерживает ответы. Порядок таких команд относительно сообщений того же чата
+    не гарантируется - на рейтинг они не влияют.
+    """
+
+    def __init__(self, bot, *args, lanes=16, lane_queue_size=100, max_in_flight=200,
+                 command_workers=8, command_queue_size=100, latency_report_interval=60, **kwargs):
+        super().__init__(bot, *args, **kwargs)
+        self.lane_count = lanes
+        self.lane_queue_size = lane_queue_size
+        self.max_in_flight = max_in_flight
+        self.command_workers = command_workers
+        self.command_queue_size = command_queue_size
+        self.latency_report_interval = latency_report_interval
+        self.latency = {'commands': LatencyStats(), 'messages': LatencyStats()}
+        self._commands = None
+        # Команды с обработчиками и имя бота для проверки /команда@бот - определяются при запуске полос
+        self._command_names = frozenset()
+        self._username = None
+        self._queues = []
+        self._workers = []
+        self._in_flight = None
+        # Обновления, ждущие места в заполненной полосе, и задачи, которые по одной переносят их в очередь
+        self._backlogs = []
+        self._feeders = {}
+
+    def registered_commands(self):
+        """Команды из фильтров commands=[...] зарегистрированных обработчиков сообщений"""
+        commands = set()
+        for handler in self.message_handlers.handlers:
+            for filter_obj in handler.filters or ():
+                if isinstance(filter_obj.filter, Command):
+                    commands.update(command.lower() for command in filter_obj.filter.commands)
+        return frozenset(commands)
+
+    def is_priority(self, update: types.Update):
+        return is_priority(update, self._command_names, self._username)
+
+    async def _start_lanes(self):
+        """Очереди и обработчики создаются в работающем цикле событий при первом обновлении"""
+        self._command_names = self.registered_commands()
+        try:
+            self._username = (await self.bot.me).username
+        except Exception as e:
+            # Без имени бота команды с упоминанием идут в полосу чата - обработчик все равно их проверит
+            logger.error(f"Не удалось узнать имя бота: {e}")
+        if self._workers:
+            # Полосы уже запустило параллельное обновление, пока ждали ответа getMe
+            return
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._queues = [asyncio.Queue(self.lane_queue_size) for _ in range(self.lane_count)]
+        self._backlogs = [deque() for _ in range(self.lane_count)]
+        self._workers = [asyncio.create_task(self._lane_worker(index, queue)) for index, queue in enumerate(self._queues)]
+        self._commands = asyncio.Queue(self.command_queue_size)
+        self._workers += [asyncio.create_task(self._command_worker()) for _ in range(self.command_workers)]
+        if self.latency_report_interval:
+            self._workers.append(asyncio.create_task(self._report_latency()))
+        logger.info(
+            f"Запущено полос обработки: {self.lane_count}, очередь {self.lane_queue_size}, в работе до {self.max_in_flight}; "
+            f"обработчиков команд: {self.command_workers}"
+        )
+
+    async def enqueue(self, update: types.Update):
+        """Ставит обновление в полосу его чата; ждет только общего лимита обновлений в работе.
+
+        Если очередь полосы полна, обновление ждет места в ней отдельно, не задерживая
+        остальные чаты: ожидающие встают в очередь полосы в том же порядке, в каком пришли.
+        """
+        if not self._workers:
+            await self._start_lanes()
+        if self.is_priority(update):
+            await self._commands.put((update, time.monotonic()))
+            return
+        await self._in_flight.acquire()
+        item = (update, time.monotonic())
+        index = update_chat_id(update) % self.lane_count
+        queue = self._queues[index]
+        backlog = self._backlogs[index]
+        if not backlog and not queue.full():
+            queue.put_nowait(item)
+            return
+        backlog.append(item)
+        if index not in self._feeders:
+            logger.warning(f"Полоса {index} заполнена ({queue.qsize()}), обновления ждут места")
+            self._feeders[index] = asyncio.create_task(self._feed_lane(index, queue, backlog))
+
+    async def _feed_lane(self, index, queue, backlog):
+        """Переносит отложенные обновления в очередь полосы по одному, сохраняя порядок"""
+        try:
+            while backlog:
+                await queue.put(backlog[0])
+                backlog.popleft()
+        finally:
+            del self._feeders[index]
+
+    async def process_updates(self, updates, fast: bool = True):
+        """Раскладывает пачку по полосам по порядку, команды - первыми; результаты обработчиков не возвращаются"""
+        if not self._workers:
+            await self._start_lanes()
+        for update in sorted(updates, key=lambda update: not self.is_priority(update)):
+            await self.enqueue(update)
+        return []
+
+    async def _lane_worker(self, index, queue):
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+        while True:
+            update, received = await queue.get()
+            try:
+                await self.updates_handler.notify(update)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке обновления {update.update_id} в полосе {index}: {e}")
+            finally:
+                self._in_flight.release()
+                queue.task_done()
+                self.latency['messages'].record(time.monotonic() - received)
+
+    async def _command_worker(self):
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+        while True:
+            update, received = await self._commands.get()
+            try:
+                await self.updates_handler.notify(update)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке команды {update.update_id}: {e}")
+            finally:
+                self._commands.task_done()
+                self.latency['commands'].record(time.monotonic() - received)
+
+    async def _report_latency(self):
+        """Периодически пишет в лог процентили задержки отдельно для команд и сообщений"""
+        while True:
+            await asyncio.sleep(self.latency_report_interval)
+            reports = [(kind, stats.report()) for kind, stats in self.latency.items()]
+            reports = [f'{kind}: {line}' for kind, line in reports if line]
+            if reports:
+                logger.info('Задержка обработки - ' + '; '.join(reports))
+
+    async def _join(self):
+        while self._feeders:
+            await asyncio.gather(*self._feeders.values())
+        await asyncio.gather(self._commands.join(), *(queue.join() for queue in self._queues))
+
+    async def drain(self, timeout=30):
+        """Дожидается обработки уже принятых обновлений и останавливает полосы"""
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._join(), timeout)
+        except asyncio.TimeoutError:
+            left = sum(queue.qsize() for queue in [self._commands, *self._queues]) + sum(map(len, self._backlogs))
+            logger.warning(f"Не дождались обработки {left} обновлений за {timeout}с")
+        tasks = [*self._feeders.values(), *self._workers]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+
+    async def start_polling(self, timeout=20, relax=0.1, limit=None, reset_webhook=None, fast: bool = True,
+                            error_sleep: int = 5, allowed_updates=None):
+        """Long polling с обратным давлением.
+
+        В отличие от Dispatcher.start_polling следующий getUpdates уходит только после того,
+        как предыдущая пачка разложена по полосам, поэтому при перегрузке бот не копит
+        обновления в памяти, а оставляет их в Telegram.
+        """
+        if self._polling:
+            raise RuntimeError('Polling already started')
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+        if reset_webhook is None:
+            await self.reset_webhook(check=False)
+        if reset_webhook:
+            await self.reset_webhook(check=True)
+
+        self._polling = True
+        offset = None
+        request_timeout = aiohttp.ClientTimeout(total=timeout + 10)
+        try:
+            while self._polling:
+                try:
+                    with self.bot.request_timeout(request_timeout):
+                        updates = await self.bot.get_updates(
+                            limit=limit, offset=offset, timeout=timeout, allowed_updates=allowed_updates
+                        )
+                except asyncio.CancelledError:
+                    break
+                except Exception as e:
+                    logger.error(f"Ошибка при получении обновлений: {e}")
+                    await asyncio.sleep(error_sleep)
+                    continue
+
+                if updates:
+                    offset = updates[-1].update_id + 1
+                    await self.process_updates(updates)
+
+                if relax:
+                    await asyncio.sleep(relax)
+        finally:
+            self._close_waiter.set_result(None)
+            logger.warning('Polling остановлен')
@@ -0,0 +1,109 @@
+import time
+from bisect import bisect_left, insort
+from datetime import datetime
+
+
+class Member:
+    """Участник в копии таблицы лидеров: компактная запись со слотами"""
+
+    __slots__ = ('user_id', 'username', 'first_name', 'rating', 'rank', 'message_count', 'streak', 'streak_day', 'last_activity')
+
+    def __init__(self, snapshot):
+        self.user_id = snapshot['user_telegram_id']
+        self.username = snapshot.get('username') or ''
+        self.first_name = snapshot.get('first_name') or ''
+        self.rating = snapshot['rating']
+        self.rank = snapshot.get('rank')
+        self.message_count = snapshot.get('message_count', 0)
+        self.streak = snapshot.get('streak', 0)
+        self.streak_day = snapshot.get('streak_day')
+        last_activity = snapshot.get('last_activity')
+        self.last_activity = datetime.fromisoformat(last_activity) if last_activity else None
+
+    @property
+    def key(self):
+        return (-self.rating, self.user_id)
+
+
+class ChatBoard:
+    """Таблица лидеров одного чата: участники по telegram_id и отсортированный список ключей (-рейтинг, id)"""
+
+    __slots__ = ('members', 'order', 'loaded_at', 'stale')
+
+    def __init__(self, snapshots):
+        self.members = {}
+        for snapshot in snapshots:
+            if snapshot.get('is_active', True):
+                member = Member(snapshot)
+                self.members[member.user_id] = member
+        self.order = sorted(member.key for member in self.members.values())
+        self.loaded_at = time.monotonic()
+        self.stale = False
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        """Участники по убыванию рейтинга"""
+        for _, user_id in self.order:
+            yield self.members[user_id]
+
+    def update(self, snapshot):
+        """Заменяет запись участника; неактивные участники из таблицы убираются"""
+        old = self.members.pop(snapshot['user_telegram_id'], None)
+        if old:
+            del self.order[bisect_left(self.order, old.key)]
+        if snapshot.get('is_active', True):
+            member = Member(snapshot)
+            self.members[member.user_id] = member
+            insort(self.order, member.key)
+
+    def position(self, user_id):
+        """Место участника (с 1) или None"""
+        member = self.members.get(user_id)
+        return bisect_left(self.order, member.key) + 1 if member else None
+
+    def neighbour_above(self, user_id):
+        """Участник на месте выше или None для лидера"""
+        position = self.position(user_id)
+        if not position or position == 1:
+            return None
+        return self.members[self.order[position - 2][1]]
+
+
+class LeaderboardReplica:
+    """Копия таблиц лидеров в памяти бота.
+
+    Загружается из Django при запуске (или при первом обращении к чату) и дальше
+    обновляется ответами на отправку сообщений. Если рейтинг участника до сообщения
+    не совпал с копией (сообщения прошли мимо этого процесса, пересчет в админке),
+    таблица чата помечается устаревшей и перезагружается при следующем чтении;
+    max_age ограничивает жизнь таблицы без перезагрузки.
+    """
+
+    def __init__(self, max_age=600):
+        self.max_age = max_age
+        self.boards = {}
+
+    def load(self, chat_id, snapshots):
+        board = ChatBoard(snapshots)
+        self.boards[chat_id] = board
+        return board
+
+    def board(self, chat_id):
+        """Актуальная таблица чата или None, если ее нужно загрузить"""
+        board = self.boards.get(chat_id)
+        if board is None or board.stale or time.monotonic() - board.loaded_at > self.max_age:
+            return None
+        return board
+
+    def apply(self, chat_id, snapshot, old_rating=None):
+        """Обновляет участника по ответу на отправку сообщения; таблицы незагруженных чатов не трогает"""
+        board = self.boards.get(chat_id)
+        if board is None or not snapshot:
+            return
+        if old_rating is not None:
+            member = board.members.get(snapshot['user_telegram_id'])
+            if (member.rating if member else 0) != old_rating:
+                board.stale = True
+        board.update(snapshot)
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Результаты отправки сообщения в Django
+SENT = 'sent'          # принято
+RETRY = 'retry'        # Django недоступен - повторить позже, попытка не считается
+FAILED = 'failed'      # Django отклонил именно это сообщение - не повторяется, уходит в dead_letters
+
+
+class Spool:
+    """Локальный журнал сообщений, которые не удалось отправить в Django.
+
+    SQLite в режиме WAL: записи добавляются в конец и отправляются строго по порядку
+    фоновой задачей, когда Django снова отвечает. Пока журнал не пуст, новые сообщения
+    тоже идут в журнал, чтобы не обогнать отложенные (от порядка зависят серии).
+    Записи копятся и фиксируются одной транзакцией (один fsync на пачку).
+    Сообщения, которые Django отклонил (или которые max_attempts раз не удалось отправить
+    из-за неожиданной ошибки), переносятся в таблицу dead_letters и очередь не держат.
+    """
+
+    def __init__(self, path, send, max_messages=500000, flush_interval=0.1, batch_size=500,
+                 replay_batch=100, max_attempts=5, max_backoff=60):
+        self.path = path
+        self.send = send
+        self.max_messages = max_messages
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.replay_batch = replay_batch
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        # sqlite3 блокирующий: все операции с базой идут в одном отдельном потоке
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spool')
+        self._db = None
+        self._pending = []
+        self._flush_task = None
+        self._replay_task = None
+        self._wakeup = None
+        # Записей в журнале, включая еще не зафиксированные
+        self.size = 0
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open_db(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=FULL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS spool ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, '
+            'created_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)'
+        )
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS dead_letters ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, failed_at REAL NOT NULL)'
+        )
+        self._db = db
+        return db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+    async def open(self):
+        """Открывает журнал и запускает фоновую отправку оставшихся с прошлого запуска записей"""
+        self.size = await self._run(self._open_db)
+        self._wakeup = asyncio.Event()
+        self._replay_task = asyncio.create_task(self._replay_loop())
+        self._replay_task.add_done_callback(self._replay_stopped)
+        if self.size:
+            logger.warning(f"В журнале {self.size} неотправленных сообщений, отправляю по порядку")
+            self._wakeup.set()
+
+    @property
+    def active(self):
+        """Есть отложенные сообщения: новые должны встать за ними"""
+        return self.size > 0
+
+    async def append(self, payload):
+        """Добавляет сообщение в журнал и ждет фиксации его пачки на диске.
+
+        Возвращает False, если журнал переполнен и сообщение не сохранено.
+        """
+        if self.size >= self.max_messages:
+            logger.error(f"Журнал переполнен ({self.size} сообщений), сообщение {payload.get('telegram_message_id')} потеряно")
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((json.dumps(payload, ensure_ascii=False), future))
+        self.size += 1
+        if len(self._pending) >= self.batch_size:
+            await self._flush()
+        elif not self._flush_task:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        await asyncio.shield(future)
+        return True
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self._flush()
+
+    def _insert(self, rows):
+        now = time.time()
+        self._db.execute('BEGIN')
+        self._db.executemany('INSERT INTO spool (payload, created_at) VALUES (?, ?)', [(row, now) for row in rows])
+        self._db.execute('COMMIT')
+
+    async def _flush(self):
+        """Фиксирует накопленные записи одной транзакцией"""
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            await self._run(self._insert, [row for row, _ in batch])
+        except Exception as e:
+            logger.error(f"Не удалось записать {len(batch)} сообщений в журнал: {e}")
+            self.size -= len(batch)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+        self._wakeup.set()
+
+    def _read_head(self, limit):
+        return self._db.execute('SELECT id, payload, attempts FROM spool ORDER BY id LIMIT ?', (limit,)).fetchall()
+
+    def _delete(self, ids):
+        self._db.execute('BEGIN')
+        self._db.executemany('DELETE FROM spool WHERE id = ?', [(row_id,) for row_id in ids])
+        self._db.execute('COMMIT')
+
+    def _insert_dead(self, payload):
+        self._db.execute('INSERT INTO dead_letters (payload, failed_at) VALUES (?, ?)', (payload, time.time()))
+
+    def _move_to_dead(self, row_id):
+        self._db.execute('BEGIN')
+        self._db.execute(
+            'INSERT INTO dead_letters (payload, failed_at) SELECT payload, ? FROM spool WHERE id = ?', (time.time(), row_id)
+        )
+        self._db.execute('DELETE FROM spool WHERE id = ?', (row_id,))
+        self._db.execute('COMMIT')
+
+    async def dead_letter(self, payload):
+        """Сохраняет отклоненное сообщение для разбора, не ставя его в очередь"""
+        await self._run(self._insert_dead, json.dumps(payload, ensure_ascii=False))
+
+    def _count_attempt(self, row_id):
+        self._db.execute('UPDATE spool SET attempts = attempts + 1 WHERE id = ?', (row_id,))
+
+    async def _replay_loop(self):
+        """Отправляет записи из начала журнала; при недоступности Django ждет с растущей паузой"""
+        backoff = 1
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                try:
+                    rows = await self._run(self._read_head, self.replay_batch)
+                    if not rows:
+                        break
+                    done, stalled = await self._replay_rows(rows)
+                    if done:
+                        await self._run(self._delete, done)
+                        self.size -= len(done)
+                except Exception:
+                    # Задача должна жить: иначе журнал никогда не опустеет и все новые сообщения останутся в нем
+                    logger.exception("Ошибка при отправке журнала, повторю позже")
+                    stalled = True
+                if stalled:
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                else:
+                    backoff = 1
+            if self.size == 0:
+                logger.info("Журнал отправлен в Django полностью")
+
+    def _replay_stopped(self, task):
+        if not task.cancelled() and task.exception():
+            logger.error("Отправка журнала остановилась", exc_info=task.exception())
+        elif not task.cancelled():
+            logger.error("Отправка журнала остановилась")
+
+    async def _replay_rows(self, rows):
+        """Отправляет пачку по порядку до первой неудачи; возвращает (id для удаления, нужна ли пауза)"""
+        done = []
+        for row_id, payload, attempts in rows:
+            try:
+                result = await self.send(json.loads(payload))
+            except Exception:
+                logger.exception(f"Неожиданная ошибка при отправке сообщения из журнала (попытка {attempts + 1})")
+                if attempts + 1 < self.max_attempts:
+                    await self._run(self._count_attempt, row_id)
+                    return done, True
+                result = FAILED
+            if result == SENT:
+                done.append(row_id)
+                continue
+            if result == FAILED:
+                # Повтор не поможет, а в начале очереди сообщение задержало бы все следующие
+                logger.error(f"Сообщение из журнала перенесено в dead_letters: {payload[:200]}")
+                await self._run(self._move_to_dead, row_id)
+                self.size -= 1
+                continue
+            return done, True
+        return done, False
+
+    async def close(self):
+        """Фиксирует накопленное и останавливает отправку; неотправленное останется до следующего запуска"""
+        if self._flush_task:
+            await self._flush_task
+        await self._flush()
+        if self._replay_task:
+            self._replay_task.cancel()
+            await asyncio.gather(self._replay_task, return_exceptions=True)
+        if self._db:
+            await self._run(self._db.close)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,91 @@
+import hmac
+import logging
+from aiohttp import web
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiogram.utils.executor import Executor
+from lanes import LaneDispatcher
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram присылает secret_token из setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+SECRET_KEY = 'webhook_secret'
+READY_KEY = 'webhook_ready'
+
+
+class SecretWebhookRequestHandler(WebhookRequestHandler):
+    """Обработчик вебхука aiogram, который принимает обновления только с верным секретным токеном"""
+
+    async def post(self):
+        secret = self.request.app[SECRET_KEY]
+        if not hmac.compare_digest(self.request.headers.get(SECRET_HEADER, ''), secret):
+            logger.warning(f"Отклонен запрос к вебхуку без верного секретного токена от {self.request.remote}")
+            raise web.HTTPUnauthorized()
+        return await super().post()
+
+    async def process_update(self, update):
+        """Обновление ставится в полосу своего чата; Telegram получает ответ, как только для него нашлось место"""
+        dispatcher = self.get_dispatcher()
+        if isinstance(dispatcher, LaneDispatcher):
+            await dispatcher.enqueue(update)
+            return None
+        return await super().process_update(update)
+
+
+async def health(request):
+    """Процесс жив и принимает соединения"""
+    return web.json_response({'status': 'ok'})
+
+
+async def ready(request):
+    """Готов принимать обновления: вебхук настроен и воркер не останавливается"""
+    if not request.app[READY_KEY]:
+        return web.json_response({'status': 'starting'}, status=503)
+    return web.json_response({'status': 'ready'})
+
+
+def create_web_app(secret):
+    """aiohttp-приложение с проверками для балансировщика; маршрут вебхука добавит executor"""
+    app = web.Application()
+    app[SECRET_KEY] = secret
+    app[READY_KEY] = False
+    app.router.add_get('/healthz', health)
+    app.router.add_get('/readyz', ready)
+    return app
+
+
+def run_webhook(dp, path, secret, host, port, public_url=None, max_connections=40, on_startup=None, on_shutdown=None):
+    """Запускает бота в режиме вебхука на aiohttp-сервере через executor aiogram.
+
+    public_url - внешний адрес (https://bot.example.com), на который Telegram шлет обновления;
+    если не задан, вебхук не регистрируется (например, его уже настроил другой воркер).
+    on_startup/on_shutdown - корутины без аргументов, которые выполняются до приема обновлений
+    и после того, как принятые обновления обработаны.
+    """
+    app = create_web_app(secret)
+
+    async def startup(dispatcher):
+        if on_startup:
+            await on_startup()
+        if public_url:
+            url = public_url.rstrip('/') + path
+            await dispatcher.bot.set_webhook(url, secret_token=secret, max_connections=max_connections)
+            logger.info(f"Вебхук зарегистрирован: {url}")
+        app[READY_KEY] = True
+        logger.info(f"Бот принимает обновления на {host}:{port}{path}")
+
+    async def shutdown(dispatcher):
+        # Вебхук не удаляем: остальные воркеры за балансировщиком продолжают работать
+        app[READY_KEY] = False
+        if isinstance(dispatcher, LaneDispatcher):
+            await dispatcher.drain()
+        if on_shutdown:
+            await on_shutdown()
+
+    executor = Executor(dp, skip_updates=False)
+    executor.on_startup(startup, polling=False, webhook=True)
+    executor.on_shutdown(shutdown, polling=False, webhook=True)
+    executor.set_webhook(path, request_handler=SecretWebhookRequestHandler, web_app=app)
+    # Сервер должен работать в том же цикле событий, где executor уже открыл сессию бота
+    executor.run_app(host=host, port=port, loop=executor.loop)